@@ -1,10 +1,19 @@
 
 import sublime, sublime_plugin
-import re, os, itertools
-from LuaAutocomplete.locals import LocalsFinder
-from LuaAutocomplete import indexer
+import re
+from LuaAutocomplete.locals import IncrementalLocalsFinder, merge_scopes
+from LuaAutocomplete import indexer, metrics, lexer, reparse
+
+LUA_SYNTAX = "Packages/Lua/Lua.sublime-syntax"
+
+def plugin_unloaded():
+	indexer.stop_all_watching()
+	reparse.REPARSER.stop()
 
 class LocalsAutocomplete(sublime_plugin.EventListener):
+	# Incremental locals finders, keyed by view id
+	finders = {}
+	
 	@staticmethod
 	def can_local_autocomplete(view, location):
 		"""
@@ -31,36 +40,92 @@ class LocalsAutocomplete(sublime_plugin.EventListener):
 		return True
 	
 	def on_query_completions(self, view, prefix, locations):
-		if view.settings().get("syntax") != "Packages/Lua/Lua.sublime-syntax":
+		if view.settings().get("syntax") != LUA_SYNTAX:
 			# Not Lua, don't do anything.
 			return
 		
-		location = locations[0] # TODO: Better multiselect behavior?
+		location = locations[0]
 		
 		if not LocalsAutocomplete.can_local_autocomplete(view, location):
 			return
 		
-		src = view.substr(sublime.Region(0, view.size()))
-
-		results = indexer.index_module(view, location, src)
+		# Other cursors in strings, comments or after a `.` don't take locals and are left out of the scan
+		locations = [loc for loc in locations if LocalsAutocomplete.can_local_autocomplete(view, loc)]
+		
+		with metrics.Request("completion.locals", view.file_name(), location):
+			# The background reparse only touches the view's stream, indexer and finder between slices that hold this lock
+			with metrics.phase("lock"):
+				lock = reparse.REPARSER.get_lock(view.id())
+				lock.acquire()
+			try:
+				return self.complete(view, prefix, location, locations)
+			finally:
+				lock.release()
+	
+	def complete(self, view, prefix, location, locations):
+		limits = indexer.get_parse_limits(view.file_name())
+		src, change_count = self.get_content(view, limits)
+		
+		results = indexer.index_module(view, location, src, prefix, change_count)
 		if results is not None: return results
 		
-		localsfinder = LocalsFinder(src)
-		varz = localsfinder.run(location)
+		# The token stream is shared with the indexer, so a buffer version that index_module has seen isn't lexed again
+		with metrics.phase("lex"):
+			stream = lexer.get_view_stream(view.id(), change_count, src, limits.max_line_length)
 		
-		return [(name+"\t"+data.vartype,name) for name, data in varz.items()]
-
-class RequireAutocomplete(sublime_plugin.EventListener):
+		localsfinder = self.get_finder(view, stream)
+		
+		# A scan that runs out of time returns the locals found so far; the next request resumes from its checkpoints
+		localsfinder.time_budget = limits.time_budget_ms / 1000.0 if limits.time_budget_ms else None
+		
+		# All cursors are handled in one scan; only the locals in scope at every cursor are offered
+		with metrics.phase("locals"):
+			varz = merge_scopes(localsfinder.run_many(locations))
+		
+		if localsfinder.partial:
+			metrics.increment("completion.locals.partial")
+		
+		with metrics.phase("filter"):
+			return indexer.filter_completions([(name+"\t"+data.vartype,name) for name, data in varz.items()], prefix)
 	
 	@staticmethod
-	def filter_lua_files(filenames):
-		for f in filenames:
-			fname, ext = os.path.splitext(f)
-			if ext == ".lua" or ext == ".luac":
-				yield fname
+	def get_content(view, limits):
+		"""
+		Returns the content to complete against and its change count. The view isn't copied when the shared token stream
+		already has its current content. Buffers larger than INLINE_PARSE_SIZE use the content of the last background
+		reparse, which may be a few edits behind, so that a keystroke doesn't have to parse the whole file.
+		"""
+		change_count = view.change_count()
+		stream = lexer.VIEW_STREAMS.get(view.id())
+		if stream is not None:
+			if stream.buffer_version == change_count:
+				return stream.content, change_count
+			
+			ready = reparse.REPARSER.get_version(view.id())
+			if ready is not None and ready == stream.buffer_version and view.size() > limits.inline_parse_size:
+				metrics.increment("completion.background_result")
+				return stream.content, ready
+		
+		with metrics.phase("substr"):
+			return view.substr(sublime.Region(0, view.size())), change_count
 	
+	@classmethod
+	def get_finder(cls, view, stream):
+		localsfinder = cls.finders.get(view.id())
+		if localsfinder is None or localsfinder.stream is not stream:
+			localsfinder = IncrementalLocalsFinder(stream=stream)
+			cls.finders[view.id()] = localsfinder
+		return localsfinder
+	
+	def on_close(self, view):
+		self.finders.pop(view.id(), None)
+		indexer.clear_view_file_indexer(view)
+		lexer.clear_view_stream(view.id())
+		reparse.REPARSER.forget(view.id())
+
+class RequireAutocomplete(sublime_plugin.EventListener):
 	def on_query_completions(self, view, prefix, locations):
-		if view.settings().get("syntax") != "Packages/Lua/Lua.sublime-syntax":
+		if view.settings().get("syntax") != LUA_SYNTAX:
 			# Not Lua, don't do anything.
 			return
 		
@@ -70,7 +135,7 @@ class RequireAutocomplete(sublime_plugin.EventListener):
 			return
 		
 		location = locations[0]
-		src = view.substr(sublime.Region(0, location))
+		src = view.substr(sublime.Region(view.line(location).begin(), location))
 		
 		match = re.search(r"""require\s*\(?\s*["']([^"]*)$""", src)
 		if not match:
@@ -80,32 +145,27 @@ class RequireAutocomplete(sublime_plugin.EventListener):
 		
 		results = []
 
-		for project_path in indexer.get_all_project_paths():
-			proj_indexer = indexer.get_or_load_project_indexer(project_path)
-			for lpath in proj_indexer.lua_paths:
-
-				cur_path = os.path.join(project_path, lpath, *(module_path[:-1]))
-				if not os.path.exists(cur_path) or not os.path.isdir(cur_path):
-					continue
-				print("curpath:", cur_path)
-				
-				_, dirs, files = next(os.walk(cur_path)) # walk splits directories and regular files for us
-				
-				results.extend(map(lambda x: (x+"\tsubdirectory", x), dirs))
-				results.extend(map(lambda x: (x+"\tmodule", x), RequireAutocomplete.filter_lua_files(files)))
+		with metrics.Request("completion.require", view.file_name(), location):
+			for project_path in indexer.get_all_project_paths():
+				proj_indexer = indexer.get_or_load_project_indexer(project_path)
+				results.extend(proj_indexer.get_module_children(module_path[:-1]))
 		
 		return results, sublime.INHIBIT_WORD_COMPLETIONS | sublime.INHIBIT_EXPLICIT_COMPLETIONS
 
 class LuaIndexProjectCommand(sublime_plugin.WindowCommand):
 	def run(self):
-		indexer.generate_indices()
+		indexer.generate_indices(self.on_finished)
+
+	def on_finished(self, proj_indexer):
 		self.window.status_message("generate lua project index finished.")
 
 		indexer.write_debug_info()
 
 class LuaIndexProjectViewCommand(sublime_plugin.TextCommand):
 	def run(self, edit):
-		indexer.generate_indices()
+		indexer.generate_indices(self.on_finished)
+
+	def on_finished(self, proj_indexer):
 		self.view.window().status_message("generate lua project index finished.")
 
 		indexer.write_debug_info()
@@ -113,6 +173,186 @@ class LuaIndexProjectViewCommand(sublime_plugin.TextCommand):
 	def is_visible(self):
 		return self.view.file_name().endswith(".lua")
 
+class LuaGotoSymbolCommand(sublime_plugin.WindowCommand):
+	"""
+	Asks for a name, searches the symbols of the window's Lua projects (substring or fuzzy) and opens the selected definition
+	"""
+	def run(self, query=None):
+		if query is not None:
+			self.on_done(query)
+			return
+		
+		# Start with the selected text, if any
+		initial = ""
+		view = self.window.active_view()
+		if view is not None and len(view.sel()) > 0 and not view.sel()[0].empty():
+			initial = view.substr(view.sel()[0])
+		
+		self.window.show_input_panel("Lua symbol:", initial, self.on_done, None, None)
+	
+	def on_done(self, query):
+		with metrics.Request("goto_symbol"):
+			self.locations = indexer.search_symbols(query)
+		
+		if not self.locations:
+			self.window.status_message("No Lua symbol matches '%s'" % query)
+			return
+		
+		items = []
+		for location in self.locations:
+			items.append([location.name, "%s %s" % (location.kind, location.container), "%s:%d" % (location.file_path, location.line + 1)])
+		
+		self.window.show_quick_panel(items, self.on_select)
+	
+	def on_select(self, index):
+		if index < 0:
+			return
+		
+		location = self.locations[index]
+		self.window.open_file("%s:%d" % (location.file_path, location.line + 1), sublime.ENCODED_POSITION)
+
+class LuaDumpMetricsCommand(sublime_plugin.WindowCommand):
+	"""
+	Shows completion latency histograms, cache hit rates, indexing counters and the slow query log in a new view
+	"""
+	def run(self):
+		report = metrics.format_report()
+		print(report)
+
+		view = self.window.new_file()
+		view.set_name("LuaAutocomplete Metrics")
+		view.set_scratch(True)
+		view.run_command("append", {"characters" : report})
+
+class LuaPrefetchModules(sublime_plugin.EventListener):
+	"""
+	For projects with LAZY_INDEX, indexes the modules required by the loaded or activated file, and everything they require, in the background
+	"""
+	def on_load_async(self, view):
+		self.prefetch(view)
+	
+	def on_activated_async(self, view):
+		self.prefetch(view)
+	
+	def prefetch(self, view):
+		file_path = view.file_name()
+		window = view.window()
+		if file_path is None or not file_path.endswith(".lua") or window is None:
+			return
+		
+		project_path = indexer.get_window_project_paths(window).find(file_path)
+		if project_path is None:
+			return
+		
+		indexer.prefetch_requires(project_path, view.substr(sublime.Region(0, view.size())))
+
+class LuaProjectPaths(sublime_plugin.EventListener):
+	"""
+	Drops the window's cached project folders when the project data has changed, so that completions don't have to
+	compare the project data on every request
+	"""
+	def on_load_project(self, window):
+		indexer.refresh_window_project_paths(window)
+	
+	def on_post_save_project(self, window):
+		indexer.refresh_window_project_paths(window)
+	
+	def on_post_save(self, view):
+		# The project file was edited by hand
+		file_name = view.file_name()
+		if file_name is not None and file_name.endswith(".sublime-project") and view.window() is not None:
+			indexer.refresh_window_project_paths(view.window())
+	
+	def on_activated(self, view):
+		# Folders added from a dialog are seen when a view in the window gets focus again
+		window = view.window()
+		if window is not None:
+			indexer.refresh_window_project_paths(window)
+
+class LuaBackgroundReparse(sublime_plugin.EventListener):
+	"""
+	Reparses the modified or activated Lua view on a worker thread once edits stop for BACKGROUND_PARSE_DELAY_MS,
+	so that completions find the token stream, the file index and the locals checkpoints up to date
+	"""
+	def on_modified_async(self, view):
+		self.schedule(view)
+	
+	def on_activated_async(self, view):
+		self.schedule(view)
+	
+	@classmethod
+	def schedule(cls, view):
+		if view.settings().get("syntax") != LUA_SYNTAX:
+			return
+		
+		limits = indexer.get_parse_limits(view.file_name(), view.window())
+		if not limits.background_delay_ms:
+			return
+		
+		if reparse.REPARSER.get_version(view.id()) == view.change_count():
+			return # Activated without changes since the last reparse
+		
+		reparse.REPARSER.schedule(view.id(), limits.background_delay_ms / 1000.0, lambda cancelled: cls.reparse(view, cancelled))
+	
+	@staticmethod
+	def reparse(view, cancelled):
+		"""
+		Brings the view's shared state up to date in slices of reparse.SLICE_SECONDS, and gives up as soon as the view
+		is modified again, since a newer reparse is scheduled by then
+		"""
+		if not view.is_valid():
+			return
+		
+		start = metrics.now()
+		key = view.id()
+		version = view.change_count()
+		src = view.substr(sublime.Region(0, view.size()))
+		if view.change_count() != version:
+			return
+		
+		file_path = view.file_name()
+		window = view.window()
+		limits = indexer.get_parse_limits(file_path, window)
+		location = view.sel()[0].begin() if len(view.sel()) > 0 else 0
+		lock = reparse.REPARSER.get_lock(key)
+		
+		with lock:
+			stream = lexer.get_view_stream(key, version, src, limits.max_line_length)
+			
+			# Only projects that are already loaded; opening a view doesn't start indexing
+			proj_indexer = indexer.get_loaded_project_indexer(file_path, window)
+			file_indexer = None
+			if proj_indexer is not None:
+				file_indexer = indexer.get_file_indexer(key, version, file_path, proj_indexer, src, location)
+		
+		while file_indexer is not None and file_indexer.pending:
+			if cancelled(): return
+			with lock:
+				file_indexer.resume(metrics.now() + reparse.SLICE_SECONDS)
+		
+		# Scanning to the end of the buffer leaves checkpoints every few lines, so a completion only scans from the one before the cursor
+		reached = -1
+		while True:
+			if cancelled(): return
+			with lock:
+				if stream.buffer_version != version:
+					return # A completion already moved the stream to a newer version
+				
+				localsfinder = LocalsAutocomplete.get_finder(view, stream)
+				localsfinder.time_budget = reparse.SLICE_SECONDS
+				localsfinder.run(len(src))
+				if not localsfinder.partial:
+					reparse.REPARSER.set_version(key, version)
+					break
+				
+				# Each slice resumes from the checkpoint where the last one stopped; stop if one didn't get any further
+				if localsfinder.line <= reached:
+					print("background reparse made no progress at line %d:" % reached, file_path)
+					return
+				reached = localsfinder.line
+		
+		metrics.record("reparse.view", (metrics.now() - start) * 1000.0)
+
 class LuaIndexFileSave(sublime_plugin.EventListener):
 	def on_post_save(self, view):
 		file_path = view.file_name()
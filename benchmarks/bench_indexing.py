@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# 比较不同进程数下生成工程索引的耗时。
+#   python benchmarks/bench_indexing.py --files 4000 --workers 1,2,4,8
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import common
+common.setup_package()
+
+from LuaAutocomplete import indexer
+
+def run(project_path, workers):
+	proj_indexer = indexer.ProjectIndexer(project_path)
+	proj_indexer.index_workers = workers
+	# 不使用任何缓存，包括按内容共享的解析结果
+	proj_indexer.use_cache = False
+
+	start = time.time()
+	proj_indexer.generate_indices()
+	return time.time() - start, proj_indexer
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--files", type = int, default = 4000)
+	parser.add_argument("--workers", default = "1,2,4,8")
+	args = parser.parse_args()
+
+	root = tempfile.mkdtemp(prefix = "lua-autocomplete-project-")
+	try:
+		common.generate_project(root, args.files)
+
+		baseline = None
+		for workers in [int(x) for x in args.workers.split(",")]:
+			elapsed, proj_indexer = run(root, workers)
+			if baseline is None:
+				baseline = (elapsed, proj_indexer)
+			elif proj_indexer.symbols != baseline[1].symbols or proj_indexer.classes != baseline[1].classes:
+				print("workers=%d: results differ from workers=1" % workers)
+
+			print("workers=%d: %.3fs, speedup %.2fx" % (workers, elapsed, baseline[0] / elapsed))
+	finally:
+		shutil.rmtree(root)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# 检查基于token流的LocalsFinder与正则扫描（合并正则、逐个正则）的结果是否一致，并比较耗时。
+# 正则扫描在for循环头等跨越多个token的匹配中不会跳过字符串和注释，这些情况下的不一致是预期的。
+#   python benchmarks/bench_locals.py --modules 200 [file.lua ...]
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import common
+common.setup_package()
+
+from LuaAutocomplete.locals import LocalsFinder, IncrementalLocalsFinder
+from reference_locals import RegexLocalsFinder, MultiPatternLocalsFinder
+
+def run_finder(finder_class, code, cursor):
+	try:
+		return finder_class(code).run(cursor)
+	except Exception as e:
+		return type(e).__name__
+
+def check_corpus(name, code, samples, rnd):
+	cursors = [len(code) * i // samples for i in range(samples + 1)]
+	cursors.extend(rnd.randrange(len(code) + 1) for i in range(samples))
+
+	mismatches = 0
+	for cursor in cursors:
+		expected = run_finder(MultiPatternLocalsFinder, code, cursor)
+		if run_finder(RegexLocalsFinder, code, cursor) != expected:
+			mismatches += 1
+			print("%s: combined regex mismatch at %d" % (name, cursor))
+
+		if run_finder(LocalsFinder, code, cursor) != expected:
+			mismatches += 1
+			print("%s: token stream mismatch at %d" % (name, cursor))
+
+	# 一次扫描所有光标的结果，应该与逐个光标扫描相同
+	scopes = LocalsFinder(code).run_many(cursors)
+	for cursor, scope in zip(cursors, scopes):
+		if scope != run_finder(LocalsFinder, code, cursor):
+			mismatches += 1
+			print("%s: run_many mismatch at %d" % (name, cursor))
+	return mismatches
+
+# 很长的没有关键字的数据表：有时间限制时，重复的请求要从上次停下的位置继续，最终得到完整的结果
+def check_budget_progress(rows, time_budget):
+	code = "local head = 1\nlocal data = {\n"
+	code += "".join("\t{%d, \"row%d\", %d.5},\n" % (i, i, i) for i in range(rows))
+	code += "}\nlocal tail = 2\n"
+	expected = LocalsFinder(code).run(len(code))
+
+	# 每次至少前进budget_check_lines行
+	finder = IncrementalLocalsFinder(code, time_budget)
+	max_runs = rows // finder.budget_check_lines + 2
+	for runs in range(1, max_runs + 1):
+		scope = finder.run(len(code))
+		if not finder.partial:
+			break
+
+	if finder.partial or scope != expected:
+		print("data table: budgeted runs did not converge after %d runs" % runs)
+		return 1
+	print("data table (%d rows): complete after %d budgeted runs" % (rows, runs))
+	return 0
+
+def time_finder(finder_class, code, repeat):
+	best = None
+	for i in range(repeat):
+		start = time.time()
+		run_finder(finder_class, code, len(code))
+		elapsed = time.time() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--modules", type = int, default = 200, help = "number of synthetic modules in the large file")
+	parser.add_argument("--samples", type = int, default = 50, help = "cursor positions checked per file")
+	parser.add_argument("--repeat", type = int, default = 3)
+	parser.add_argument("--table-rows", type = int, default = 30000, help = "rows of the keyword-free data table")
+	parser.add_argument("files", nargs = "*")
+	args = parser.parse_args()
+
+	rnd = random.Random(0)
+	previous = [("pkg", "mod%d" % i) for i in range(10)]
+	corpus = [("synthetic", "".join(common.generate_module(rnd, previous, "M%d" % i) for i in range(args.modules)))]
+	for path in args.files:
+		with open(path, "r", encoding = "utf-8") as f:
+			corpus.append((path, f.read()))
+
+	mismatches = 0
+	for name, code in corpus:
+		mismatches += check_corpus(name, code, args.samples, rnd)
+
+		tokens = time_finder(LocalsFinder, code, args.repeat)
+		single = time_finder(RegexLocalsFinder, code, args.repeat)
+		multi = time_finder(MultiPatternLocalsFinder, code, args.repeat)
+		print("%s (%d chars): token stream %.3fs, combined regex %.3fs, multi-pattern %.3fs" % (name, len(code), tokens, single, multi))
+
+	mismatches += check_budget_progress(args.table_rows, 0.005)
+
+	print("mismatches: %d" % mismatches)
+	return 1 if mismatches else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
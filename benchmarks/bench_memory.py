@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# 比较符号表的内存占用：旧的 "名字\t类型" : 补全内容 格式，和现在的驻留名字 + 共享Symbol格式。
+#   python benchmarks/bench_memory.py --files 50000
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import common
+common.setup_package()
+
+from LuaAutocomplete import indexer
+
+# 解析生成的模块，返回所有文件的符号表 [{路径 : 符号表}, ...]
+def parse_corpus(num_files, seed):
+	rnd = random.Random(seed)
+	modules = [("pkg%d" % (i % 32), "mod%d" % i) for i in range(num_files)]
+
+	results = []
+	for i, (package, name) in enumerate(modules):
+		content = common.generate_module(rnd, modules, name, i)
+
+		file_indexer = indexer.FileIndexer(None, package + "." + name)
+		for line in content.splitlines(True):
+			file_indexer.pos += len(line)
+			file_indexer.parse_line(line)
+
+		results.append(file_indexer.get_result()["symbols"])
+	return results
+
+# 新的字符串对象，模拟旧格式中每个符号都有自己的字符串
+def copy_str(s):
+	return s.encode("utf-8").decode("utf-8")
+
+# 转换成旧的符号表格式
+def to_legacy_tables(tables):
+	ret = {}
+	for path, table in tables.items():
+		legacy = {}
+		for name, symbol in table.items():
+			if symbol.kind == indexer.KIND_FUNCTION:
+				value = "%s($0%s)" % (name, symbol.args)
+			else:
+				value = copy_str(name)
+			legacy[copy_str(name) + "\t" + indexer.KIND_NAMES[symbol.kind]] = value
+
+		ret[copy_str(path)] = legacy
+	return ret
+
+# 对象及其引用的所有对象占用的字节数，共享的对象只计算一次
+def deep_size(obj, seen):
+	if id(obj) in seen:
+		return 0
+
+	seen.add(id(obj))
+	size = sys.getsizeof(obj)
+	if isinstance(obj, dict):
+		for key, value in obj.items():
+			size += deep_size(key, seen) + deep_size(value, seen)
+	elif isinstance(obj, (list, tuple)):
+		for value in obj:
+			size += deep_size(value, seen)
+	elif isinstance(obj, indexer.Symbol):
+		size += deep_size(obj.args, seen)
+	return size
+
+def count_symbols(results):
+	return sum(len(table) for tables in results for table in tables.values())
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--files", type = int, default = 50000)
+	parser.add_argument("--seed", type = int, default = 0)
+	args = parser.parse_args()
+
+	start = time.time()
+	results = parse_corpus(args.files, args.seed)
+	print("parsed %d files in %.1fs" % (args.files, time.time() - start))
+
+	symbols = count_symbols(results)
+	compact = deep_size(results, set())
+
+	legacy_results = [to_legacy_tables(tables) for tables in results]
+	legacy = deep_size(legacy_results, set())
+
+	print("symbols: %d" % symbols)
+	print("legacy:  %d bytes, %.1f bytes/symbol" % (legacy, legacy / float(symbols)))
+	print("compact: %d bytes, %.1f bytes/symbol" % (compact, compact / float(symbols)))
+	print("ratio:   %.2fx" % (legacy / float(compact)))
+
+if __name__ == "__main__":
+	main()
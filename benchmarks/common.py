@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# 基准测试的公共代码：在sublime之外加载插件，并生成用于测试的lua工程。
+import os
+import sys
+import types
+import random
+
+import stubs
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def setup_package():
+	""" 把仓库目录注册成LuaAutocomplete包，并在没有sublime模块时使用替身。 """
+	if "sublime" not in sys.modules:
+		try:
+			import sublime
+		except ImportError:
+			sys.modules["sublime"] = stubs.make_sublime_module()
+
+	if "sublime_plugin" not in sys.modules:
+		try:
+			import sublime_plugin
+		except ImportError:
+			sys.modules["sublime_plugin"] = stubs.make_sublime_plugin_module()
+
+	if "LuaAutocomplete" not in sys.modules:
+		package = types.ModuleType("LuaAutocomplete")
+		package.__path__ = [ROOT_PATH]
+		sys.modules["LuaAutocomplete"] = package
+
+def generate_project(root, num_files, seed = 0):
+	""" 在root下生成一个有num_files个lua文件的工程，返回工程路径。 """
+	rnd = random.Random(seed)
+
+	with open(os.path.join(root, ".luacomplete.py"), "w") as f:
+		f.write('LUA_PATHS = ["scripts"]\n')
+
+	modules = []
+	for i in range(num_files):
+		package = "pkg%d" % (i % 32)
+		modules.append((package, "mod%d" % i))
+
+	for i, (package, name) in enumerate(modules):
+		dir_path = os.path.join(root, "scripts", package)
+		if not os.path.isdir(dir_path):
+			os.makedirs(dir_path)
+
+		with open(os.path.join(dir_path, name + ".lua"), "w") as f:
+			f.write(generate_module(rnd, modules, name, i))
+
+	return root
+
+def generate_module(rnd, previous, name, count = None):
+	""" 生成一个lua模块。基类从previous的前count个模块中随机选择，count默认是整个列表。 """
+	if count is None:
+		count = len(previous)
+
+	lines = []
+	base = None
+	if count > 0:
+		# 一半的模块继承最近生成的模块，形成较深的继承链
+		if rnd.random() < 0.5:
+			index = count - 1 - rnd.randrange(min(count, 4))
+		else:
+			index = rnd.randrange(count)
+
+		base_package, base = previous[index]
+		lines.append('local %s = require("%s.%s")' % (base, base_package, base))
+	else:
+		lines.append('local Object = require("object")')
+		base = "Object"
+
+	requires = set([base])
+	for i in range(min(count, rnd.randint(0, 8))):
+		package, module = previous[rnd.randrange(count)]
+		if module in requires: continue
+
+		requires.add(module)
+		lines.append('local %s = require("%s.%s")' % (module, package, module))
+
+	lines.append('local %s = class("%s", %s)' % (name, name, base))
+	lines.append("")
+
+	lines.append("--[==[")
+	lines.append("  long comment: function %s:commented(a, b) local x = 1 end" % name)
+	for i in range(rnd.randint(0, 20)):
+		lines.append("  local commented%d = self.field%d -- %s" % (i, i, "x" * rnd.randint(0, 80)))
+	lines.append("]==]")
+
+	lines.append("local DOC_%s = [[" % name.upper())
+	for i in range(rnd.randint(0, 20)):
+		lines.append("  function %s.fake%d(a) local inside = 'string' end" % (name, i))
+	lines.append("]]")
+
+	for i in range(rnd.randint(10, 40)):
+		args = ", ".join("arg%d" % j for j in range(rnd.randint(0, 4)))
+		lines.append("function %s:method%d(%s)" % (name, i, args))
+		lines.append("\tlocal value = %d" % i)
+		lines.append("\tself.field%d = value -- comment %d" % (i, i))
+		lines.append("\tfor k, v in pairs(self) do")
+		lines.append('\t\tprint(k, v, "string with function inside")')
+		depth = rnd.randint(0, 8)
+		for j in range(depth):
+			lines.append("\t\t" + "\t" * j + "if v == %d then local nested%d = [[long string end]]" % (j, j))
+		for j in reversed(range(depth)):
+			lines.append("\t\t" + "\t" * j + "end")
+		lines.append("\tend")
+		lines.append("end")
+		lines.append("")
+
+	for i in range(rnd.randint(5, 20)):
+		lines.append("CONST_%s_%d = %d" % (name.upper(), i, i))
+
+	lines.append("function helper_%s(a, b)" % name)
+	lines.append("\treturn a + b")
+	lines.append("end")
+	lines.append("return %s" % name)
+	return "\n".join(lines) + "\n"
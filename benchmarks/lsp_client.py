@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+# 脚本化的LSP客户端：启动lsp_server.py，在生成的工程上模拟编辑器的操作（打开文件、增量修改、补全、搜索符号），
+# 检查每一步的结果并输出耗时。任何一步的结果不符合预期时返回1。
+#   python benchmarks/lsp_client.py [--files 200] [--repeat 50] [--storage sqlite] [--verbose]
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import common
+
+SERVER_SCRIPT = os.path.join(common.ROOT_PATH, "lsp_server.py")
+
+class LspError(Exception):
+	pass
+
+class LspClient(object):
+	def __init__(self, command, stderr = None, env = None):
+		self.process = subprocess.Popen(command, stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = stderr, env = env)
+		self.next_id = 1
+
+		# 服务器发送的通知
+		self.notifications = []
+
+	def send(self, message):
+		message["jsonrpc"] = "2.0"
+		body = json.dumps(message).encode("utf-8")
+		self.process.stdin.write(("Content-Length: %d\r\n\r\n" % len(body)).encode("ascii"))
+		self.process.stdin.write(body)
+		self.process.stdin.flush()
+
+	def read(self):
+		length = None
+		while True:
+			line = self.process.stdout.readline()
+			if not line:
+				raise LspError("server closed the connection")
+
+			line = line.strip()
+			if not line: break
+
+			name, _, value = line.decode("ascii").partition(":")
+			if name.lower() == "content-length":
+				length = int(value)
+
+		return json.loads(self.process.stdout.read(length).decode("utf-8"))
+
+	def request(self, method, params = None):
+		msg_id = self.next_id
+		self.next_id += 1
+		self.send({"id" : msg_id, "method" : method, "params" : params or {}})
+
+		while True:
+			message = self.read()
+			if message.get("id") != msg_id:
+				self.notifications.append(message)
+				continue
+
+			if "error" in message:
+				raise LspError("%s: %s" % (method, message["error"]["message"]))
+			return message.get("result")
+
+	def notify(self, method, params = None):
+		self.send({"method" : method, "params" : params or {}})
+
+	# 正常退出，返回服务器的退出码
+	def close(self, timeout = 10):
+		self.request("shutdown")
+		self.notify("exit")
+		self.process.stdin.close()
+		return self.process.wait(timeout)
+
+	def kill(self):
+		if self.process.poll() is None:
+			self.process.kill()
+			self.process.wait()
+
+def path_to_uri(path):
+	path = os.path.abspath(path).replace("\\", "/")
+	if not path.startswith("/"):
+		path = "/" + path
+	return "file://" + path
+
+def utf16_length(text):
+	return len(text.encode("utf-16-le")) // 2
+
+# 一个打开的文档。客户端也保存一份内容，用于计算修改的位置
+class Document(object):
+	def __init__(self, client, file_path):
+		self.client = client
+		self.uri = path_to_uri(file_path)
+		self.version = 1
+		with open(file_path, "r", encoding = "utf-8") as f:
+			self.lines = f.read().split("\n")
+
+		client.notify("textDocument/didOpen", {"textDocument" : {
+			"uri" : self.uri, "languageId" : "lua", "version" : self.version, "text" : "\n".join(self.lines)}})
+
+	# 用text替换第line行的 [start, end) 列（字符串中的位置），只发送这一处修改
+	def replace(self, line, start, end, text):
+		old = self.lines[line]
+		position = lambda column: {"line" : line, "character" : utf16_length(old[:column])}
+
+		self.version += 1
+		self.client.notify("textDocument/didChange", {
+			"textDocument" : {"uri" : self.uri, "version" : self.version},
+			"contentChanges" : [{"range" : {"start" : position(start), "end" : position(end)}, "text" : text}],
+		})
+		self.lines[line:line + 1] = (old[:start] + text + old[end:]).split("\n")
+
+	def set_line(self, line, text):
+		self.replace(line, 0, len(self.lines[line]), text)
+
+	# 在第line行的末尾补全，返回补全的标签列表
+	def complete(self, line):
+		result = self.client.request("textDocument/completion", {
+			"textDocument" : {"uri" : self.uri},
+			"position" : {"line" : line, "character" : utf16_length(self.lines[line])},
+		})
+		return [item["label"] for item in (result or {}).get("items", ())]
+
+	def close(self):
+		self.client.notify("textDocument/didClose", {"textDocument" : {"uri" : self.uri}})
+
+def wait_for_index(client, timeout):
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		status = client.request("luaAutocomplete/status")
+		if status["projects"] and not any(project["indexing"] for project in status["projects"]):
+			return status
+		time.sleep(0.05)
+	raise LspError("indexing did not finish in %ds" % timeout)
+
+class Checker(object):
+	def __init__(self):
+		self.failed = 0
+
+	def check(self, name, run, expect):
+		start = time.perf_counter()
+		result = run()
+		elapsed = (time.perf_counter() - start) * 1000.0
+
+		ok = expect(result)
+		if not ok:
+			self.failed += 1
+		print("%-28s %8.2fms  %s" % (name, elapsed, "ok" if ok else "FAILED: %r" % (result[:20] if isinstance(result, list) else result, )))
+
+def run_session(client, root, files, repeat):
+	checker = Checker()
+
+	start = time.perf_counter()
+	client.request("initialize", {
+		"processId" : os.getpid(),
+		"rootUri" : path_to_uri(root),
+		"capabilities" : {"general" : {"positionEncodings" : ["utf-16"]}},
+	})
+	client.notify("initialized")
+	status = wait_for_index(client, 120)
+	print("%-28s %8.2fms  %d files" % ("initialize + index", (time.perf_counter() - start) * 1000.0, status["projects"][0]["files"]))
+
+	# 工程中最后一个文件，它有最深的继承链。基类是第一个require进来的模块
+	last = files - 1
+	module_file = os.path.join(root, "scripts", "pkg%d" % (last % 32), "mod%d.lua" % last)
+	document = Document(client, module_file)
+	base_name = re.match(r"local (\w+) = require", document.lines[0]).group(1)
+
+	# 在第一个方法的局部变量之后插入一行用于输入
+	line = document.lines.index("\tlocal value = 0") + 1
+	document.replace(line, 0, 0, "\n")
+
+	contains = lambda *names: lambda labels: all(name in labels for name in names)
+
+	document.set_line(line, "\tself.")
+	checker.check("completion.self", lambda: document.complete(line), contains("method0", "field0"))
+
+	document.replace(line, 6, 6, "me")
+	checker.check("completion.self_prefix", lambda: document.complete(line),
+		lambda labels: "method0" in labels and all(label.startswith("me") for label in labels))
+
+	document.set_line(line, "\tlocal x = %s." % base_name)
+	checker.check("completion.module", lambda: document.complete(line), contains("method0"))
+
+	document.set_line(line, "\tlocal x = va")
+	checker.check("completion.locals", lambda: document.complete(line), contains("value"))
+
+	document.set_line(line, '\tprint("self.')
+	checker.check("completion.in_string", lambda: document.complete(line), lambda labels: labels == [])
+
+	# BMP之外的字符在utf-16中占两个编码单元，服务器需要正确转换列
+	document.set_line(line, '\tlocal s = "\U0001F600" ')
+	document.replace(line, len(document.lines[line]), len(document.lines[line]), "self.")
+	checker.check("completion.utf16", lambda: document.complete(line), contains("method0"))
+
+	document.set_line(line, '\tlocal m = require("pkg3.')
+	checker.check("completion.require", lambda: document.complete(line), contains("mod3"))
+
+	# 结果中的行应该是函数定义所在的行
+	with open(os.path.join(root, "scripts", "pkg1", "mod1.lua"), "r", encoding = "utf-8") as f:
+		helper_line = f.read().split("\n").index("function helper_mod1(a, b)")
+
+	def find_symbol():
+		return client.request("workspace/symbol", {"query" : "helper_mod1"})
+	checker.check("workspace.symbol", find_symbol,
+		lambda symbols: any(s["name"] == "helper_mod1" and s["location"]["uri"].endswith("/mod1.lua") and
+			s["location"]["range"]["start"]["line"] == helper_line for s in symbols))
+
+	checker.check("workspace.symbol_fuzzy", lambda: client.request("workspace/symbol", {"query" : "hlpmod12"}),
+		lambda symbols: any(s["name"] == "helper_mod12" for s in symbols))
+
+	# 模拟输入：每次输入一个字符之后请求补全
+	document.set_line(line, "\tself.")
+	samples = []
+	for i in range(repeat):
+		end = len(document.lines[line])
+		if i % 2 == 0:
+			document.replace(line, end, end, "m")
+		else:
+			document.replace(line, end - 1, end, "")
+
+		start = time.perf_counter()
+		labels = document.complete(line)
+		samples.append((time.perf_counter() - start) * 1000.0)
+		if "method0" not in labels:
+			checker.failed += 1
+			print("typing: missing completions after %d edits" % (i + 1))
+			break
+
+	samples.sort()
+	if samples:
+		print("%-28s median %.2fms  max %.2fms  (%d edits)" % ("typing.self", samples[len(samples) // 2], samples[-1], len(samples)))
+
+	document.close()
+
+	status = client.request("luaAutocomplete/status")
+	if status["documents"]:
+		checker.failed += 1
+		print("documents still open after close: %r" % status["documents"])
+
+	return checker.failed
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--files", type = int, default = 200, help = "number of files in the generated project")
+	parser.add_argument("--repeat", type = int, default = 50, help = "number of edits in the typing test")
+	parser.add_argument("--storage", choices = ("memory", "sqlite"), default = "memory", help = "INDEX_STORAGE of the generated project")
+	parser.add_argument("--verbose", action = "store_true", help = "show the server's log")
+	args = parser.parse_args()
+
+	root = tempfile.mkdtemp(prefix = "lua-autocomplete-lsp-")
+	common.generate_project(root, args.files)
+	with open(os.path.join(root, ".luacomplete.py"), "a") as f:
+		f.write('INDEX_STORAGE = "%s"\n' % args.storage)
+
+	# 索引缓存写到临时目录中，不影响用户的缓存
+	env = dict(os.environ)
+	env["HOME"] = env["USERPROFILE"] = root
+
+	log = None if args.verbose else tempfile.TemporaryFile()
+	client = LspClient([sys.executable, SERVER_SCRIPT], stderr = log, env = env)
+	try:
+		failed = run_session(client, root, args.files, args.repeat)
+
+		code = client.close()
+		if code != 0:
+			failed += 1
+			print("server exited with %d" % code)
+	except Exception:
+		client.kill()
+		if log is not None:
+			log.seek(0)
+			sys.stderr.write(log.read().decode("utf-8", "replace"))
+		raise
+	finally:
+		shutil.rmtree(root)
+
+	print("%d checks failed" % failed if failed else "all checks passed")
+	return 1 if failed else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
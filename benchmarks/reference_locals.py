@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+# 以前的两种局部变量扫描方式：合并正则（RegexLocalsFinder）和逐个正则（MultiPatternLocalsFinder）。
+# 插件已经不再使用，只用于bench_locals.py中检查基于token流的LocalsFinder的结果并比较耗时。
+from collections import OrderedDict
+import logging
+import time
+import re
+
+from LuaAutocomplete.locals import VarInfo, UPVALUE
+
+logger = logging.getLogger("LuaAutocomplete.locals")
+
+localvar_re = re.compile(r"(?:[a-zA-Z_][a-zA-Z0-9_]*|\.\.\.)")
+
+class StopParsing(Exception):
+	pass
+
+class TokenMatch(object):
+	"""
+	Wraps a match of the combined token regex so that group numbers are relative to the pattern that matched,
+	allowing the `handle_*` methods to treat it like a match of the individual pattern.
+	"""
+	__slots__ = ("match", "offset")
+	
+	def __init__(self, match, offset):
+		self.match = match
+		self.offset = offset
+	
+	def group(self, index=0):
+		return self.match.group(self.offset + index)
+	
+	def start(self):
+		return self.match.start()
+	
+	def end(self):
+		return self.match.end()
+
+def combine_patterns(patterns, first_chars):
+	"""
+	Joins the patterns into one alternation of named groups. Returns the regex and the group number of each pattern.
+	
+	At each position the alternatives are tried in order, so the leftmost match wins and ties go to the earlier pattern,
+	same as searching each pattern separately. Only the `for` patterns contain `.`, and they need re.S anyway.
+	first_chars must contain every character a pattern can start with; the lookahead lets the regex engine skip
+	other positions without trying each alternative.
+	"""
+	parts = []
+	offsets = {}
+	group = 1
+	for name, regex in patterns.items():
+		parts.append("(?P<%s>%s)" % (name, regex.pattern))
+		offsets[name] = group
+		group += 1 + regex.groups
+	return re.compile("(?=[%s])(?:%s)" % (re.escape(first_chars), "|".join(parts)), re.S), offsets
+
+class RegexLocalsFinder:
+	"""
+	The previous engine, which scans the code with its own regexes instead of the shared token stream.
+	Kept as a reference to compare the token based LocalsFinder against.
+	"""
+	
+	# Both patterns and matches need to be ordered, so that `longcomment` is tried first before `comment`
+	patterns = OrderedDict([
+		("for_incremental", re.compile(r"\bfor\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*=.*?\bdo\b", re.S)),
+		("for_iterator",    re.compile(r"\bfor\s*((?:[a-zA-Z_][a-zA-Z0-9_]*|,\s*)+)\s*in\b.*?\bdo\b", re.S)),
+		("local_function",  re.compile(r"\blocal\s+function\s+([a-zA-Z_][a-zA-Z0-9_]*)\s*\(((?:[a-zA-Z_][a-zA-Z0-9_]*|\.\.\.|,\s*)*)\)")),
+		("function",        re.compile(r"\bfunction(?:\s+[a-zA-Z0-9._]*)?\(((?:[a-zA-Z_][a-zA-Z0-9_]*|\.\.\.|,\s*)*)\)")),
+		("method",          re.compile(r"\bfunction\s+[a-zA-Z0-9._]+:[a-zA-Z0-9_]+\(((?:[a-zA-Z_][a-zA-Z0-9_]*|\.\.\.|,\s*)*)\)")),
+		("block_start",     re.compile(r"\b(?:do|then|repeat)\b")), # Matches while loops, incomplete for loops, and `do ... end` blocks
+		("block_end",       re.compile(r"\b(?:end|until)\b")),
+		("locals",          re.compile(r"\blocal\s+((?:[a-zA-Z_][a-zA-Z0-9_]*|,\s*)+)\b")),
+		("longcomment",     re.compile(r"\-\-\[(=*)\[")),
+		("comment",         re.compile(r"\-\-")),
+		("string",          re.compile(r"""(?:"|')""")),
+		("longstring",      re.compile(r"\[(=*)\[")),
+	])
+	
+	token_re, token_offsets = combine_patterns(patterns, "fldtreu-\"'[")
+	
+	# Number of tokens handled between checks of the time budget
+	budget_check_interval = 256
+	
+	def __init__(self, code, time_budget=None):
+		"""
+		Creates a new parser. time_budget is the number of seconds a single run may take, or None for no limit.
+		"""
+		self.code = code
+		self.time_budget = time_budget
+		
+		# Whether the last run stopped at the time budget before reaching the cursor
+		self.partial = False
+	
+	def run(self, cursor):
+		"""
+		Runs the parser. cursor is the location of the scope.
+		"""
+		return self.run_from(0, [{}], cursor)
+	
+	def run_from(self, start_pos, scope_stack, cursor):
+		"""
+		Runs the parser starting at start_pos with an existing scope stack.
+		"""
+		self.scope_stack = scope_stack
+		self.partial = False
+		
+		deadline = None
+		if self.time_budget is not None:
+			deadline = time.perf_counter() + self.time_budget
+		
+		try:
+			current_pos = start_pos
+			tokens = 0
+			while True:
+				name, match = self.next_match(current_pos)
+				if not match:
+					break
+				
+				if match.start() >= cursor:
+					break
+				
+				current_pos = self.dispatch(name, match)
+				self.advance(current_pos)
+				
+				tokens += 1
+				if deadline is not None and tokens % self.budget_check_interval == 0 and time.perf_counter() > deadline:
+					# Out of time: return the variables in scope at this point instead of at the cursor
+					self.partial = True
+					break
+		except StopParsing:
+			pass
+		
+		curscope = self.scope_stack[-1]
+		del self.scope_stack
+		return curscope
+	
+	def advance(self, pos):
+		"""
+		Called after each handled token with the position the scan continues from.
+		"""
+		pass
+	
+	def next_match(self, pos):
+		"""
+		Finds the first token at or after pos. Returns the pattern name and the match.
+		"""
+		match = self.token_re.search(self.code, pos)
+		if not match:
+			return None, None
+		
+		name = match.lastgroup
+		return name, TokenMatch(match, self.token_offsets[name])
+	
+	def dispatch(self, name, match):
+		logger.debug("Matched %s at char %s", name, match.start())
+		return getattr(self, "handle_"+name)(match)
+	
+	def push_scope(self, is_function=False):
+		if not is_function:
+			self.scope_stack.append(self.scope_stack[-1].copy())
+		else:
+			self.scope_stack.append(dict.fromkeys(self.scope_stack[-1], UPVALUE))
+	
+	def pop_scope(self):
+		if len(self.scope_stack) == 1:
+			logging.debug("Scope stack underflow; probably an excess `end`")
+			# TODO: Can we handle excessive ends better?
+		else:
+			self.scope_stack.pop()
+	
+	def add_var(self, name, **kwargs):
+		self.scope_stack[-1][name] = VarInfo(**kwargs)
+	
+	def add_vars(self, vars, **kwargs):
+		info = VarInfo(**kwargs)
+		for name in vars:
+			self.scope_stack[-1][name] = info
+	
+	#########################################################################
+	
+	def handle_for_incremental(self, match):
+		self.push_scope()
+		
+		self.add_var(match.group(1), vartype="for index")
+		return match.end()
+	
+	def handle_for_iterator(self, match):
+		self.push_scope()
+		
+		the_locals = localvar_re.findall(match.group(1))
+		self.add_vars(the_locals, vartype="for index")
+		return match.end()
+	
+	def handle_local_function(self, match):
+		self.add_var(match.group(1), vartype="local")
+		
+		self.push_scope(is_function=True)
+		arguments = localvar_re.findall(match.group(2))
+		self.add_vars(arguments, vartype="parameter")
+		return match.end()
+	
+	def handle_function(self, match):
+		self.push_scope(is_function=True)
+		arguments = localvar_re.findall(match.group(1))
+		self.add_vars(arguments, vartype="parameter")
+		return match.end()
+	
+	def handle_method(self, match):
+		self.push_scope(is_function=True)
+		arguments = localvar_re.findall(match.group(1))
+		self.add_var("self", vartype="self")
+		self.add_vars(arguments, vartype="parameter")
+		return match.end()
+	
+	def handle_block_start(self, match):
+		self.push_scope()
+		return match.end()
+	
+	def handle_block_end(self, match):
+		self.pop_scope()
+		return match.end()
+	
+	def handle_locals(self, match):
+		the_locals = localvar_re.findall(match.group(1))
+		self.add_vars(the_locals, vartype="local")
+		return match.end()
+	
+	def handle_comment(self, match):
+		line_end = self.code.find("\n", match.end())
+		if line_end == -1:
+			raise StopParsing() # EOF
+		return line_end+1
+	
+	def handle_longcomment(self, match):
+		end_str = "]" + match.group(1) + "]" # Match number of equals signs
+		comment_end = self.code.find(end_str, match.end())
+		if comment_end == -1:
+			raise StopParsing() # EOF
+		return comment_end+len(end_str)
+	
+	def handle_string(self, match):
+		str_char = match.group(0) # single or double quotes?
+		str_end = match.end()
+		
+		while self.code[str_end] != str_char or self.code[str_end-1] == "\\": # Keep looking for unescaped terminator
+			str_end = self.code.find(str_char, str_end+1)
+			if str_end == -1:
+				raise StopParsing() # EOF
+		
+		return str_end+1
+	
+	def handle_longstring(self, match):
+		end_str = "]" + match.group(1) + "]" # Match number of equals signs
+		str_end = self.code.find(end_str, match.end())
+		if str_end == -1:
+			raise StopParsing() # EOF
+		return str_end+len(end_str)
+
+class MultiPatternLocalsFinder(RegexLocalsFinder):
+	"""
+	The previous scanning engine, which searches each pattern separately and caches its last match.
+	Kept as a reference to verify that the combined regex gives identical results.
+	"""
+	
+	def run_from(self, start_pos, scope_stack, cursor):
+		self.matches = OrderedDict()
+		self.setup_initial_matches(start_pos)
+		try:
+			return super(MultiPatternLocalsFinder, self).run_from(start_pos, scope_stack, cursor)
+		finally:
+			del self.matches
+	
+	def setup_initial_matches(self, pos=0):
+		for name, regex in self.patterns.items():
+			self.matches[name] = regex.search(self.code, pos)
+	
+	def next_match(self, pos):
+		return self.rematch(pos)
+	
+	def rematch(self, pos):
+		best_name, best_match = None, None
+		
+		for name, regex in self.patterns.items():
+			match = self.matches[name]
+			
+			if not match:
+				# Previous try didn't find anything. Trying now won't find anything either.
+				continue
+			
+			# If the new position is less than the first match, the regex doesn't need to be re-ran.
+			if pos > match.start():
+				match = regex.search(self.code, pos)
+				self.matches[name] = match
+			
+			# Find first match
+			if match and (not best_match or match.start() < best_match.start()):
+				best_name = name
+				best_match = match
+		return best_name, best_match
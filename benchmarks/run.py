@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+# 基准测试集：在sublime之外测量插件各个主要路径的耗时，输出json格式的结果，并与阈值比较。
+# 任何一项的中位数超过 阈值 * scale 时返回1。
+#   python benchmarks/run.py [--files 500] [--output results.json] [--scale 2] [--only locals]
+import os
+import io
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import common
+import stubs
+common.setup_package()
+
+import sublime
+from LuaAutocomplete import indexer, lexer, sqlite_index
+from LuaAutocomplete.locals import LocalsFinder, IncrementalLocalsFinder
+from LuaAutocomplete.LuaAutocomplete import RequireAutocomplete, LocalsAutocomplete, LuaBackgroundReparse
+
+THRESHOLDS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "thresholds.json")
+
+# 所有测试共用的数据：生成的工程、索引好的ProjectIndexer和一个较大的lua文件
+class Context(object):
+	def __init__(self, num_files, modules_per_buffer):
+		self.root = tempfile.mkdtemp(prefix = "lua-autocomplete-suite-")
+		common.generate_project(self.root, num_files)
+
+		self.proj_indexer = indexer.ProjectIndexer(self.root)
+		self.proj_indexer.generate_indices()
+
+		# 除了专门测试时间限制的用例，都测量完整解析的耗时
+		self.proj_indexer.parse_limits.time_budget_ms = 0
+		indexer.PROJECT_DATAS[self.root] = self.proj_indexer
+
+		self.window = stubs.Window([self.root])
+		stubs.set_active_window(sublime, self.window)
+
+		# 多个生成的模块拼成一个大文件
+		rnd = random.Random(1)
+		previous = [("pkg%d" % (i % 32), "mod%d" % i) for i in range(num_files)]
+		self.buffer = "".join(common.generate_module(rnd, previous, "Big%d" % i) for i in range(modules_per_buffer))
+
+		# 工程中最后一个文件，它有最深的继承链
+		last = num_files - 1
+		self.module_file = os.path.join(self.root, "scripts", "pkg%d" % (last % 32), "mod%d.lua" % last)
+		with open(self.module_file, "r", encoding = "utf-8") as f:
+			self.module_content = f.read()
+
+		# 模块的基类，是第一个require进来的模块
+		self.base_name = re.match(r"local (\w+) = require", self.module_content).group(1)
+
+	def close(self):
+		indexer.PROJECT_DATAS.pop(self.root, None)
+		shutil.rmtree(self.root)
+
+	def new_project_indexer(self, cls = indexer.ProjectIndexer):
+		proj_indexer = cls(self.root)
+		proj_indexer.watch_files = False
+		return proj_indexer
+
+	# 在模块文件的指定内容之后插入text，返回停在插入内容末尾的view
+	def make_view(self, anchor, text):
+		text = text % {"base" : self.base_name}
+		pos = self.module_content.index(anchor) + len(anchor)
+		content = self.module_content[:pos] + text + self.module_content[pos:]
+		view = stubs.View(content, self.module_file, self.window)
+		return view, pos + len(text)
+
+def bench_locals_run(ctx):
+	code = ctx.buffer
+	return lambda: LocalsFinder(code).run(len(code))
+
+# 多个光标在一次扫描中完成，耗时与扫描到最后一个光标相同
+def bench_locals_run_many(ctx):
+	code = ctx.buffer
+	cursors = [len(code) * (i + 1) // 16 for i in range(16)]
+	return lambda: LocalsFinder(code).run_many(cursors)
+
+def bench_locals_incremental(ctx):
+	code = ctx.buffer
+	finder = IncrementalLocalsFinder()
+	finder.update(code)
+	finder.run(len(code))
+
+	# 每次在文件末尾附近输入一个字符
+	state = {"count" : 0}
+	def run():
+		state["count"] += 1
+		edited = code[:-10] + "x" * (state["count"] % 2) + code[-10:]
+		finder.update(edited)
+		finder.run(len(edited) - 10)
+	return run
+
+# 按内容共享的匹配结果会让重复的解析直接返回，除了专门测试共享的用例，每次都先清空
+def bench_parse_content(ctx):
+	def run():
+		indexer.PARSE_CACHE.records.clear()
+		file_indexer = indexer.FileIndexer(ctx.proj_indexer, "bench.big")
+		file_indexer.parse_content(ctx.buffer)
+	return run
+
+# 有时间限制时，一次请求只解析一部分，耗时不会随文件大小增长
+def bench_parse_content_budget(ctx):
+	def run():
+		ctx.proj_indexer.parse_limits.time_budget_ms = 50
+		indexer.PARSE_CACHE.records.clear()
+		try:
+			file_indexer = indexer.FileIndexer(ctx.proj_indexer, "bench.big")
+			file_indexer.parse_content(ctx.buffer)
+		finally:
+			ctx.proj_indexer.parse_limits.time_budget_ms = 0
+	return run
+
+def bench_locals_budget(ctx):
+	code = ctx.buffer
+	return lambda: LocalsFinder(code, 0.05).run(len(code))
+
+def bench_update_content(ctx):
+	file_indexer = indexer.FileIndexer(ctx.proj_indexer, "bench.big")
+	file_indexer.parse_content(ctx.buffer)
+
+	# 每次修改文件中间的一行
+	middle = ctx.buffer.index("\n", len(ctx.buffer) // 2)
+	state = {"count" : 0}
+	def run():
+		state["count"] += 1
+		content = ctx.buffer[:middle] + "\nlocal edited = %d" % state["count"] + ctx.buffer[middle:]
+		file_indexer.update_content(content)
+	return run
+
+# 另一个buffer已经解析过相同的内容
+def bench_parse_content_shared(ctx):
+	indexer.FileIndexer(ctx.proj_indexer, "bench.big").parse_content(ctx.buffer)
+	def run():
+		file_indexer = indexer.FileIndexer(ctx.proj_indexer, "bench.big")
+		file_indexer.parse_content(ctx.buffer)
+	return run
+
+def bench_lex(ctx):
+	return lambda: lexer.TokenStream(ctx.buffer).lex_all()
+
+# 同一个buffer的第一次补全：FileIndexer和LocalsFinder共用一个token流，只分析一次
+def bench_shared_stream(ctx):
+	def run():
+		indexer.PARSE_CACHE.records.clear()
+		stream = lexer.TokenStream(ctx.buffer)
+		file_indexer = indexer.FileIndexer(ctx.proj_indexer, "bench.big")
+		file_indexer.parse_content(ctx.buffer, stream)
+		IncrementalLocalsFinder(stream = stream).run(len(ctx.buffer))
+	return run
+
+def bench_generate_indices_cold(ctx):
+	def run():
+		proj_indexer = ctx.new_project_indexer()
+		proj_indexer.use_cache = False
+		proj_indexer.generate_indices()
+	return run
+
+# 工程自己的缓存是空的，但是其他工程已经解析过相同的文件
+def bench_generate_indices_shared(ctx):
+	def run():
+		proj_indexer = ctx.new_project_indexer()
+		proj_indexer.load_cache = lambda: {}
+		proj_indexer.save_cache = lambda: None
+		proj_indexer.generate_indices()
+	return run
+
+# 同上，内存中的结果已经被清除（例如另一个进程中的工程），从磁盘加载
+def bench_generate_indices_shared_disk(ctx):
+	def run():
+		indexer.PARSE_CACHE.entries.clear()
+		bench_generate_indices_shared(ctx)()
+	return run
+
+def bench_generate_indices_warm(ctx):
+	ctx.new_project_indexer().generate_indices()
+	return lambda: ctx.new_project_indexer().generate_indices()
+
+# 懒索引：只收集文件，并索引模块文件require的闭包。不使用任何缓存
+def bench_generate_indices_lazy(ctx):
+	requires = indexer.find_requires(ctx.module_content)
+	def run():
+		proj_indexer = ctx.new_project_indexer()
+		proj_indexer.use_cache = False
+		proj_indexer.lazy_index = True
+		proj_indexer.generate_indices(requires)
+	return run
+
+# 懒索引的工程中第一次补全self.，按需索引类和所有基类所在的模块（从按内容共享的解析结果中读取）
+def bench_completion_lazy(ctx):
+	view, location = ctx.make_view("\n\tlocal value = 0\n", "\tself.")
+	content = view.substr(sublime.Region(0, view.size()))
+	def run():
+		proj_indexer = ctx.new_project_indexer()
+		proj_indexer.lazy_index = True
+		proj_indexer.generate_indices()
+
+		file_indexer = indexer.FileIndexer(proj_indexer, proj_indexer.match_file_indexer_name(ctx.module_file), location)
+		file_indexer.file_path = ctx.module_file
+		file_indexer.parse_content(content)
+		if not file_indexer.index_value("self"):
+			raise RuntimeError("no completions from the lazy index")
+	return run
+
+# SQLite存储：数据库是空的，解析结果来自按内容共享的PARSE_CACHE，主要是写入数据库的耗时
+def bench_generate_indices_sqlite(ctx):
+	db_file = ctx.new_project_indexer(sqlite_index.SqliteProjectIndexer).db_file
+	def run():
+		for suffix in ("", "-wal", "-shm"):
+			if os.path.exists(db_file + suffix):
+				os.remove(db_file + suffix)
+		ctx.new_project_indexer(sqlite_index.SqliteProjectIndexer).generate_indices()
+	return run
+
+# SQLite存储：再次加载工程，只检查文件的修改时间
+def bench_generate_indices_sqlite_warm(ctx):
+	ctx.new_project_indexer(sqlite_index.SqliteProjectIndexer).generate_indices()
+	return lambda: ctx.new_project_indexer(sqlite_index.SqliteProjectIndexer).generate_indices()
+
+# SQLite存储：内存中没有热数据时补全self.，类和所有基类都从数据库中读取
+def bench_completion_sqlite(ctx):
+	proj_indexer = ctx.new_project_indexer(sqlite_index.SqliteProjectIndexer)
+	proj_indexer.generate_indices()
+
+	view, location = ctx.make_view("\n\tlocal value = 0\n", "\tself.")
+	file_indexer = indexer.FileIndexer(proj_indexer, proj_indexer.match_file_indexer_name(ctx.module_file), location)
+	file_indexer.file_path = ctx.module_file
+	file_indexer.parse_content(view.substr(sublime.Region(0, view.size())))
+	def run():
+		proj_indexer.hot_tables.clear()
+		proj_indexer.hot_classes.clear()
+		proj_indexer.class_members.clear()
+		proj_indexer.completion_cache.clear()
+		if not file_indexer.index_value("self"):
+			raise RuntimeError("no completions from the sqlite index")
+	return run
+
+def bench_index_value(anchor, text, prefix, cold = False):
+	def setup(ctx):
+		view, location = ctx.make_view(anchor, text + prefix)
+		content = view.substr(sublime.Region(0, view.size()))
+		indexer.index_module(view, location, content, prefix)
+
+		def run():
+			if cold:
+				ctx.proj_indexer.completion_cache.clear()
+				ctx.proj_indexer.class_members.clear()
+			return indexer.index_module(view, location, content, prefix)
+		return run
+	return setup
+
+# 在大文件的末尾输入一个字符之后补全局部变量。inline在请求中解析最新的内容，
+# background使用输入之前后台解析好的结果（后台的解析在这之前完成，不计入耗时）
+def bench_completion_big_buffer(background):
+	def setup(ctx):
+		content = ctx.buffer + "\nlocal x = "
+		view = stubs.View(content, os.path.join(ctx.root, "scripts", "big_buffer.lua"), ctx.window)
+		listener = LocalsAutocomplete()
+		LuaBackgroundReparse.reparse(view, lambda: False)
+
+		limits = ctx.proj_indexer.parse_limits
+		state = {"count" : 0}
+		def run():
+			state["count"] += 1
+			view.set_content(content + "m" * (state["count"] % 2 + 1))
+
+			old_size = limits.inline_parse_size
+			limits.inline_parse_size = 0 if background else len(content) * 2
+			try:
+				if not listener.on_query_completions(view, "m", [view.size()]):
+					raise RuntimeError("no completions")
+			finally:
+				limits.inline_parse_size = old_size
+		return run
+	return setup
+
+def bench_require(ctx):
+	listener = RequireAutocomplete()
+	view = stubs.View('local m = require("pkg3.', os.path.join(ctx.root, "scripts", "bench.lua"), ctx.window)
+	ctx.window.project_file = os.path.join(ctx.root, "bench.sublime-project")
+	return lambda: listener.on_query_completions(view, "", [view.size()])
+
+# 符号搜索：前缀、子串和模糊匹配各一次，名字索引只在第一次搜索时生成
+def bench_search_symbols(ctx):
+	ctx.proj_indexer.search_symbols("")
+	def run():
+		for query in ("helper_mod1", "od12", "hlpmd99", "zzzq"):
+			ctx.proj_indexer.search_symbols(query)
+	return run
+
+def bench_search_symbols_sqlite(ctx):
+	proj_indexer = ctx.new_project_indexer(sqlite_index.SqliteProjectIndexer)
+	proj_indexer.generate_indices()
+	def run():
+		for query in ("helper_mod1", "od12", "hlpmd99", "zzzq"):
+			proj_indexer.search_symbols(query)
+	return run
+
+# (名字, 生成测试函数, 重复次数)
+CASES = [
+	("locals.run", bench_locals_run, 5),
+	("locals.run_many", bench_locals_run_many, 5),
+	("locals.incremental", bench_locals_incremental, 50),
+	("locals.budget", bench_locals_budget, 5),
+	("file_indexer.parse_content", bench_parse_content, 5),
+	("file_indexer.parse_content.budget", bench_parse_content_budget, 5),
+	("file_indexer.parse_content.shared", bench_parse_content_shared, 5),
+	("file_indexer.update_content", bench_update_content, 50),
+	("lexer.lex_all", bench_lex, 5),
+	("lexer.shared_stream", bench_shared_stream, 5),
+	("project.generate_indices.cold", bench_generate_indices_cold, 3),
+	("project.generate_indices.warm", bench_generate_indices_warm, 3),
+	("project.generate_indices.shared", bench_generate_indices_shared, 3),
+	("project.generate_indices.shared_disk", bench_generate_indices_shared_disk, 3),
+	("project.generate_indices.lazy", bench_generate_indices_lazy, 3),
+	("completion.self", bench_index_value("\n\tlocal value = 0\n", "\tself.", ""), 200),
+	("completion.self_prefix", bench_index_value("\n\tlocal value = 0\n", "\tself.", "me"), 200),
+	("completion.self_cold", bench_index_value("\n\tlocal value = 0\n", "\tself.", "", cold = True), 50),
+	("completion.module", bench_index_value("\n\tlocal value = 0\n", "\tlocal x = %(base)s.", ""), 200),
+	("completion.require", bench_require, 200),
+	("completion.self_lazy", bench_completion_lazy, 5),
+	("completion.big_buffer.inline", bench_completion_big_buffer(False), 20),
+	("completion.big_buffer.background", bench_completion_big_buffer(True), 20),
+	("project.search_symbols", bench_search_symbols, 50),
+	("project.generate_indices.sqlite", bench_generate_indices_sqlite, 3),
+	("project.generate_indices.sqlite_warm", bench_generate_indices_sqlite_warm, 3),
+	("completion.self_sqlite", bench_completion_sqlite, 50),
+	("project.search_symbols.sqlite", bench_search_symbols_sqlite, 20),
+]
+
+def measure(run, repeat):
+	samples = []
+	for i in range(repeat):
+		start = time.perf_counter()
+		run()
+		samples.append((time.perf_counter() - start) * 1000.0)
+
+	samples.sort()
+	return {
+		"repeat" : repeat,
+		"min_ms" : samples[0],
+		"median_ms" : samples[len(samples) // 2],
+		"max_ms" : samples[-1],
+	}
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--files", type = int, default = 500, help = "number of files in the generated project")
+	parser.add_argument("--buffer-modules", type = int, default = 100, help = "number of generated modules in the large buffer")
+	parser.add_argument("--output", help = "write the json results to this file instead of stdout")
+	parser.add_argument("--thresholds", default = THRESHOLDS_FILE)
+	parser.add_argument("--scale", type = float, default = 1.0, help = "multiply all thresholds, for slower machines")
+	parser.add_argument("--only", help = "run only the cases whose name starts with this prefix")
+	parser.add_argument("--verbose", action = "store_true", help = "show the plugin's own output")
+	args = parser.parse_args()
+
+	thresholds = {}
+	if args.thresholds and os.path.exists(args.thresholds):
+		with open(args.thresholds, "r") as f:
+			thresholds = json.load(f)
+
+	# 插件会打印日志，不能和json结果混在一起
+	plugin_output = sys.stderr if args.verbose else io.StringIO()
+
+	results = []
+	failed = 0
+	with contextlib.redirect_stdout(plugin_output):
+		ctx = Context(args.files, args.buffer_modules)
+		try:
+			for name, setup, repeat in CASES:
+				if args.only and not name.startswith(args.only): continue
+
+				result = measure(setup(ctx), repeat)
+				result["name"] = name
+
+				threshold = thresholds.get(name)
+				if threshold is not None:
+					result["threshold_ms"] = threshold * args.scale
+					result["ok"] = result["median_ms"] <= result["threshold_ms"]
+					if not result["ok"]:
+						failed += 1
+
+				results.append(result)
+				sys.stderr.write("%-36s median %9.3fms  min %9.3fms  %s\n" % (name, result["median_ms"], result["min_ms"],
+					"" if threshold is None else ("ok" if result["ok"] else "REGRESSION")))
+		finally:
+			ctx.close()
+
+	report = {
+		"python" : platform.python_version(),
+		"platform" : platform.platform(),
+		"files" : args.files,
+		"buffer_chars" : len(ctx.buffer),
+		"results" : results,
+		"failed" : failed,
+	}
+
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(report, f, indent = 4)
+	else:
+		json.dump(report, sys.stdout, indent = 4)
+		sys.stdout.write("\n")
+
+	return 1 if failed else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
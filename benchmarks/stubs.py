@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# sublime和sublime_plugin模块的替身，只实现插件用到的接口，用于在编辑器之外运行插件代码。
+import types
+import tempfile
+
+LUA_SYNTAX = "Packages/Lua/Lua.sublime-syntax"
+
+class Region(object):
+	def __init__(self, a, b = None):
+		self.a = a
+		self.b = a if b is None else b
+
+	def begin(self):
+		return min(self.a, self.b)
+
+	def end(self):
+		return max(self.a, self.b)
+
+class Settings(object):
+	def __init__(self, values = None):
+		self.values = dict(values or {})
+
+	def get(self, key, default = None):
+		return self.values.get(key, default)
+
+	def set(self, key, value):
+		self.values[key] = value
+
+class Window(object):
+	next_id = 1
+
+	def __init__(self, folders = (), project_file_name = None):
+		self.window_id = Window.next_id
+		Window.next_id += 1
+
+		self.project_file = project_file_name
+		self.data = {"folders" : [{"path" : path} for path in folders]}
+		self.status = None
+
+	def id(self):
+		return self.window_id
+
+	def project_file_name(self):
+		return self.project_file
+
+	def project_data(self):
+		return self.data
+
+	def folders(self):
+		return [folder["path"] for folder in self.data["folders"]]
+
+	def status_message(self, message):
+		self.status = message
+
+class View(object):
+	next_id = 1
+
+	def __init__(self, content = "", file_name = None, window = None, syntax = LUA_SYNTAX):
+		self.view_id = View.next_id
+		View.next_id += 1
+
+		self.content = content
+		self.path = file_name
+		self.parent = window
+		self.changes = 0
+		self.view_settings = Settings({"syntax" : syntax})
+
+	def id(self):
+		return self.view_id
+
+	def file_name(self):
+		return self.path
+
+	def window(self):
+		return self.parent
+
+	def settings(self):
+		return self.view_settings
+
+	def change_count(self):
+		return self.changes
+
+	def is_valid(self):
+		return True
+
+	# 只有一个光标，在文件末尾
+	def sel(self):
+		return [Region(len(self.content))]
+
+	def size(self):
+		return len(self.content)
+
+	# 替换全部内容，相当于一次编辑
+	def set_content(self, content):
+		self.content = content
+		self.changes += 1
+
+	def substr(self, x):
+		if isinstance(x, Region):
+			return self.content[x.begin():x.end()]
+		return self.content[x:x + 1]
+
+	def line(self, x):
+		point = x.begin() if isinstance(x, Region) else x
+		begin = self.content.rfind("\n", 0, point) + 1
+		end = self.content.find("\n", point)
+		if end < 0: end = len(self.content)
+		return Region(begin, end)
+
+	def scope_name(self, point):
+		return "source.lua "
+
+	# 只支持向前查找单词的开始位置。指定了separators时，空白和separators之外的字符都算作单词的一部分
+	def find_by_class(self, point, forward, classes, separators = ""):
+		if forward:
+			raise NotImplementedError("find_by_class only supports searching backward")
+
+		pos = point
+		while pos > 0:
+			c = self.content[pos - 1]
+			if separators:
+				if c.isspace() or c in separators: break
+			elif not (c.isalnum() or c == "_"):
+				break
+			pos -= 1
+		return pos
+
+def make_sublime_module():
+	module = types.ModuleType("sublime")
+	module.CLASS_WORD_START = 1
+	module.INHIBIT_WORD_COMPLETIONS = 8
+	module.INHIBIT_EXPLICIT_COMPLETIONS = 16
+	module.DYNAMIC_COMPLETIONS = 32
+	module.Region = Region
+
+	cache_path = tempfile.mkdtemp(prefix = "lua-autocomplete-bench-")
+	module.cache_path = lambda: cache_path
+	module.status_message = lambda message: None
+
+	# 当前窗口。由set_active_window设置
+	module.windows = [Window()]
+	module.active_window = lambda: module.windows[0]
+	return module
+
+def set_active_window(module, window):
+	module.windows[0] = window
+
+def make_sublime_plugin_module():
+	module = types.ModuleType("sublime_plugin")
+
+	class EventListener(object):
+		pass
+
+	class WindowCommand(object):
+		def __init__(self, window):
+			self.window = window
+
+	class TextCommand(object):
+		def __init__(self, view):
+			self.view = view
+
+	module.EventListener = EventListener
+	module.WindowCommand = WindowCommand
+	module.TextCommand = TextCommand
+	return module
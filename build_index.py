@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# 命令行工具：在sublime之外生成工程的预生成索引文件。
+# 可以在CI中为大型工程生成一次，编辑器加载之后，内容没有变化的文件不需要在本地重新解析。
+#   python build_index.py PROJECT_PATH [-o OUTPUT] [--config CONFIG] [--workers N] [--rebuild]
+import os
+import sys
+import time
+import types
+import argparse
+
+DEFAULT_OUTPUT = ".luacomplete-index.json"
+
+def setup_package():
+	""" 直接运行这个脚本时，把所在的目录注册成LuaAutocomplete包 """
+	if "LuaAutocomplete" in sys.modules:
+		return
+
+	package = types.ModuleType("LuaAutocomplete")
+	package.__path__ = [os.path.dirname(os.path.abspath(__file__))]
+	sys.modules["LuaAutocomplete"] = package
+
+def report_progress(count, total):
+	if count % 1000 == 0 or count == total:
+		print("parsed %d/%d files" % (count, total))
+
+def main(argv = None):
+	from LuaAutocomplete import indexer
+
+	parser = argparse.ArgumentParser(description = "Build a prebuilt Lua completion index for a project.")
+	parser.add_argument("project", help = "project root directory")
+	parser.add_argument("-o", "--output", help = "output file. Defaults to PREBUILT_INDEX in the config, or %s in the project root" % DEFAULT_OUTPUT)
+	parser.add_argument("--config", help = "config file. Defaults to .luacomplete.py in the project root")
+	parser.add_argument("--workers", type = int, help = "number of parser processes, 0 for all cores. Overrides INDEX_WORKERS")
+	parser.add_argument("--rebuild", action = "store_true", help = "parse every file instead of reusing unchanged entries from the existing prebuilt index")
+	args = parser.parse_args(argv)
+
+	project_path = os.path.abspath(args.project)
+	config_file = args.config or os.path.join(project_path, ".luacomplete.py")
+	if not os.path.exists(config_file):
+		print("config file not found: %s" % config_file, file = sys.stderr)
+		return 1
+
+	proj_indexer = indexer.ProjectIndexer(project_path, os.path.abspath(config_file))
+	if not proj_indexer.lua_paths:
+		print("no existing directory in LUA_PATHS", file = sys.stderr)
+		return 1
+
+	proj_indexer.use_cache = False
+	proj_indexer.watch_files = False
+	# 预生成的索引要包含所有文件，不能只索引用到的模块
+	proj_indexer.lazy_index = False
+	proj_indexer.index_workers = args.workers if args.workers is not None else proj_indexer.config_module.get("INDEX_WORKERS", 1)
+
+	output = args.output or proj_indexer.prebuilt_index or os.path.join(project_path, DEFAULT_OUTPUT)
+	if args.rebuild:
+		proj_indexer.prebuilt_index = None
+
+	start = time.time()
+	proj_indexer.generate_indices(progress = report_progress)
+	if not proj_indexer.save_prebuilt_index(os.path.abspath(output)):
+		return 1
+
+	print("indexed %d files in %.1fs: %s" % (len(proj_indexer.file_entries), time.time() - start, output))
+	return 0
+
+if __name__ == "__main__":
+	setup_package()
+	sys.exit(main())
@@ -1,8 +1,25 @@
 # -*- coding: utf-8 -*-
-import sublime
 import os
 import re
 import json
+import hashlib
+import tempfile
+import bisect
+import functools
+import itertools
+import threading
+import multiprocessing
+from sys import intern
+from array import array
+from collections import OrderedDict, namedtuple
+from LuaAutocomplete.watcher import ChangeDetector
+from LuaAutocomplete import metrics, lexer
+
+# 在sublime之外（命令行、测试）也可以使用索引功能，只有编辑器相关的函数需要sublime模块
+try:
+	import sublime
+except ImportError:
+	sublime = None
 
 var_pattern = re.compile(r"^(\w+)\s*=")
 fun_pattern = re.compile(r"^function\s*(\w+)\s*\(([\w\s,]*)\)")
@@ -27,30 +44,125 @@ BUILTIN_MODULES = {
 
 PROJECT_DATAS = {}
 
-def index_module(view, location, content):
+# 每个buffer缓存的FileIndexer。view id或文档uri : (change_count, FileIndexer)
+VIEW_INDEXERS = {}
+
+# 每个窗口的工程路径。window id : (工程文件名, 工程数据, ProjectPaths)
+# 不在每次补全时比较工程数据，由插件在窗口获得焦点和工程事件时调用refresh_window_project_paths
+WINDOW_PROJECT_PATHS = {}
+
+# 索引缓存文件的版本号。缓存格式有变化时需要增加版本号，旧的缓存会被丢弃。
+CACHE_VERSION = 3
+
+# 需要解析的文件数少于这个值时，不使用多进程解析
+PARALLEL_MIN_FILES = 64
+
+# 每个工程缓存的补全列表数量
+COMPLETION_CACHE_SIZE = 256
+
+# 每个工程缓存的合并了基类成员的类成员表数量
+CLASS_MEMBERS_CACHE_SIZE = 4096
+
+# 每次最多返回的补全数量。可以在配置文件中用MAX_COMPLETIONS修改
+MAX_COMPLETIONS = 300
+
+# 预生成索引文件的格式，与缓存文件的版本号一起检查
+PREBUILT_FORMAT = "prebuilt"
+
+# 按内容共享的解析结果：内存中保存的条目数，磁盘上保存的文件数，以及内存中保存的buffer匹配结果数
+PARSE_CACHE_SIZE = 20000
+PARSE_CACHE_FILES = 200000
+CONTENT_RECORDS_SIZE = 64
+
+# 比任何字符都大的字符，用于二分查找前缀的结束位置
+MAX_CHAR = "\U0010ffff"
+
+# 符号的类型
+KIND_VAR = 0
+KIND_FUNCTION = 1
+KIND_CLASS = 2
+KIND_NAMES = ("var", "function", "class")
+
+# 所有的符号对象。(类型, 参数) : Symbol
+SYMBOLS = {}
+
+# change_count是content对应的buffer版本，默认是view当前的版本
+def index_module(view, location, content, prefix = "", change_count = None):
 	# find whole word
 	pos = view.find_by_class(location, False, sublime.CLASS_WORD_START, " ")
 	if pos <= 0: return None
 
 	word = view.substr(sublime.Region(pos, location))
-	names = word.replace(':', '.').split('.')
-	if len(names) != 2: return None
-
-	first_name = names[0]
+	first_name = get_index_name(word)
+	if first_name is None: return None
 
 	if first_name in BUILTIN_MODULES:
 		return index_builtin(first_name)
 
 	file_path = view.file_name()
-	proj_indexer = find_project_indexer(file_path)
+	with metrics.phase("find_project"):
+		proj_indexer = find_project_indexer(file_path, content)
 	if proj_indexer is None:
 		return
 
-	file_indexer = proj_indexer.parse_content(content, file_path)
+	with metrics.phase("update_file"):
+		file_indexer = get_view_file_indexer(view, proj_indexer, content, location, change_count)
 	if file_indexer is None:
 		return
 
-	return file_indexer.index_value(first_name)
+	with metrics.phase("index_value"):
+		return file_indexer.index_value(first_name, prefix)
+
+# 输入的单词是 xxx.yyy 或 xxx:yyy 时返回xxx，否则返回None
+def get_index_name(word):
+	names = word.replace(':', '.').split('.')
+	if len(names) != 2: return None
+	return names[0]
+
+def get_view_file_indexer(view, proj_indexer, content, location, change_count = None):
+	if change_count is None:
+		change_count = view.change_count()
+	return get_file_indexer(view.id(), change_count, view.file_name(), proj_indexer, content, location)
+
+# 获取buffer对应的FileIndexer。key是buffer的唯一标识（view id，或者语言服务器中的文档uri），
+# change_count是buffer的版本。没有修改时直接使用缓存，否则只重新解析修改过的行。
+def get_file_indexer(key, change_count, file_path, proj_indexer, content, location):
+	module_name = proj_indexer.match_file_indexer_name(file_path)
+	if module_name is None:
+		return None
+
+	# token流与LocalsFinder共用，同一个版本只分析一次
+	stream = lexer.get_view_stream(key, change_count, content, proj_indexer.parse_limits.max_line_length)
+
+	cached = VIEW_INDEXERS.get(key)
+	if cached is not None:
+		cached_count, file_indexer = cached
+		if file_indexer.proj_indexer is proj_indexer and file_indexer.module_name == module_name and file_indexer.stream is stream:
+			metrics.cache_access("view_indexer", cached_count == change_count)
+			# 先更新光标位置，内容有变化时只重新生成一次符号表
+			moved = file_indexer.set_location(location, False)
+			if cached_count != change_count:
+				applied = file_indexer.update_content(content)
+			else:
+				applied = file_indexer.resume()
+			if moved and not applied:
+				file_indexer.apply_records()
+
+			VIEW_INDEXERS[key] = (change_count, file_indexer)
+			return file_indexer
+
+	metrics.cache_access("view_indexer", False)
+	file_indexer = FileIndexer(proj_indexer, module_name, location)
+	file_indexer.file_path = file_path
+	file_indexer.parse_content(content, stream)
+	VIEW_INDEXERS[key] = (change_count, file_indexer)
+	return file_indexer
+
+def clear_view_file_indexer(view):
+	clear_file_indexer(view.id())
+
+def clear_file_indexer(key):
+	VIEW_INDEXERS.pop(key, None)
 
 
 def index_builtin(key):
@@ -73,20 +185,46 @@ def load_python_file(path):
 	return module
 
 def get_all_project_paths():
-	paths = []
+	return get_window_project_paths().paths
 
-	window = sublime.active_window()
+# 获取窗口的工程路径。结果按窗口缓存，只有工程数据变化时才重新计算。
+def get_window_project_paths(window = None):
+	if window is None:
+		window = sublime.active_window()
 
-	root_path = ""
 	project_file_name = window.project_file_name()
+	cached = WINDOW_PROJECT_PATHS.get(window.id())
+	if cached is not None and cached[0] == project_file_name:
+		return cached[2]
+
+	project_data = window.project_data()
+	project_paths = ProjectPaths(resolve_project_paths(project_file_name, project_data))
+	WINDOW_PROJECT_PATHS[window.id()] = (project_file_name, project_data, project_paths)
+	return project_paths
+
+# 窗口打开了其他工程，或者工程的目录有变化时，丢弃缓存的工程路径
+def refresh_window_project_paths(window):
+	cached = WINDOW_PROJECT_PATHS.get(window.id())
+	if cached is None:
+		return
+
+	if cached[0] != window.project_file_name() or cached[1] != window.project_data():
+		WINDOW_PROJECT_PATHS.pop(window.id(), None)
+
+def resolve_project_paths(project_file_name, project_data):
+	paths = []
+
+	root_path = ""
 	if project_file_name:
 		root_path = os.path.dirname(project_file_name)
 
-	for proj_data in window.project_data()["folders"]:
+	for proj_data in (project_data or {}).get("folders", ()):
 		proj_path = proj_data["path"]
 
+		# 绝对路径也要规范化，例如去掉末尾的分隔符，否则查找时匹配不到
 		if not is_abs_path(proj_path):
-			proj_path = os.path.normpath(os.path.join(root_path, proj_path))
+			proj_path = os.path.join(root_path, proj_path)
+		proj_path = os.path.normpath(proj_path)
 
 		if not os.path.exists(proj_path):
 			continue
@@ -95,57 +233,1149 @@ def get_all_project_paths():
 
 	return paths
 
-def generate_indices():
+# 工程路径列表，可以查找文件属于哪个工程。
+# 从文件所在的目录逐级向上查找，第一个命中的就是最长的匹配，嵌套的工程目录也能得到正确的结果。
+class ProjectPaths(object):
+	def __init__(self, paths):
+		self.paths = paths
+		self.lookup = dict((os.path.normcase(path), path) for path in paths)
+
+		# 文件路径 : 工程路径
+		self.file_cache = {}
+
+	def find(self, file_name):
+		if file_name in self.file_cache:
+			return self.file_cache[file_name]
+
+		project_path = None
+		path = os.path.normcase(os.path.dirname(file_name))
+		while True:
+			project_path = self.lookup.get(path)
+			if project_path is not None: break
+
+			parent = os.path.dirname(path)
+			if parent == path: break
+			path = parent
+
+		self.file_cache[file_name] = project_path
+		return project_path
+
+# 在后台重新生成所有工程的索引。生成过程中继续使用旧的索引，完成之后再替换。
+def generate_indices(on_finished = None):
 	print("generate lua project indices.")
 
+	def finished(proj_indexer):
+		old_indexer = PROJECT_DATAS.get(proj_indexer.project_path)
+		if old_indexer is not None:
+			old_indexer.stop_watching()
+
+		PROJECT_DATAS[proj_indexer.project_path] = proj_indexer
+		if on_finished is not None:
+			on_finished(proj_indexer)
+
 	paths = get_all_project_paths()
 	for project_path in paths:
-		proj_indexer = ProjectIndexer(project_path)
-		proj_indexer.generate_indices()
-
-		PROJECT_DATAS[project_path] = proj_indexer
+		proj_indexer = create_project_indexer(project_path)
+		proj_indexer.start_indexing(on_finished = finished)
 
-	print("finished in %d path" % len(paths))
+	print("start indexing %d path" % len(paths))
 	return
 
-def find_project_indexer(file_name):
-	for project_path in get_all_project_paths():
-		if file_name.startswith(project_path):
-			return get_or_load_project_indexer(project_path)
-	return None
+# 文件所在工程的索引。content是文件的内容，第一次加载工程时它require的模块会最先被索引
+def find_project_indexer(file_name, content = None):
+	if file_name is None:
+		return None
+
+	project_path = get_window_project_paths().find(file_name)
+	if project_path is None:
+		return None
+
+	# 只有第一次加载工程时才需要查找require
+	priority_modules = None
+	if content is not None and project_path not in PROJECT_DATAS:
+		priority_modules = find_requires(content)
+	return get_or_load_project_indexer(project_path, priority_modules)
 
-def get_or_load_project_indexer(project_path):
+# 获取工程的索引。第一次访问时在后台生成索引，不会阻塞调用者，索引完成前只能得到部分结果。
+def get_or_load_project_indexer(project_path, priority_modules = None):
 	proj_indexer = PROJECT_DATAS.get(project_path)
 	if proj_indexer is None:
 		print("create project indexer", project_path)
-		proj_indexer = ProjectIndexer(project_path)
-		proj_indexer.generate_indices()
+		proj_indexer = create_project_indexer(project_path)
 		PROJECT_DATAS[project_path] = proj_indexer
+		proj_indexer.start_indexing(priority_modules)
 
 	return proj_indexer
 
+# 创建工程的索引。配置中INDEX_STORAGE为sqlite时，符号保存在本地的数据库中，没有sqlite3模块时仍然使用内存中的索引
+def create_project_indexer(project_path):
+	config_file = os.path.join(project_path, ".luacomplete.py")
+	if not os.path.exists(config_file) or load_python_file(config_file).get("INDEX_STORAGE", "memory") != "sqlite":
+		return ProjectIndexer(project_path)
+
+	from LuaAutocomplete import sqlite_index
+	if sqlite_index.sqlite3 is None:
+		print("sqlite3 is not available, use the in-memory index for", project_path)
+		return ProjectIndexer(project_path)
+
+	return sqlite_index.SqliteProjectIndexer(project_path)
+
+# 打开或切换到文件时调用。懒索引的工程在后台索引文件require的模块，以及它们直接或间接require的模块。
+# 其他工程什么也不做，仍然在第一次补全时才开始生成索引
+def prefetch_requires(project_path, content):
+	proj_indexer = PROJECT_DATAS.get(project_path)
+	if proj_indexer is None:
+		config_file = os.path.join(project_path, ".luacomplete.py")
+		if not os.path.exists(config_file) or not load_python_file(config_file).get("LAZY_INDEX"):
+			return False
+
+		get_or_load_project_indexer(project_path, find_requires(content))
+		return True
+
+	return proj_indexer.prefetch_modules(find_requires(content))
+
+# 在所有工程中按名字搜索符号，返回SymbolLocation列表
+def search_symbols(query, limit = 100, project_paths = None):
+	if project_paths is None:
+		project_paths = get_all_project_paths()
+
+	ret = []
+	for project_path in project_paths:
+		proj_indexer = PROJECT_DATAS.get(project_path)
+		if proj_indexer is None: continue
+
+		ret.extend(proj_indexer.search_symbols(query, limit - len(ret)))
+		if len(ret) >= limit: break
+	return ret
+
+# 插件卸载时停止所有的后台监视
+def stop_all_watching():
+	for proj_indexer in PROJECT_DATAS.values():
+		proj_indexer.stop_watching()
+
+class LRUCache(object):
+	def __init__(self, capacity):
+		self.capacity = capacity
+		self.items = OrderedDict()
+
+	def get(self, key):
+		value = self.items.get(key)
+		if value is not None:
+			self.items.move_to_end(key)
+		return value
+
+	def put(self, key, value):
+		self.items[key] = value
+		self.items.move_to_end(key)
+		while len(self.items) > self.capacity:
+			self.items.popitem(last = False)
+
+	def clear(self):
+		self.items.clear()
+
+# 模块树的节点。children是子节点，files是定义了这个模块的文件（不同的LUA_PATHS下可能有同名的模块）
+class ModuleNode(object):
+	__slots__ = ("children", "files")
+
+	def __init__(self):
+		self.children = {}
+		self.files = set()
+
+	def add(self, module_name, file_path):
+		node = self
+		for name in module_name.split('.'):
+			child = node.children.get(name)
+			if child is None:
+				child = ModuleNode()
+				node.children[name] = child
+			node = child
+
+		node.files.add(file_path)
+
+	def remove(self, module_name, file_path):
+		path = [self]
+		for name in module_name.split('.'):
+			node = path[-1].children.get(name)
+			if node is None: return
+			path.append(node)
+
+		path[-1].files.discard(file_path)
+
+		# 删除空的节点
+		names = module_name.split('.')
+		for i in range(len(names), 0, -1):
+			node = path[i]
+			if node.files or node.children: break
+			del path[i - 1].children[names[i - 1]]
+
+	def find(self, names):
+		node = self
+		for name in names:
+			node = node.children.get(name)
+			if node is None: return None
+		return node
+
+	def get_completions(self):
+		ret = []
+		for name, node in sorted(self.children.items()):
+			if node.children:
+				ret.append((name + "\tsubdirectory", name))
+			if node.files:
+				ret.append((name + "\tmodule", name))
+		return ret
+
+# 符号表中的值。符号名是符号表的键，这里只保存类型和函数参数。
+# 类型和参数相同的符号共用同一个对象，由make_symbol创建。
+class Symbol(object):
+	__slots__ = ("kind", "args")
+
+	def __init__(self, kind, args = None):
+		self.kind = kind
+		self.args = args
+
+	def __eq__(self, other):
+		return isinstance(other, Symbol) and self.kind == other.kind and self.args == other.args
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	def __hash__(self):
+		return hash((self.kind, self.args))
+
+	# 从其他进程返回时，仍然使用共享的对象
+	def __reduce__(self):
+		return (make_symbol, (self.kind, self.args))
+
+	def __repr__(self):
+		return "Symbol(%s, %r)" % (KIND_NAMES[self.kind], self.args)
+
+	# 生成sublime需要的补全 (触发词, 内容)
+	def completion(self, name):
+		if self.kind == KIND_FUNCTION:
+			return (name + "\tfunction", "%s($0%s)" % (name, self.args))
+		return (name + "\t" + KIND_NAMES[self.kind], name)
+
+def make_symbol(kind, args = None):
+	key = (kind, args)
+	symbol = SYMBOLS.get(key)
+	if symbol is None:
+		if args is not None:
+			args = intern(args)
+		symbol = SYMBOLS.setdefault(key, Symbol(kind, args))
+	return symbol
+
+VAR_SYMBOL = make_symbol(KIND_VAR)
+CLASS_SYMBOL = make_symbol(KIND_CLASS)
+
+def symbol_completion(entry):
+	return entry[1].completion(entry[0])
+
+# 写入json时把符号转换成 [类型] 或 [类型, 参数]
+def encode_symbol(symbol):
+	if not isinstance(symbol, Symbol):
+		raise TypeError("%r is not JSON serializable" % (symbol, ))
+
+	if symbol.args is None:
+		return [symbol.kind]
+	return [symbol.kind, symbol.args]
+
+# 重新生成解析结果中的符号表，名字使用驻留的字符串，符号使用共享的对象。
+# 从缓存文件加载的结果，以及其他进程返回的结果都需要经过这一步。
+def intern_symbols(tables):
+	ret = {}
+	for path, table in tables.items():
+		symbols = {}
+		for name, symbol in table.items():
+			if not isinstance(symbol, Symbol):
+				symbol = make_symbol(*symbol)
+			symbols[intern(name)] = symbol
+
+		ret[intern(path)] = symbols
+	return ret
+
+# 按触发词排序的补全列表，支持前缀查找。结果按匹配程度分级：
+# 大小写一致的前缀 > 忽略大小写的前缀 > 驼峰缩写 > 子序列，后两种只在开启模糊匹配时使用。
+# 如果提供了make_completion，条目在返回之前才转换成补全，没有返回的条目不会生成字符串。
+class PrefixIndex(object):
+	def __init__(self, entries, make_completion = None):
+		self.entries = entries
+		self.keys = [x[0] for x in entries]
+		self.make_completion = make_completion
+
+		# 忽略大小写的索引 [(小写的触发词, 序号), ...]，第一次使用时生成
+		self.lower_keys = None
+
+	def __len__(self):
+		return len(self.entries)
+
+	def search(self, prefix, limit, fuzzy = False):
+		if not prefix:
+			return self.to_completions(self.entries[:limit])
+
+		ret = []
+		found = set()
+
+		lo = bisect.bisect_left(self.keys, prefix)
+		hi = bisect.bisect_left(self.keys, prefix + MAX_CHAR, lo)
+		for i in range(lo, min(hi, lo + limit)):
+			ret.append(self.entries[i])
+			found.add(i)
+
+		if len(ret) < limit:
+			if self.lower_keys is None:
+				self.lower_keys = sorted((key.lower(), i) for i, key in enumerate(self.keys))
+
+			lower_prefix = prefix.lower()
+			lo = bisect.bisect_left(self.lower_keys, (lower_prefix, ))
+			hi = bisect.bisect_left(self.lower_keys, (lower_prefix + MAX_CHAR, ), lo)
+			for key, i in self.lower_keys[lo:hi]:
+				if i in found: continue
+
+				ret.append(self.entries[i])
+				found.add(i)
+				if len(ret) >= limit: return self.to_completions(ret)
+
+		if fuzzy and len(ret) < limit:
+			lower_prefix = prefix.lower()
+			subsequences = []
+			for i, key in enumerate(self.keys):
+				if i in found: continue
+
+				name = key.split("\t", 1)[0]
+				if camel_humps(name).startswith(lower_prefix):
+					ret.append(self.entries[i])
+					if len(ret) >= limit: return self.to_completions(ret)
+				elif len(subsequences) < limit and is_subsequence(lower_prefix, name.lower()):
+					subsequences.append(self.entries[i])
+
+			ret.extend(subsequences[:limit - len(ret)])
+
+		return self.to_completions(ret)
+
+	def to_completions(self, entries):
+		if self.make_completion is None:
+			return entries
+		return [self.make_completion(entry) for entry in entries]
+
+# 解析结果中定义的所有名字：符号表中的名字，以及模块名的最后一部分
+def get_result_names(result):
+	if result is None:
+		return frozenset()
+
+	names = set()
+	for table in result["symbols"].values():
+		names.update(table)
+	names.add(intern(result["module"].rpartition(".")[2]))
+	return names
+
+# 按名字查找到的符号定义。kind是var、function、class或module；container是符号所在的模块或类的全名，
+# 与module相同时是模块中的全局符号；line从0开始
+SymbolLocation = namedtuple("SymbolLocation", ("name", "kind", "module", "container", "file_path", "line"))
+
+# 符号名的搜索索引。所有名字按小写排序之后拼接成一个字符串，查找子串和子序列都由str.find和正则完成，
+# 不需要在python中逐个比较名字，几十万个名字也只需要几毫秒。
+class NameSearch(object):
+	def __init__(self, names):
+		self.names = sorted(names, key = lambda x: (x.lower(), x))
+		self.text = "\n".join(self.names).lower() + "\n"
+
+		# 每个名字在text中开始的位置，最后一个是text的长度
+		self.starts = array("l", itertools.accumulate(itertools.chain((0, ), (len(name) + 1 for name in self.names))))
+
+	def __len__(self):
+		return len(self.names)
+
+	# 返回匹配的名字列表
+	def search(self, query, limit, fuzzy = True):
+		return list(itertools.islice(self.matches(query, fuzzy), limit))
+
+	# 按匹配程度依次生成名字，调用者只取需要的个数，不需要的部分不会查找
+	def matches(self, query, fuzzy = True):
+		query = query.strip().lower()
+		if not query:
+			yield from self.names
+			return
+		if "\n" in query:
+			return
+
+		text = self.text
+		starts = self.starts
+		found = set()
+
+		# 名字按小写排序，以query开始的名字是连续的一段，完全相同的名字排在最前面
+		if text.startswith(query):
+			pos = 0
+		else:
+			pos = text.find("\n" + query)
+			if pos >= 0: pos += 1
+
+		if pos >= 0:
+			i = self.index_at(pos)
+			while i < len(self.names) and text.startswith(query, starts[i]):
+				found.add(i)
+				yield self.names[i]
+				i += 1
+
+		# 包含query的名字
+		pos = 0
+		while True:
+			pos = text.find(query, pos)
+			if pos < 0: break
+
+			i = self.index_at(pos)
+			if i not in found:
+				found.add(i)
+				yield self.names[i]
+			pos = starts[i + 1]
+
+		# 依次包含query中每个字符的名字。从名字中第一个出现的query[0]开始匹配就能找到所有的结果，
+		# 正则以字面字符开始，可以快速跳过其他位置；[^c\n]*c 不会回溯，查找的时间与名字的总长度成正比
+		if fuzzy:
+			pattern = re.compile(re.escape(query[0]) + "".join("[^%s\n]*%s" % (re.escape(c), re.escape(c)) for c in query[1:]))
+			for match in pattern.finditer(text):
+				i = self.index_at(match.start())
+				if i not in found:
+					found.add(i)
+					yield self.names[i]
+
+	# text中pos所在的名字的序号
+	def index_at(self, pos):
+		return bisect.bisect_right(self.starts, pos) - 1
+
+# 驼峰或下划线分隔的单词首字母，例如 getPlayerName -> gpn, MAX_HP_VALUE -> mhv
+def camel_humps(name):
+	humps = []
+	prev = "_"
+	for c in name:
+		if c != "_" and (prev == "_" or (c.isupper() and not prev.isupper())):
+			humps.append(c)
+		prev = c
+	return "".join(humps).lower()
+
+def is_subsequence(query, text):
+	pos = 0
+	for c in query:
+		pos = text.find(c, pos) + 1
+		if pos == 0: return False
+	return True
+
+# 对补全列表做前缀过滤和排序
+def filter_completions(completions, prefix, limit = MAX_COMPLETIONS, fuzzy = False):
+	return PrefixIndex(sorted(completions, key = lambda x: x[0])).search(prefix, limit, fuzzy)
+
+# 补全数量达到上限时，需要sublime在继续输入时重新查询
+def completion_flags(completions, limit):
+	flags = getattr(sublime, "INHIBIT_WORD_COMPLETIONS", 8)
+	if len(completions) >= limit:
+		flags |= getattr(sublime, "DYNAMIC_COMPLETIONS", 0)
+	return flags
+
+# 缓存目录。在sublime之外使用 ~/.cache
+def get_cache_path():
+	if sublime is not None:
+		return sublime.cache_path()
+	return os.path.join(os.path.expanduser("~"), ".cache")
+
+# 分块计算文件内容的hash，内存占用与文件大小无关
+def hash_file(file_path):
+	sha1 = hashlib.sha1()
+	with open(file_path, "rb") as f:
+		while True:
+			data = f.read(1024 * 1024)
+			if not data: break
+			sha1.update(data)
+	return sha1.hexdigest()
+
+def read_json_file(file_path):
+	try:
+		with open(file_path, "r", encoding = "utf-8") as f:
+			return json.load(f)
+	except (OSError, ValueError) as e:
+		print("failed load json file", file_path, e)
+		return None
+
+# 先写入临时文件再替换，写入过程中中断不会留下不完整的文件。
+# 索引线程、插件和语言服务器可能同时写同一个文件，每次写入使用不同的临时文件
+def write_json_file(file_path, datas):
+	temp_file = None
+	try:
+		dir_path = os.path.dirname(file_path)
+		if dir_path and not os.path.isdir(dir_path):
+			os.makedirs(dir_path, exist_ok = True)
+
+		# json.dumps使用C实现的编码器，json.dump逐块写入时只能使用python实现的编码器
+		text = json.dumps(datas, default = encode_symbol)
+		fd, temp_file = tempfile.mkstemp(suffix = ".tmp", prefix = os.path.basename(file_path) + ".", dir = dir_path or None)
+		with open(fd, "w", encoding = "utf-8") as f:
+			f.write(text)
+		os.replace(temp_file, file_path)
+		return True
+	except OSError as e:
+		print("failed save json file", file_path, e)
+		if temp_file is not None and os.path.exists(temp_file):
+			os.remove(temp_file)
+		return False
+
+# 按文件内容共享的解析结果。同一台机器上所有的工程、窗口和语言服务器共用，内容相同的文件只解析一次，
+# 例如多个窗口打开的同一份引擎脚本，或者多个工程的LUA_PATHS中都有的第三方库。
+# 解析结果还与模块名和解析限制有关，它们也是key的一部分。内存中保存最近使用的条目，磁盘上每个条目一个文件。
+class ParseCache(object):
+	def __init__(self, cache_dir = None, capacity = PARSE_CACHE_SIZE, max_files = PARSE_CACHE_FILES):
+		# 为None时使用get_cache_path()下的目录。sublime的api在插件加载之后才能使用，所以第一次使用时才确定
+		self.cache_dir = cache_dir
+		self.max_files = max_files
+		self.entries = LRUCache(capacity)
+
+		# 打开的buffer每一行的匹配结果。内容的hash : 匹配结果
+		self.records = LRUCache(CONTENT_RECORDS_SIZE)
+
+		# 后台索引线程和主线程都会访问
+		self.lock = threading.Lock()
+		self.pruned = False
+
+	def get_cache_dir(self):
+		if self.cache_dir is None:
+			self.cache_dir = os.path.join(get_cache_path(), "LuaAutocomplete", "parse-v%d" % CACHE_VERSION)
+		return self.cache_dir
+
+	def make_key(self, file_hash, module_name, limits):
+		text = "%s\n%s\n%d\n%d\n%d" % (file_hash, module_name, limits.large_file_size, limits.shallow_lines, limits.max_line_length)
+		return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+	def get_entry_file(self, key):
+		return os.path.join(self.get_cache_dir(), key[:2], key + ".json")
+
+	# 返回key对应的解析结果，没有时返回None。结果是共享的，调用者需要复制之后再修改
+	def get(self, key, module_name):
+		with self.lock:
+			entry = self.entries.get(key)
+		if entry is not None:
+			metrics.cache_access("parse_cache.memory", True)
+			return entry
+		metrics.cache_access("parse_cache.memory", False)
+
+		entry_file = self.get_entry_file(key)
+		try:
+			with open(entry_file, "r", encoding = "utf-8") as f:
+				entry = json.load(f)
+		except (OSError, ValueError):
+			# 没有缓存，或者其他进程正在写入
+			entry = None
+
+		if not isinstance(entry, dict) or entry.get("module") != module_name:
+			metrics.cache_access("parse_cache.disk", False)
+			return None
+		metrics.cache_access("parse_cache.disk", True)
+
+		# 修改时间用于清理时判断最近是否用过
+		try:
+			os.utime(entry_file, None)
+		except OSError:
+			pass
+
+		entry["symbols"] = intern_symbols(entry["symbols"])
+		with self.lock:
+			self.entries.put(key, entry)
+		return entry
+
+	def put(self, key, entry):
+		entry = dict((name, value) for name, value in entry.items() if name != "mtime" and name != "size")
+		with self.lock:
+			self.entries.put(key, entry)
+
+		write_json_file(self.get_entry_file(key), entry)
+
+	# 打开的buffer的匹配结果，与模块名无关，只在内存中保存
+	def make_content_key(self, content, max_line_length):
+		return "%s-%d" % (hashlib.sha1(content.encode("utf-8")).hexdigest(), max_line_length)
+
+	def get_records(self, key):
+		with self.lock:
+			records = self.records.get(key)
+		metrics.cache_access("parse_cache.records", records is not None)
+		return records
+
+	def put_records(self, key, records):
+		with self.lock:
+			self.records.put(key, tuple(records))
+
+	# 磁盘上的文件超过max_files时，删除最久没有用过的文件
+	def prune(self):
+		if self.pruned:
+			return
+		self.pruned = True
+
+		files = []
+		for root, dirs, names in os.walk(self.get_cache_dir()):
+			for name in names:
+				file_path = os.path.join(root, name)
+				try:
+					files.append((os.stat(file_path).st_mtime, file_path))
+				except OSError:
+					pass
+
+		if len(files) <= self.max_files:
+			return
+
+		files.sort()
+		for mtime, file_path in files[:len(files) - self.max_files * 9 // 10]:
+			try:
+				os.remove(file_path)
+			except OSError:
+				pass
+
+PARSE_CACHE = ParseCache()
+
 def path_to_module_name(path):
 	return path.replace('\\', '.').replace('/', '.')
 
+def is_entry_valid(entry, file_path, module_name):
+	if entry is None or entry.get("module") != module_name:
+		return False
+
+	try:
+		stat = os.stat(file_path)
+	except OSError:
+		return False
+
+	return entry.get("mtime") == stat.st_mtime and entry.get("size") == stat.st_size
+
+# 解析单个文件，返回 (文件路径, 缓存条目)。可以在子进程中执行。
+# use_parse_cache为True时，内容相同的文件直接使用PARSE_CACHE中的结果，新的结果也会写入PARSE_CACHE
+def parse_file_worker(args, limits = None, use_parse_cache = False):
+	file_path, module_name = args
+	limits = limits or DEFAULT_PARSE_LIMITS
+	key = None
+	try:
+		stat = os.stat(file_path)
+
+		if use_parse_cache:
+			key = PARSE_CACHE.make_key(hash_file(file_path), module_name, limits)
+			entry = PARSE_CACHE.get(key, module_name)
+			if entry is not None:
+				entry = dict(entry)
+				entry["mtime"] = stat.st_mtime
+				entry["size"] = stat.st_size
+				entry["shared"] = True
+				return file_path, entry
+
+		file_indexer = FileIndexer(None, module_name)
+		file_indexer.read_file(file_path, limits = limits)
+
+		# 解析过程中文件被修改过，结果与hash不一定对应
+		if key is not None:
+			new_stat = os.stat(file_path)
+			if new_stat.st_mtime != stat.st_mtime or new_stat.st_size != stat.st_size:
+				key = None
+	except (OSError, UnicodeDecodeError) as e:
+		print("failed parse file", file_path, e)
+		return file_path, None
+
+	entry = file_indexer.get_result()
+	if file_indexer.shallow:
+		entry["shallow"] = True
+	if key is not None:
+		PARSE_CACHE.put(key, entry)
+
+	entry["mtime"] = stat.st_mtime
+	entry["size"] = stat.st_size
+	return file_path, entry
+
+# 逐行读取文件，返回 (行, 行的长度)，内存占用与文件大小无关。
+# 超过max_length的行（通常是压缩过的代码）只返回开头的部分，其余部分被跳过。
+def iter_lines(f, max_length):
+	while True:
+		line = f.readline(max_length)
+		if not line:
+			return
+
+		length = len(line)
+		if length == max_length and line[-1] != "\n":
+			while True:
+				rest = f.readline(max_length)
+				length += len(rest)
+				if not rest or rest[-1] == "\n": break
+
+		yield line, length
+
+# 使用进程池解析文件，按files的顺序返回 (文件路径, 缓存条目) 的迭代器。
+# 当前环境不支持fork时返回None，由调用者在当前进程中解析。
+def parse_files_parallel(files, workers, worker = parse_file_worker):
+	if not hasattr(multiprocessing, "get_context"):
+		return None
+
+	try:
+		context = multiprocessing.get_context("fork")
+	except ValueError:
+		return None
+
+	chunksize = max(1, min(64, len(files) // (workers * 8)))
+	return iter_pool_results(context.Pool(workers), files, chunksize, worker)
+
+def iter_pool_results(pool, files, chunksize, worker):
+	try:
+		for file_path, entry in pool.imap(worker, files, chunksize):
+			if entry is not None:
+				entry["symbols"] = intern_symbols(entry["symbols"])
+			yield file_path, entry
+	finally:
+		pool.terminate()
+
+# 按优先级排序文件列表，priority_modules中的模块排在最前面
+def sort_files_by_priority(files, priority_modules):
+	if not priority_modules:
+		return files
+
+	priority = {}
+	for i, module_name in enumerate(priority_modules):
+		priority.setdefault(module_name, i)
+
+	default = len(priority)
+	return sorted(files, key = lambda x: priority.get(x[1], default))
+
+# 当前文件require的模块
+def find_requires(content):
+	return [path for _, path in require_pattern.findall(content)]
+
+# 解析的限制，都可以在配置文件中修改
+class ParseLimits(object):
+	def __init__(self, config = None):
+		config = config or {}
+
+		# 超过这个大小（字节）的文件被认为是生成的数据文件，只索引前面的SHALLOW_INDEX_LINES行
+		self.large_file_size = config.get("LARGE_FILE_SIZE", 2 * 1024 * 1024)
+		self.shallow_lines = config.get("SHALLOW_INDEX_LINES", 2000)
+
+		# 超过这个长度的行（通常是压缩过的代码）只匹配开头的部分，有这样的行的文件也只做浅索引
+		self.max_line_length = config.get("MAX_LINE_LENGTH", 1000)
+
+		# 补全时解析当前文件和查找局部变量的时间限制（毫秒），超时返回部分结果，后续的请求继续解析。0表示不限制
+		self.time_budget_ms = config.get("TIME_BUDGET_MS", 50)
+
+		# 修改停止这么长时间（毫秒）之后，在后台重新解析正在编辑的buffer。0表示不在后台解析
+		self.background_delay_ms = config.get("BACKGROUND_PARSE_DELAY_MS", 100)
+
+		# 超过这个大小（字符数）的buffer，补全时不解析最新的内容，直接使用最近一次后台解析的结果（可能落后几次修改）
+		self.inline_parse_size = config.get("INLINE_PARSE_SIZE", 256 * 1024)
+
+	def get_deadline(self):
+		if not self.time_budget_ms:
+			return None
+		return metrics.now() + self.time_budget_ms / 1000.0
+
+DEFAULT_PARSE_LIMITS = ParseLimits()
+
+# 文件所在工程已经加载的索引，没有时返回None，不会触发加载
+def get_loaded_project_indexer(file_name, window = None):
+	if file_name is None or sublime is None:
+		return None
+
+	project_path = get_window_project_paths(window).find(file_name)
+	return PROJECT_DATAS.get(project_path)
+
+# 文件所在工程的解析限制。工程还没有加载时使用默认值
+def get_parse_limits(file_name, window = None):
+	proj_indexer = get_loaded_project_indexer(file_name, window)
+	if proj_indexer is None:
+		return DEFAULT_PARSE_LIMITS
+	return proj_indexer.parse_limits
+
 class ProjectIndexer(object):
-	def __init__(self, project_path):
+	def __init__(self, project_path, config_file = None):
 		self.project_path = project_path
 
 		self.symbols = {"_G" : [["_G", "_G"]] }
 		self.classes = {}
 
-		self.config_module = self.load_config_module()
+		# 每个文件的解析结果。文件路径 : 缓存条目
+		self.file_entries = {}
+
+		# 每个文件当前合并到索引中的结果（磁盘文件或者未保存的view）。文件路径 : 解析结果
+		self.file_results = {}
+
+		# 符号表和类由哪个文件定义。名字 : 文件路径
+		self.symbol_owners = {}
+		self.class_owners = {}
+
+		# 符号名的倒排索引，用于按名字查找定义。名字 : 定义了这个名字的文件路径（只有一个文件时）或文件路径列表
+		self.symbol_files = {}
+
+		# 按名字搜索的索引。符号名有增减时丢弃，下一次搜索时重新生成
+		self.name_search = None
+
+		# 反向依赖。基类 : 派生类集合，模块 : require它的模块集合
+		self.derived_classes = {}
+		self.module_dependents = {}
+
+		# 模块或类的版本号，内容变化时增加，用于判断依赖它的缓存是否失效。名字 : 版本号
+		self.generations = {}
+
+		# 合并了所有基类成员的类成员表。类名 : (版本号, 成员表)
+		self.class_members = LRUCache(CLASS_MEMBERS_CACHE_SIZE)
+
+		# 排好序的补全列表。(名字, 类型, 版本号) : 补全列表
+		self.completion_cache = LRUCache(COMPLETION_CACHE_SIZE)
+
+		self.config_module = self.load_config_module(config_file)
 		self.lua_paths = []
 
+		# 是否使用本地的索引缓存，以及按文件内容共享的解析结果（PARSE_CACHE）
+		self.use_cache = True
+
+		# 预生成的索引文件，通常由CI生成。本地缓存中没有的文件，如果内容相同就直接使用其中的结果
+		self.prebuilt_index = None
+
+		# 解析文件的进程数。1表示在当前进程中解析，0表示使用所有的cpu核心。
+		# 只由命令行工具（build_index.py）设置：编辑器和语言服务器的进程中有多个线程，fork出的子进程可能继承被占用的锁而死锁
+		self.index_workers = 1
+
+		# 索引完成之后是否监视文件变化。没有inotify时每隔watch_poll_interval秒扫描一次，
+		# 变化停止watch_debounce秒之后再更新索引
+		self.watch_files = True
+		self.watch_poll_interval = 10.0
+		self.watch_debounce = 1.0
+		self.change_detector = None
+
+		# 每次最多返回的补全数量，以及是否使用模糊匹配（驼峰缩写、子序列）
+		self.max_completions = MAX_COMPLETIONS
+		self.fuzzy_completions = False
+
+		# 大文件、生成的文件的解析限制，以及补全时的时间限制
+		self.parse_limits = ParseLimits()
+
+		# 所有lua模块组成的树，用于require补全
+		self.module_tree = ModuleNode()
+
+		# 后台索引线程。索引过程中，已经解析完的文件可以直接用于自动补全。
+		self.indexing_thread = None
+		self.lock = threading.RLock()
+
+		# 懒索引：生成索引时只收集文件，模块第一次通过require用到时才索引，打开的文件require的模块在后台预先索引。
+		# loaded_modules是已经索引过的模块，prefetch_pending是等待在后台索引的模块。
+		# 后台预取和补全线程可能同时索引同一个模块，load_lock保证每个模块只解析一次，解析时不占用self.lock
+		self.lazy_index = False
+		self.loaded_modules = set()
+		self.load_lock = threading.Lock()
+		# 懒索引时预生成的索引在开始时读取一次，模块第一次用到时先从中查找，找不到才解析
+		self.prebuilt_entries = {}
+		self.prefetch_pending = []
+		self.prefetch_thread = None
+
 		self.parse_config()
 
-	def generate_indices(self):
+	def is_indexing(self):
+		return self.indexing_thread is not None or self.prefetch_thread is not None
+
+	# 在后台线程中生成索引。priority_modules中的模块会最先被解析。
+	def start_indexing(self, priority_modules = None, on_finished = None):
+		if self.indexing_thread is not None:
+			return False
+
+		self.indexing_thread = threading.Thread(target = self.run_indexing, args = (priority_modules, on_finished))
+		self.indexing_thread.daemon = True
+		self.indexing_thread.start()
+		return True
+
+	def run_indexing(self, priority_modules, on_finished):
+		try:
+			self.generate_indices(priority_modules, self.report_progress)
+		finally:
+			self.indexing_thread = None
+
+		if self.watch_files:
+			self.start_watching()
+
+		if on_finished is not None:
+			on_finished(self)
+
+	# 监视LUA_PATHS下在编辑器之外发生的文件变化，增量更新索引
+	def start_watching(self):
+		if self.change_detector is not None:
+			return
+
+		with self.lock:
+			snapshot = self.get_file_snapshot()
+
+		self.change_detector = ChangeDetector(self.lua_paths, snapshot, self.apply_file_changes,
+			self.watch_poll_interval, self.watch_debounce)
+		self.change_detector.start()
+
+	# 已经索引的文件。文件路径 : (修改时间, 大小)
+	def get_file_snapshot(self):
+		return dict((file_path, (entry["mtime"], entry["size"])) for file_path, entry in self.file_entries.items())
+
+	def get_file_count(self):
+		return len(self.file_entries)
+
+	def stop_watching(self):
+		if self.change_detector is not None:
+			self.change_detector.stop()
+			self.change_detector = None
+
+	# 只重新索引发生变化的文件
+	def apply_file_changes(self, added, modified, deleted):
+		with metrics.phase("index.apply_file_changes"):
+			self.reindex_files(added, modified, deleted)
+
+	def reindex_files(self, added, modified, deleted):
+		print("lua files changed: %d added, %d modified, %d deleted" % (len(added), len(modified), len(deleted)))
+
+		for file_path in deleted:
+			self.remove_file(file_path)
+
+		files = []
+		for file_path in added + modified:
+			module_name = self.match_file_indexer_name(file_path)
+			if module_name is None: continue
+
+			# 懒索引只更新已经索引过的模块，其他文件只加入模块树（监视开始时没有索引的文件都会被当作新增的文件）
+			if self.lazy_index and module_name not in self.loaded_modules and file_path not in self.file_results:
+				with self.lock:
+					self.module_tree.add(module_name, file_path)
+				continue
+
+			files.append((file_path, module_name))
+
+		for file_path, entry in self.parse_files(files):
+			if entry is not None:
+				self.add_file_entry(file_path, entry)
+
+		if deleted or files:
+			self.save_cache()
+
+	def report_progress(self, count, total):
+		if sublime is None:
+			return
+
+		if count == total:
+			sublime.status_message("Lua index finished: %d files" % total)
+		elif count % 100 == 0:
+			sublime.status_message("Lua index: %d/%d files" % (count, total))
+
+	def generate_indices(self, priority_modules = None, progress = None):
+		if self.lazy_index:
+			return self.generate_lazy_indices(priority_modules)
+
+		start = metrics.now()
+		cache_entries = self.load_cache()
+
+		files = []
+		module_tree = ModuleNode()
 		for path in self.lua_paths:
-			self.gen_indices_in_path(path)
+			files.extend(self.collect_files(path, module_tree))
+
+		self.module_tree = module_tree
+
+		total = len(files)
+		count = 0
+
+		# 本地缓存中没有的文件，再从预生成的索引中查找
+		prebuilt_entries = None
+		prebuilt = 0
+
+		pending = []
+		for file_path, module_name in sort_files_by_priority(files, priority_modules):
+			entry = cache_entries.get(file_path)
+			if not is_entry_valid(entry, file_path, module_name):
+				if prebuilt_entries is None:
+					prebuilt_entries = self.load_prebuilt_index()
+
+				entry = self.find_prebuilt_entry(prebuilt_entries, file_path, module_name)
+				if entry is None:
+					pending.append((file_path, module_name))
+					continue
+
+				prebuilt += 1
+
+			entry["symbols"] = intern_symbols(entry["symbols"])
+			self.add_file_entry(file_path, entry)
+			count += 1
+
+		parse_start = metrics.now()
+		shallow = 0
+		shared = 0
+		for file_path, entry in self.parse_files(pending):
+			if entry is not None:
+				if entry.get("shared"):
+					shared += 1
+				self.add_file_entry(file_path, entry)
+				if entry.get("shallow"):
+					shallow += 1
+
+			count += 1
+			if progress is not None and count < total:
+				progress(count, total)
+
+		parse_elapsed = metrics.now() - parse_start
+
+		# 按照文件顺序重新设置一次，保证多个文件定义同一个名字时，结果与解析顺序无关。
+		# 索引过程中已经有补全请求时，换了所属文件的名字需要增加版本号，派生类的记录也要跟着基类更新
+		with self.lock:
+			file_entries = {}
+			changed = []
+			for file_path, module_name in files:
+				entry = self.file_entries.get(file_path)
+				if entry is not None:
+					file_entries[file_path] = entry
+
+				result = self.file_results.get(file_path)
+				if result is None: continue
+
+				for name, symbols in result["symbols"].items():
+					if self.symbol_owners.get(name) == file_path: continue
+
+					self.add_symbol(name, symbols)
+					self.symbol_owners[name] = file_path
+					changed.append(name)
+
+				for cname, bases in result["classes"].items():
+					if self.class_owners.get(cname) == file_path: continue
+
+					cls_info = self.get_or_add_class(cname)
+					for base in cls_info.get(".bases", ()):
+						derived = self.derived_classes.get(base)
+						if derived is not None:
+							derived.discard(cname)
+
+					cls_info[".bases"] = list(bases)
+					self.class_owners[cname] = file_path
+					changed.append(cname)
+
+					for base in bases:
+						self.derived_classes.setdefault(base, set()).add(cname)
+
+			self.file_entries = file_entries
+			self.invalidate(changed)
+
+		if progress is not None:
+			progress(total, total)
+
+		# 没有解析新的文件，也没有丢弃缓存中的条目时，缓存文件不需要重写
+		if pending or prebuilt or len(cache_entries) != total:
+			self.save_cache()
+		if self.use_cache:
+			PARSE_CACHE.prune()
+
+		metrics.record("index.generate_indices", (metrics.now() - start) * 1000.0)
+		metrics.increment("index.files_cached", total - len(pending) - prebuilt)
+		metrics.increment("index.files_prebuilt", prebuilt)
+		metrics.increment("index.files_shared", shared)
+		metrics.increment("index.files_parsed", len(pending) - shared)
+		metrics.increment("index.files_shallow", shallow)
+		if len(pending) > shared and parse_elapsed > 0:
+			metrics.set_gauge("index.files_parsed_per_second", (len(pending) - shared) / parse_elapsed)
 		return
 
-	def load_config_module(self):
-		config_file = os.path.join(self.project_path, ".luacomplete.py")
+	# 懒索引只收集文件生成模块树，然后索引priority_modules以及它们require的模块。
+	# 不使用工程的索引缓存（它记录的是整个工程），已经解析过的文件从按内容共享的PARSE_CACHE中读取
+	def generate_lazy_indices(self, priority_modules):
+		start = metrics.now()
+		self.prebuilt_entries = self.load_prebuilt_index()
+
+		module_tree = ModuleNode()
+		files = []
+		for path in self.lua_paths:
+			files.extend(self.collect_files(path, module_tree))
+
+		with self.lock:
+			# 收集文件的过程中已经按需索引的文件
+			for file_path, result in self.file_results.items():
+				module_tree.add(result["module"], file_path)
+			self.module_tree = module_tree
+
+		self.index_closure(priority_modules or ())
+
+		metrics.record("index.generate_indices", (metrics.now() - start) * 1000.0)
+		metrics.increment("index.files_lazy", len(files))
+		print("lazy index: %d files, %d modules loaded" % (len(files), len(self.loaded_modules)))
+
+	# 懒索引时，模块第一次用到时才索引
+	def ensure_module(self, module_name):
+		if not self.lazy_index or module_name in self.loaded_modules:
+			return
+
+		# 另一个线程正在索引这个模块时，等它完成之后直接返回
+		with self.load_lock:
+			if module_name in self.loaded_modules:
+				return
+
+			with self.lock:
+				node = self.module_tree.find(module_name.split('.'))
+				if node is None: return
+				files = sorted(x for x in node.files if x.endswith(".lua") and x not in self.file_results)
+
+			with metrics.phase("index.lazy_module"):
+				for file_path in files:
+					entry = self.find_prebuilt_entry(self.prebuilt_entries, file_path, module_name)
+					if entry is None:
+						self.index_file(file_path, module_name)
+						continue
+
+					entry["symbols"] = intern_symbols(entry["symbols"])
+					self.add_file_entry(file_path, entry)
+					metrics.increment("index.files_prebuilt")
+
+			self.loaded_modules.add(module_name)
+
+	# 模块中的文件require的模块
+	def get_module_requires(self, module_name):
+		ret = []
+		with self.lock:
+			node = self.module_tree.find(module_name.split('.'))
+			if node is None:
+				return ret
+
+			for file_path in node.files:
+				result = self.file_results.get(file_path)
+				if result is not None:
+					ret.extend(result["requires"].values())
+		return ret
+
+	# 索引modules以及它们直接或间接require的所有模块
+	def index_closure(self, module_names):
+		pending = list(module_names)
+		visited = set()
+		while pending:
+			module_name = pending.pop()
+			if module_name in visited: continue
+
+			visited.add(module_name)
+			self.ensure_module(module_name)
+			pending.extend(self.get_module_requires(module_name))
+
+	# 懒索引时在后台索引modules的require闭包。已经有预取线程时只加入它的队列
+	def prefetch_modules(self, module_names):
+		if not self.lazy_index or not module_names:
+			return False
+
+		with self.lock:
+			self.prefetch_pending.extend(module_names)
+			if self.prefetch_thread is None:
+				self.prefetch_thread = threading.Thread(target = self.run_prefetch)
+				self.prefetch_thread.daemon = True
+				self.prefetch_thread.start()
+		return True
+
+	def run_prefetch(self):
+		try:
+			while True:
+				with self.lock:
+					module_names = self.prefetch_pending
+					self.prefetch_pending = []
+					if not module_names:
+						self.prefetch_thread = None
+						return
+
+				with metrics.phase("index.prefetch"):
+					self.index_closure(module_names)
+		except Exception:
+			with self.lock:
+				self.prefetch_thread = None
+			raise
+
+	def load_config_module(self, config_file = None):
+		if config_file is None:
+			config_file = os.path.join(self.project_path, ".luacomplete.py")
 		if not os.path.exists(config_file):
 			return None
 
@@ -163,24 +1393,442 @@ class ProjectIndexer(object):
 
 			self.lua_paths.append(lua_path)
 
+		self.max_completions = self.config_module.get("MAX_COMPLETIONS", MAX_COMPLETIONS)
+		self.fuzzy_completions = self.config_module.get("FUZZY_COMPLETIONS", False)
+		self.watch_files = self.config_module.get("WATCH_FILES", True)
+		self.watch_poll_interval = self.config_module.get("WATCH_POLL_INTERVAL", 10.0)
+		self.watch_debounce = self.config_module.get("WATCH_DEBOUNCE", 1.0)
+		self.lazy_index = self.config_module.get("LAZY_INDEX", False)
+		self.parse_limits = ParseLimits(self.config_module)
+
+		if "SLOW_QUERY_MS" in self.config_module:
+			metrics.set_slow_query_threshold(self.config_module["SLOW_QUERY_MS"])
+
+		prebuilt_index = self.config_module.get("PREBUILT_INDEX")
+		if prebuilt_index:
+			self.prebuilt_index = os.path.normpath(os.path.join(self.project_path, prebuilt_index))
 		return
 
-	def gen_indices_in_path(self, path):
+	# 返回路径下所有的lua文件 [(文件路径, 模块名), ...]，按路径排序
+	# 如果提供了module_tree，.lua和.luac文件都会被加入到模块树中
+	def collect_files(self, path, module_tree = None):
 		print("parse lua:", path)
 
+		ret = []
 		for root, dirs, files in os.walk(path):
-			for fname in files:
+			dirs.sort()
+			for fname in sorted(files):
 				name, ext = os.path.splitext(fname)
-				if ext != ".lua": continue
+				if ext != ".lua" and ext != ".luac": continue
 
 				fpath = os.path.join(root, name)
 				fpath = os.path.relpath(fpath, path)
 				module_name = path_to_module_name(fpath)
 
-				indexer = FileIndexer(self, module_name)
-				indexer.parse_file(os.path.join(root, fname))
+				file_path = os.path.join(root, fname)
+				if module_tree is not None:
+					module_tree.add(module_name, file_path)
 
-		return
+				if ext == ".lua":
+					ret.append((file_path, module_name))
+
+		return ret
+
+	# 按顺序解析文件列表，返回 (文件路径, 缓存条目) 的迭代器
+	def parse_files(self, files):
+		worker = functools.partial(parse_file_worker, limits = self.parse_limits, use_parse_cache = self.use_cache)
+
+		workers = self.index_workers or multiprocessing.cpu_count()
+		if workers > 1 and len(files) >= PARALLEL_MIN_FILES:
+			results = parse_files_parallel(files, workers, worker)
+			if results is not None:
+				return results
+
+		return map(worker, files)
+
+	def index_file(self, file_path, module_name):
+		_, entry = parse_file_worker((file_path, module_name), self.parse_limits, self.use_cache)
+		if entry is None:
+			return None
+
+		self.add_file_entry(file_path, entry)
+		return entry
+
+	def add_file_entry(self, file_path, entry):
+		# 只用于统计，不写入缓存
+		entry.pop("shared", None)
+		with self.lock:
+			self.add_file_result(entry, file_path)
+			self.file_entries[file_path] = entry
+			self.module_tree.add(entry["module"], file_path)
+
+	# 合并一个文件的解析结果。同一个文件之前的结果会先被移除。
+	def add_file_result(self, result, file_path = None):
+		with self.lock:
+			if file_path is not None:
+				old_result = self.file_results.get(file_path)
+				if old_result is not None:
+					self.remove_file_result(old_result, file_path)
+
+				self.file_results[file_path] = result
+				self.update_symbol_files(file_path, old_result, result)
+
+			changed = []
+			for name, symbols in result["symbols"].items():
+				self.add_symbol(name, symbols)
+				self.symbol_owners[name] = file_path
+				changed.append(name)
+
+			for cname, bases in result["classes"].items():
+				cls_info = self.get_or_add_class(cname)
+				cls_info[".bases"] = list(bases)
+				self.class_owners[cname] = file_path
+				changed.append(cname)
+
+				for base in bases:
+					self.derived_classes.setdefault(base, set()).add(cname)
+
+			for path in result["requires"].values():
+				self.module_dependents.setdefault(path, set()).add(result["module"])
+
+			self.invalidate(changed)
+
+	# 移除一个文件的解析结果。只移除仍然属于这个文件的符号和类；
+	# 其他文件也定义了同一个名字时（例如不同LUA_PATHS中的同名模块），换成其他文件的定义
+	def remove_file_result(self, result, file_path):
+		changed = []
+		for name in result["symbols"].keys():
+			if self.symbol_owners.get(name) != file_path: continue
+
+			changed.append(name)
+			other = self.find_other_definer(name, "symbols", file_path)
+			if other is not None:
+				self.add_symbol(name, other[1]["symbols"][name])
+				self.symbol_owners[name] = other[0]
+				continue
+
+			del self.symbols[name]
+			del self.symbol_owners[name]
+
+		for cname in result["classes"].keys():
+			if self.class_owners.get(cname) != file_path: continue
+
+			cls_info = self.classes.pop(cname)
+			del self.class_owners[cname]
+			changed.append(cname)
+
+			for base in cls_info.get(".bases", ()):
+				derived = self.derived_classes.get(base)
+				if derived is not None:
+					derived.discard(cname)
+
+			other = self.find_other_definer(cname, "classes", file_path)
+			if other is not None:
+				bases = other[1]["classes"][cname]
+				self.get_or_add_class(cname)[".bases"] = list(bases)
+				self.class_owners[cname] = other[0]
+				for base in bases:
+					self.derived_classes.setdefault(base, set()).add(cname)
+
+		for path in result["requires"].values():
+			dependents = self.module_dependents.get(path)
+			if dependents is not None:
+				dependents.discard(result["module"])
+
+		self.invalidate(changed)
+
+	# 除了file_path之外，最后加入的定义了这个符号表或类的文件，返回 (文件路径, 解析结果)。
+	# 表名的最后一部分是模块名或者上一级表中的名字，symbol_files中记录了用到这个名字的文件
+	def find_other_definer(self, name, key, file_path):
+		files = self.symbol_files.get(name.rpartition(".")[2])
+		if files is None:
+			return None
+
+		if not isinstance(files, list):
+			files = [files]
+
+		for other_path in reversed(files):
+			if other_path == file_path: continue
+
+			result = self.file_results.get(other_path)
+			if result is not None and name in result[key]:
+				return other_path, result
+		return None
+
+	# 文件被删除时，移除它的索引
+	def remove_file(self, file_path):
+		with self.lock:
+			self.file_entries.pop(file_path, None)
+
+			result = self.file_results.pop(file_path, None)
+			if result is not None:
+				self.remove_file_result(result, file_path)
+				self.update_symbol_files(file_path, result, None)
+				module_name = result["module"]
+			else:
+				# 懒索引时没有用到过的模块只在模块树中
+				module_name = self.match_file_indexer_name(file_path)
+
+			if module_name is not None:
+				self.module_tree.remove(module_name, file_path)
+
+	# 更新符号名的倒排索引。编辑文件时名字的集合通常没有变化，只处理增加和删除的名字
+	def update_symbol_files(self, file_path, old_result, new_result):
+		old_names = get_result_names(old_result)
+		new_names = get_result_names(new_result)
+		symbol_files = self.symbol_files
+
+		for name in old_names - new_names:
+			files = symbol_files.get(name)
+			if files is None: continue
+
+			if isinstance(files, list):
+				files.remove(file_path)
+				if len(files) == 1:
+					symbol_files[name] = files[0]
+			else:
+				del symbol_files[name]
+				self.name_search = None
+
+		for name in new_names - old_names:
+			files = symbol_files.get(name)
+			if files is None:
+				symbol_files[name] = file_path
+				self.name_search = None
+			elif isinstance(files, list):
+				files.append(file_path)
+			else:
+				symbol_files[name] = [files, file_path]
+
+	# 按名字搜索符号，忽略大小写。结果按 完全相同 > 前缀 > 子串 > 子序列（fuzzy） 排序，返回SymbolLocation列表
+	def search_symbols(self, query, limit = 100, fuzzy = True):
+		with self.lock:
+			if self.name_search is None:
+				self.name_search = NameSearch(self.symbol_files.keys())
+
+			ret = []
+			for name in self.name_search.matches(query, fuzzy):
+				ret.extend(self.find_symbol_locations(name, limit - len(ret)))
+				if len(ret) >= limit: break
+			return ret
+
+	# 名字的定义，最多limit个。结果来自文件当前的解析结果，打开的文件使用编辑中的内容
+	def find_symbol_locations(self, name, limit = None):
+		files = self.symbol_files.get(name)
+		if files is None:
+			return []
+		if not isinstance(files, list):
+			files = (files, )
+
+		ret = []
+		for file_path in files:
+			if limit is not None and len(ret) >= limit: break
+
+			result = self.file_results.get(file_path)
+			if result is None: continue
+
+			module_name = result["module"]
+			if module_name.rpartition(".")[2] == name:
+				ret.append(SymbolLocation(name, "module", module_name, module_name, file_path, 0))
+
+			lines = result.get("lines", {})
+			for table_name, table in result["symbols"].items():
+				symbol = table.get(name)
+				if symbol is None: continue
+
+				line = lines.get(table_name, {}).get(name, 0)
+				ret.append(SymbolLocation(name, KIND_NAMES[symbol.kind], module_name, table_name, file_path, line))
+		return ret[:limit]
+
+	# require补全：返回模块路径names下的子目录和模块
+	def get_module_children(self, names):
+		node = self.module_tree.find(names)
+		if node is None:
+			return []
+
+		return node.get_completions()
+
+	# 增加名字的版本号。类的变化会影响所有的派生类，模块的变化会影响直接require它的模块。
+	def invalidate(self, names):
+		pending = list(names)
+		visited = set()
+		while pending:
+			name = pending.pop()
+			if name in visited: continue
+
+			visited.add(name)
+			self.generations[name] = self.generations.get(name, 0) + 1
+			pending.extend(self.get_derived_classes(name))
+
+			for dependent in self.get_module_dependents(name):
+				self.generations[dependent] = self.generations.get(dependent, 0) + 1
+
+	def get_generation(self, name):
+		return self.generations.get(name, 0)
+
+	def get_derived_classes(self, cname):
+		return self.derived_classes.get(cname, ())
+
+	def get_module_dependents(self, module_name):
+		return self.module_dependents.get(module_name, ())
+
+	# 类及其所有基类的成员。基类的成员表同样会被缓存，同名成员派生类优先。
+	# 任何一个基类变化时，派生类的版本号都会增加，缓存随之失效。
+	def get_class_members(self, cname, visiting = ()):
+		# 懒索引时，类所在的模块（以及通过递归，基类所在的模块）第一次用到时才索引
+		if self.lazy_index:
+			self.ensure_module(cname.rpartition('.')[0])
+
+		generation = self.get_generation(cname)
+		cached = self.class_members.get(cname)
+		metrics.cache_access("class_members", cached is not None and cached[0] == generation)
+		if cached is not None and cached[0] == generation:
+			return cached[1]
+
+		members = {}
+		visiting = set(visiting)
+		visiting.add(cname)
+
+		cls_info = self.get_class(cname)
+		if cls_info is not None:
+			for base in cls_info.get(".bases", ()):
+				if base in visiting: continue
+				members.update(self.get_class_members(base, visiting))
+
+		fields = self.get_symbol(cname)
+		if fields is not None:
+			members.update(fields)
+
+		self.class_members.put(cname, (generation, members))
+		return members
+
+	def get_class_completions(self, cname, functions_only = False, prefix = ""):
+		key = (cname, "functions" if functions_only else "class", self.get_generation(cname))
+		index = self.completion_cache.get(key)
+		metrics.cache_access("completion_cache", index is not None)
+		if index is None:
+			members = self.get_class_members(cname)
+			if functions_only:
+				members = dict((k, v) for k, v in members.items() if v.kind == KIND_FUNCTION)
+
+			index = PrefixIndex(sorted(members.items(), key = lambda x: x[0]), symbol_completion)
+			self.completion_cache.put(key, index)
+
+		return index.search(prefix, self.max_completions, self.fuzzy_completions)
+
+	def get_module_completions(self, name, prefix = ""):
+		symbols = self.get_symbol(name)
+		if symbols is None: return None
+
+		key = (name, "module", self.get_generation(name))
+		index = self.completion_cache.get(key)
+		metrics.cache_access("completion_cache", index is not None)
+		if index is None:
+			index = PrefixIndex(sorted(symbols.items(), key = lambda x: x[0]), symbol_completion)
+			self.completion_cache.put(key, index)
+
+		return index.search(prefix, self.max_completions, self.fuzzy_completions)
+
+	def get_cache_file(self):
+		name = hashlib.md5(self.project_path.encode("utf-8")).hexdigest()
+		return os.path.join(get_cache_path(), "LuaAutocomplete", name + ".json")
+
+	# 加载磁盘上的索引缓存。返回 文件路径 : 缓存条目
+	def load_cache(self):
+		if not self.use_cache:
+			return {}
+
+		cache_file = self.get_cache_file()
+		if not os.path.exists(cache_file):
+			return {}
+
+		datas = read_json_file(cache_file)
+		if datas is None:
+			return {}
+
+		if datas.get("version") != CACHE_VERSION or datas.get("project") != self.project_path:
+			return {}
+
+		return datas.get("files", {})
+
+	# 懒索引只索引了一部分文件，不写入工程的索引缓存，以免覆盖完整的缓存
+	def save_cache(self):
+		if not self.use_cache or self.lazy_index:
+			return
+
+		with self.lock:
+			datas = {
+				"version" : CACHE_VERSION,
+				"project" : self.project_path,
+				"files" : dict(self.file_entries),
+			}
+
+		write_json_file(self.get_cache_file(), datas)
+
+	# 加载预生成的索引。返回 文件路径 : 缓存条目，条目中记录的是文件内容的hash，而不是修改时间
+	def load_prebuilt_index(self):
+		if self.prebuilt_index is None or not os.path.exists(self.prebuilt_index):
+			return {}
+
+		datas = read_json_file(self.prebuilt_index)
+		if datas is None:
+			return {}
+
+		if datas.get("version") != CACHE_VERSION or datas.get("format") != PREBUILT_FORMAT:
+			print("ignore incompatible prebuilt index", self.prebuilt_index)
+			return {}
+
+		print("load prebuilt index:", self.prebuilt_index)
+
+		entries = {}
+		for relative_path, entry in datas.get("files", {}).items():
+			file_path = os.path.normpath(os.path.join(self.project_path, relative_path))
+			entries[file_path] = entry
+		return entries
+
+	# 在预生成的索引中查找文件。文件的大小和内容都相同时才使用，返回可以写入本地缓存的条目
+	def find_prebuilt_entry(self, prebuilt_entries, file_path, module_name):
+		entry = prebuilt_entries.get(file_path)
+		if entry is None or entry.get("module") != module_name:
+			return None
+
+		try:
+			stat = os.stat(file_path)
+			if entry.get("size") != stat.st_size or entry.get("hash") != hash_file(file_path):
+				return None
+		except OSError:
+			return None
+
+		entry = dict(entry)
+		del entry["hash"]
+		entry["mtime"] = stat.st_mtime
+		return entry
+
+	# 把当前的索引写成预生成的索引文件。文件路径相对于工程目录，在其他机器上也可以使用。
+	def save_prebuilt_index(self, output_file):
+		files = {}
+		with self.lock:
+			file_entries = dict(self.file_entries)
+
+		for file_path, entry in sorted(file_entries.items()):
+			try:
+				file_hash = hash_file(file_path)
+			except OSError:
+				continue
+
+			entry = dict(entry)
+			del entry["mtime"]
+			entry["hash"] = file_hash
+
+			relative_path = os.path.relpath(file_path, self.project_path).replace(os.sep, "/")
+			files[relative_path] = entry
+
+		datas = {
+			"version" : CACHE_VERSION,
+			"format" : PREBUILT_FORMAT,
+			"files" : files,
+		}
+		return write_json_file(output_file, datas)
 
 	def add_symbol(self, name, symbols):
 		self.symbols[name] = symbols
@@ -197,6 +1845,13 @@ class ProjectIndexer(object):
 	def is_class(self, name):
 		return name in self.classes
 
+	# write_debug_info写入的内容
+	def get_debug_info(self):
+		return {
+			"symbols" : self.symbols,
+			"classes" : self.classes,
+		}
+
 	def match_file_indexer_name(self, file_path):
 		for lua_path in self.lua_paths:
 			relative_path = os.path.relpath(file_path, lua_path)
@@ -212,91 +1867,346 @@ class ProjectIndexer(object):
 		if module_name is None:
 			return
 
-		file_indexer = FileIndexer(self, module_name)
-		file_indexer.parse_file(file_path)
-		return file_indexer
+		with metrics.phase("index.parse_file"):
+			return self.index_file(file_path, module_name)
 
-	def parse_content(self, content, file_path):
+	def parse_content(self, content, file_path, location = 0):
 		module_name = self.match_file_indexer_name(file_path)
 		if module_name is None:
 			return
 
-		file_indexer = FileIndexer(self, module_name)
+		file_indexer = FileIndexer(self, module_name, location)
+		file_indexer.file_path = file_path
 		file_indexer.parse_content(content)
 		return file_indexer
 
 
+# 超时之后还没有匹配的行
+UNMATCHED = False
+
+# 匹配一行代码，返回与上下文无关的匹配结果，没有匹配时返回None。
+# 结果由FileIndexer.apply_record根据当前文件的状态合并到符号表中。
+def match_line(line):
+	match = var_pattern.match(line)
+	if match:
+		return ("var", match.group(1))
+
+	match = fun_pattern.match(line)
+	if match:
+		return ("function", match.group(1), match.group(2))
+
+	match = require_pattern.search(line)
+	if match:
+		return ("require", match.group(1), match.group(2))
+
+	match = class_pattern.search(line)
+	if match:
+		return ("class", match.group(1), match.group(2))
+
+	match = interface_pattern.match(line)
+	if match:
+		return ("interface", match.group(1), match.group(2))
+
+	# self.xxx只有在类的方法之后才有效，是否使用由apply_record决定
+	cls_var = None
+	match = cls_var_pattern.search(line)
+	if match:
+		cls_var = match.group(1)
+
+	cls_fun = None
+	match = cls_fun_pattern.match(line)
+	if match:
+		cls_fun = match.groups()
+
+	if cls_var is None and cls_fun is None:
+		return None
+
+	return ("member", cls_var, cls_fun)
+
 class FileIndexer:
 	def __init__(self, proj_indexer, module_name, location = 0):
 		super(FileIndexer, self).__init__()
 		self.proj_indexer = proj_indexer
 
-		self.module_name = module_name
+		self.module_name = intern(module_name)
+
+		# 文件路径，用于记录符号属于哪个文件
+		self.file_path = None
 
 		# 当前文件所包含的其他模块。模块名 : 模块路径
 		self.requires = {}
 
-		# 当前文件中的符号表
+		# 当前文件中的符号表。符号名 : Symbol
 		self.symbols = {}
 
 		# 当前文件中的类
 		self.classes = {}
 
+		# 当前文件中类的基类。类全名 : 基类列表
+		self.bases = {}
+
+		# 符号定义所在的行（从0开始），用于按名字跳转。符号名 : 行号，类名 : {成员名 : 行号}
+		self.symbol_lines = {}
+		self.member_lines = {}
+
 		self.location = location
 		self.pos = 0
 
+		# 正在解析的行
+		self.line = 0
+
 		self.last_cname = None
 		self.self_cname = None
 
+		# parse_content之后使用的token流和每一行的匹配结果，用于增量更新。stream_version是已经处理过的token流版本
+		self.stream = None
+		self.stream_version = 0
+		self.records = None
+
+		# 超时之后还有没有匹配的行（记录为UNMATCHED），后续的请求会继续匹配
+		self.pending = False
+
+		# 文件太大或者有超长的行，只索引了一部分
+		self.shallow = False
+
+	def get_parse_limits(self):
+		if self.proj_indexer is None:
+			return DEFAULT_PARSE_LIMITS
+		return self.proj_indexer.parse_limits
+
 	def flush(self):
+		self.proj_indexer.add_file_result(self.get_result(), self.file_path)
+
+	# 当前文件的解析结果，可以直接写入索引缓存
+	def get_result(self):
+		for cname in self.classes.keys():
+			self.symbols[cname] = CLASS_SYMBOL
+
+		symbols = {self.module_name : self.symbols}
 		for cname, cls_info in self.classes.items():
-			self.symbols[cname + "\tclass"] = cname
+			symbols[intern(self.module_name + "." + cname)] = cls_info
+
+		# 与symbols的结构相同，记录每个符号的行号
+		lines = {self.module_name : self.symbol_lines}
+		for cname, member_lines in self.member_lines.items():
+			lines[intern(self.module_name + "." + cname)] = member_lines
+
+		return {
+			"module" : self.module_name,
+			"symbols" : symbols,
+			"classes" : self.bases,
+			"requires" : self.requires,
+			"lines" : lines,
+		}
 
-			cpath = self.module_name + "." + cname
-			self.proj_indexer.add_symbol(cpath, cls_info)
+	def parse_file(self, path, encoding = "utf-8"):
+		self.read_file(path, encoding)
+		self.flush()
 
-		self.proj_indexer.add_symbol(self.module_name, self.symbols)
+	# 流式读取文件。大文件只索引开头的部分，超长的行只匹配开头的部分
+	def read_file(self, path, encoding = "utf-8", limits = None):
+		limits = limits or self.get_parse_limits()
 
+		max_lines = None
+		if os.path.getsize(path) > limits.large_file_size:
+			max_lines = limits.shallow_lines
+			self.shallow = True
 
-	def parse_file(self, path, encoding = "utf-8"):
+		# 跨行的长字符串和长注释中的内容不能作为代码匹配
+		state = None
 		with open(path, "r", encoding = encoding) as f:
-			for line in f.readlines():
-				self.pos += len(line)
-				self.parse_line(line)
+			for line, length in iter_lines(f, limits.max_line_length):
+				self.pos += length
+				code, state = lexer.strip_code(line, state)
+				self.parse_line(code)
+
+				if length > len(line) and max_lines is None:
+					max_lines = limits.shallow_lines
+					self.shallow = True
+
+				if max_lines is not None:
+					max_lines -= 1
+					if max_lines <= 0: break
+
+	# 解析整个文件。stream是view共用的token流，没有时使用一个新的token流
+	def parse_content(self, content, stream = None):
+		if stream is None:
+			stream = lexer.TokenStream(max_line_length = self.get_parse_limits().max_line_length)
+		stream.update(content)
+
+		self.stream = stream
+		self.stream_version = stream.version
+		self.pending = True
+
+		# 其他buffer（例如另一个窗口中打开的同一个文件）已经匹配过相同的内容时，直接使用匹配结果。
+		# 计算hash不能中途停止，超大的内容不使用，以免超过补全的时间限制
+		limits = self.get_parse_limits()
+		content_key = None
+		records = None
+		if len(stream.content) <= limits.large_file_size:
+			content_key = PARSE_CACHE.make_content_key(stream.content, limits.max_line_length)
+			records = PARSE_CACHE.get_records(content_key)
+
+		if records is not None and len(records) == stream.line_count():
+			self.records = list(records)
+			self.pending = False
+		else:
+			self.records = [UNMATCHED] * stream.line_count()
+			self.match_pending(limits.get_deadline())
+			if not self.pending and content_key is not None:
+				PARSE_CACHE.put_records(content_key, self.records)
 
-		self.flush()
+		self.apply_records()
 
-	def parse_content(self, content):
-		for line in content.split('\n'):
-			self.pos += len(line) + 1
-			self.parse_line(line)
+		if self.pending:
+			metrics.increment("file_indexer.partial")
+		else:
+			self.flush()
+
+	# 继续匹配之前超时没有匹配的行。全部匹配完之后才把结果合并到工程中，避免用部分结果覆盖已有的索引
+	def resume(self, deadline = None):
+		if not self.pending:
+			return False
+
+		if deadline is None:
+			deadline = self.get_parse_limits().get_deadline()
+
+		self.match_pending(deadline)
+		self.apply_records()
+		if not self.pending:
+			self.flush()
+		return True
+
+	# 在deadline之前匹配尽量多的UNMATCHED行。token流按需要分析到正在匹配的行
+	def match_pending(self, deadline):
+		records = self.records
+		try:
+			start = records.index(UNMATCHED)
+		except ValueError:
+			self.pending = False
+			return
 
-		self.flush()
+		max_length = self.get_parse_limits().max_line_length
+		stream = self.stream
+		count = len(records)
+
+		i = start
+		while i < count:
+			end = min(count, i + 256)
+			stream.lex_until(end)
+			for j in range(i, end):
+				if records[j] is UNMATCHED:
+					records[j] = match_line(stream.code_line(j)[:max_length])
+			i = end
+
+			if deadline is not None and i < count and metrics.now() > deadline:
+				self.pending = UNMATCHED in records[i:]
+				if self.pending: return
+				break
+
+		self.pending = False
+
+	# 根据token流的修改记录，把变化过的行标记为UNMATCHED。返回是否有变化
+	def sync_stream(self):
+		stream = self.stream
+		changes = stream.changes_since(self.stream_version)
+		if changes is None:
+			self.records = [UNMATCHED] * stream.line_count()
+		elif not changes:
+			return False
+		else:
+			records = self.records
+			for version, first, old_end, new_end in changes:
+				records[first:old_end] = [UNMATCHED] * (new_end - first)
+
+		self.stream_version = stream.version
+		self.pending = True
+		return True
+
+	# 更新文件内容。只重新匹配token流中变化过的行，然后用缓存的匹配结果重新生成符号表。
+	# token流是view共用的时候，可能已经被其他使用者更新过，这里只处理修改记录
+	def update_content(self, content):
+		self.stream.update(content)
+		if not self.sync_stream():
+			return False
+
+		self.match_pending(self.get_parse_limits().get_deadline())
+		self.apply_records()
+
+		if self.pending:
+			metrics.increment("file_indexer.partial")
+		else:
+			self.flush()
+		return True
+
+	# 光标位置变化时，重新计算self所在的类。apply为False时由调用者负责重新生成符号表。返回位置是否变化
+	def set_location(self, location, apply = True):
+		if location == self.location:
+			return False
+
+		self.location = location
+		if apply:
+			self.apply_records()
+		return True
+
+	def apply_records(self):
+		self.requires = {}
+		self.symbols = {}
+		self.classes = {}
+		self.bases = {}
+		self.symbol_lines = {}
+		self.member_lines = {}
+		self.last_cname = None
+		self.self_cname = None
+
+		# 光标所在的行和列。第i行之前的内容都在光标之前，等价于逐行解析时的 pos < location
+		content = self.stream.content
+		location = min(self.location, len(content))
+		cursor_line = content.count('\n', 0, location)
+		cursor_column = location - content.rfind('\n', 0, location) - 1
+
+		last_before = cursor_line - 1 if cursor_column > 0 else cursor_line - 2
+		for i, record in enumerate(self.records):
+			if record:
+				self.line = i
+				self.apply_record(record, i <= last_before)
+
+		for cname in self.classes.keys():
+			self.symbols[cname] = CLASS_SYMBOL
+
+		self.pos = len(content) + 1
 
 	def parse_line(self, line):
-		match = var_pattern.match(line)
-		if match:
-			var = match.group(1)
-			self.symbols[var + "\tvar"] = var
+		self.apply_record(match_line(line), self.pos < self.location)
+		self.line += 1
+
+	# 根据一行的匹配结果更新当前文件的符号表。before_location表示这一行是否在光标之前。
+	def apply_record(self, record, before_location):
+		if record is None:
+			return
+
+		kind = record[0]
+		if kind == "var":
+			var = intern(record[1])
+			self.symbols[var] = VAR_SYMBOL
+			self.symbol_lines.setdefault(var, self.line)
 			return
 
-		match = fun_pattern.match(line)
-		if match:
-			var = match.group(1)
-			args = match.group(2)
-			self.symbols[var + "\tfunction"] = var + "($0%s)" % args
+		if kind == "function":
+			var, args = intern(record[1]), record[2]
+			self.symbols[var] = make_symbol(KIND_FUNCTION, args)
+			self.symbol_lines.setdefault(var, self.line)
 			return
 
-		match = require_pattern.search(line)
-		if match:
-			var, path = match.group(1), match.group(2)
+		if kind == "require":
+			var, path = record[1], record[2]
 			self.requires[var] = path
 			return
 
 		# parse class defination
-		match = class_pattern.search(line)
-		if match:
-			cname, base_name = match.group(1), match.group(2)
+		if kind == "class":
+			cname, base_name = record[1], record[2]
+			self.symbol_lines.setdefault(intern(cname), self.line)
 			cname = self.module_name + "." + cname
 
 			base_path = self.find_base_class_path(base_name)
@@ -304,14 +2214,12 @@ class FileIndexer:
 				print("Failed find base class '%s' for '%s'" % (base_name, cname))
 				return
 
-			cls_info = self.proj_indexer.get_or_add_class(cname)
-			cls_info[".bases"] = [base_path, ]
+			self.bases[cname] = [base_path, ]
 			return
 
 		# parse class implement interfaces
-		match = interface_pattern.match(line)
-		if match:
-			cname, args = match.group(1), match.group(2)
+		if kind == "interface":
+			cname, args = record[1], record[2]
 			cname = self.module_name + "." + cname
 
 			bases = []
@@ -326,25 +2234,25 @@ class FileIndexer:
 
 				bases.append(base_path)
 
-			cls_info = self.proj_indexer.get_or_add_class(cname)
-			cls_info.setdefault(".bases", []).extend(bases)
+			self.bases.setdefault(cname, []).extend(bases)
 			return
 
-		if self.last_cname is not None:
-			match = cls_var_pattern.search(line)
-			if match:
-				var = match.group(1)
-				cls_info = self.classes[self.last_cname]
-				cls_info[var + "\tvar"] = var
-				return
+		cls_var, cls_fun = record[1], record[2]
+		if self.last_cname is not None and cls_var is not None:
+			cls_var = intern(cls_var)
+			cls_info = self.classes[self.last_cname]
+			cls_info[cls_var] = VAR_SYMBOL
+			self.member_lines[self.last_cname].setdefault(cls_var, self.line)
+			return
 
-		match = cls_fun_pattern.match(line)
-		if match:
-			cname, var, args = match.group(1), match.group(2), match.group(3)
+		if cls_fun is not None:
+			cname, var, args = intern(cls_fun[0]), intern(cls_fun[1]), cls_fun[2]
 			cls_info = self.classes.setdefault(cname, {})
-			cls_info[var + "\tfunction"] = "%s($0%s)" % (var, args)
+			cls_info[var] = make_symbol(KIND_FUNCTION, args)
+			self.member_lines.setdefault(cname, {}).setdefault(var, self.line)
+			self.symbol_lines.setdefault(cname, self.line)
 			self.last_cname = cname
-			if self.pos < self.location:
+			if before_location:
 				self.self_cname = cname
 
 		return
@@ -365,111 +2273,66 @@ class FileIndexer:
 
 		return base_path
 
-	def index_value(self, key):
+	def index_value(self, key, prefix = ""):
+		limit = self.proj_indexer.max_completions
+
 		if key == "self":
-			ret = self.index_self()
-			if ret: return ret, sublime.INHIBIT_WORD_COMPLETIONS
+			ret = self.index_self(prefix)
+			if ret: return ret, completion_flags(ret, limit)
 			return None
 
-		ret = self.index_class(key)
-		if ret: return ret, sublime.INHIBIT_WORD_COMPLETIONS
+		ret = self.index_class(key, prefix)
+		if ret: return ret, completion_flags(ret, limit)
 
-		ret = self.index_module(key)
-		if ret: return ret, sublime.INHIBIT_WORD_COMPLETIONS
+		ret = self.index_module(key, prefix)
+		if ret: return ret, completion_flags(ret, limit)
 
 		return None
 
-	def index_self(self):
+	def index_self(self, prefix = ""):
 		#print("class name", self.self_cname)
 		if self.self_cname is None: return None
 
 		cname = self.module_name + "." + self.self_cname
+		return self.proj_indexer.get_class_completions(cname, prefix = prefix)
 
-		bases = set()
-		self.collect_bases(bases, cname)
-		#print("bases", sorted(bases))
-
-		values = {}
-		for base in bases:
-			fileds = self.proj_indexer.get_symbol(base)
-			if fileds is None: continue
-
-			values.update(fileds)
-
-		return self.to_sorted_values(values)
-
-	def index_class(self, key):
+	def index_class(self, key, prefix = ""):
 		cname = self.module_name + "." + key
-		ret = self.index_class_by_cname(cname)
+		ret = self.index_class_by_cname(cname, prefix)
 		if ret is not None: return ret
 
 		# wheather key is an external class
 		path = self.requires.get(key)
 		if path is None: return None
 
+		self.proj_indexer.ensure_module(path)
 		cname = path + "." + key
-		return self.index_class_by_cname(cname)
+		return self.index_class_by_cname(cname, prefix)
 
-	def index_class_by_cname(self, cname):
+	def index_class_by_cname(self, cname, prefix = ""):
 		#print("try class", cname)
 		if not self.proj_indexer.is_class(cname): return None
 
-		bases = set()
-		self.collect_bases(bases, cname)
-		#print("bases", sorted(bases))
-
-		values = {}
-		for base in bases:
-			fileds = self.proj_indexer.get_symbol(base)
-			if fileds is None: continue
-
-			for k, v in fileds.items():
-				if "\tfunction" in k:
-					values[k] = v
+		return self.proj_indexer.get_class_completions(cname, True, prefix)
 
-		return self.to_sorted_values(values)
-
-	def index_module(self, key):
+	def index_module(self, key, prefix = ""):
 		path = self.requires.get(key)
 		#print("module", path)
 		if path is None: return None
 
-		values = self.proj_indexer.get_symbol(path)
-		return self.to_sorted_values(values)
-
-	def to_sorted_values(self, symbols):
-		if symbols is None: return None
-
-		ret = list(symbols.items())
-		ret.sort(key = lambda x: x[0])
-		return ret
-
-
-	def collect_bases(self, bases, cpath):
-		bases.add(cpath)
-
-		cls_info = self.proj_indexer.get_class(cpath)
-		if cls_info is None: return
-
-		for base in cls_info.get(".bases", ()):
-			if base not in bases:
-				self.collect_bases(bases, base)
-
-		return
+		self.proj_indexer.ensure_module(path)
+		return self.proj_indexer.get_module_completions(path, prefix)
 
 
 def write_debug_info():
 	datas = {}
 
 	for path, indexer in PROJECT_DATAS.items():
-		datas[path] = {
-			"symbols" : indexer.symbols,
-			"classes" : indexer.classes,
-		}
+		datas[path] = indexer.get_debug_info()
 
-	temp_file = os.path.join(sublime.cache_path(), "lua-autocomplete-temp.json")
+	temp_file = os.path.join(get_cache_path(), "lua-autocomplete-temp.json")
 	with open(temp_file, "w") as f:
-		json.dump(datas, f, indent = 4, sort_keys = True)
+		json.dump(datas, f, indent = 4, sort_keys = True, default = encode_symbol)
 
 	print("write cache file", temp_file)
 
@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+# Lua词法分析。LocalsFinder和FileIndexer共用同一个按行保存的token流，每次修改只分析一次。
+# 每一行保存开始时的状态（是否在跨行的长字符串、长注释中），内容修改之后只重新分析修改过的行，
+# 以及开始状态因此发生变化的后续行。token流只在需要时才向后分析，可以在时间限制内分多次完成。
+#
+# 每一行的token只保存文本，类型由第一个字符决定，这样一行可以用一次正则扫描完成:
+#   字母、下划线: 名字和关键字    引号、[: 字符串    -: 注释    数字: 数字    其他: 符号
+# 只有少数情况需要token的位置（光标所在的行、有注释的行），这时再扫描一次这一行。
+import re
+import time
+from string import ascii_letters
+
+KEYWORDS = frozenset((
+	"and", "break", "do", "else", "elseif", "end", "false", "for", "function", "goto", "if", "in",
+	"local", "nil", "not", "or", "repeat", "return", "then", "true", "until", "while",
+))
+
+NAME_START = frozenset(ascii_letters + "_")
+
+# 以这些字符开始的token是字符串、注释或者数字
+LITERAL_START = frozenset("\"'[-0123456789")
+
+# 状态的类型: 行首在跨行的字符串或者注释中。状态是 (类型, 结束符)，短字符串的结束符是引号
+STRING = 0
+COMMENT = 1
+
+# 跨行的字符串、注释在下一行中的部分，只用于判断类型
+STRING_PIECE = '"'
+COMMENT_PIECE = "--"
+
+token_re = re.compile(r"""
+	[A-Za-z_][A-Za-z0-9_]*
+	|0[xX][0-9a-fA-F]*(?:\.[0-9a-fA-F]*)?(?:[pP][+-]?[0-9]+)?|(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?
+	|--\[(=*)\[(?:.*?(\]\1\])|.*)
+	|--.*
+	|\[(=*)\[(?:.*?(\]\3\])|.*)
+	|"(?:[^"\\\r\n]|\\[^\r\n])*(?:"|(\\))?
+	|'(?:[^'\\\r\n]|\\[^\r\n])*(?:'|(\\))?
+	|\.\.\.|\.\.|==|~=|<=|>=|::|[(),=:.;]
+""", re.X)
+
+# 没有长字符串、长注释和反斜杠的行（大部分的行）使用的正则，没有分组，可以直接用findall
+simple_token_re = re.compile(r"""
+	[A-Za-z_][A-Za-z0-9_]*
+	|0[xX][0-9a-fA-F]*(?:\.[0-9a-fA-F]*)?(?:[pP][+-]?[0-9]+)?|(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?
+	|--.*
+	|"[^"\r\n]*"?
+	|'[^'\r\n]*'?
+	|\.\.\.|\.\.|==|~=|<=|>=|::|[(),=:.;]
+""", re.X)
+
+short_string_res = {
+	'"' : re.compile(r'(?:[^"\\\r\n]|\\[^\r\n])*(?:"|(\\))?'),
+	"'" : re.compile(r"(?:[^'\\\r\n]|\\[^\r\n])*(?:'|(\\))?"),
+}
+
+# 在同一行结束的长注释和短字符串，用于判断光标是否在其中
+long_comment_re = re.compile(r"--\[=*\[")
+closed_string_res = {
+	'"' : re.compile(r'"(?:[^"\\]|\\.)*"$'),
+	"'" : re.compile(r"'(?:[^'\\]|\\.)*'$"),
+}
+
+EMPTY = ()
+
+# 修改记录保留的条数。使用者落后太多时需要全部重新处理
+MAX_CHANGES = 64
+
+# 每次检查时间限制之间分析的行数
+BUDGET_CHECK_LINES = 256
+
+# 行首在跨行的字符串或注释中时，返回 (字符串、注释结束的位置, 结束之后的状态)
+def close_state(line, state):
+	kind, close = state
+	if len(close) == 1:
+		match = short_string_res[close].match(line)
+		if match.group(1) is not None:
+			return len(line), state
+		return match.end(), None
+
+	end = line.find(close)
+	if end < 0:
+		return len(line), state
+	return end + len(close), None
+
+# 一行最后一个token结束时的状态
+def end_state(match):
+	if match.group(1) is not None and match.group(2) is None:
+		return (COMMENT, "]" + match.group(1) + "]")
+	if match.group(3) is not None and match.group(4) is None:
+		return (STRING, "]" + match.group(3) + "]")
+	if match.group(5) is not None:
+		return (STRING, '"')
+	if match.group(6) is not None:
+		return (STRING, "'")
+	return None
+
+def is_simple_line(line, state):
+	return state is None and "\\" not in line and ("[" not in line or ("[[" not in line and "[=" not in line))
+
+def lex_line(line, state = None):
+	""" 分析一行代码。state是这一行开始时的状态，返回 (token文本, 这一行结束时的状态) """
+	if is_simple_line(line, state):
+		texts = simple_token_re.findall(line)
+		return tuple(texts) if texts else EMPTY, None
+
+	pos = 0
+	head = None
+	if state is not None:
+		pos, new_state = close_state(line, state)
+		head = STRING_PIECE if state[0] == STRING else COMMENT_PIECE
+		if new_state is not None:
+			return (head, ), new_state
+
+	matches = list(token_re.finditer(line, pos))
+	texts = [match.group() for match in matches]
+	if head is not None:
+		texts.insert(0, head)
+
+	state = end_state(matches[-1]) if matches else None
+	return tuple(texts) if texts else EMPTY, state
+
+def line_spans(line, state = None):
+	""" 与lex_line的token一一对应的 (开始列, 结束列) """
+	if is_simple_line(line, state):
+		return [match.span() for match in simple_token_re.finditer(line)]
+
+	spans = []
+	pos = 0
+	if state is not None:
+		pos, state = close_state(line, state)
+		spans.append((0, pos))
+		if state is not None:
+			return spans
+
+	spans.extend(match.span() for match in token_re.finditer(line, pos))
+	return spans
+
+def strip_line(line, texts, start_state, end_state):
+	""" 去掉注释和跨行的字符串，只保留代码。同一行中的字符串要保留，require和class的参数是字符串 """
+	if not texts:
+		return line
+
+	last = len(texts) - 1
+	parts = []
+	pos = 0
+	for i, (start, end) in enumerate(line_spans(line, start_state)):
+		text = texts[i]
+		if text[0] == "-" or (i == 0 and start_state is not None) or (i == last and end_state is not None):
+			parts.append(line[pos:start])
+			if start > 0: parts.append(" ")
+			pos = end
+
+	if not parts:
+		return line
+
+	parts.append(line[pos:])
+	return "".join(parts)
+
+def strip_code(line, state = None):
+	""" 逐行读取文件时使用。返回 (去掉注释和跨行字符串之后的代码, 行尾的状态) """
+	# 没有这些字符时不会有注释，也不会进入或离开跨行的字符串
+	if state is None and "--" not in line and "[" not in line and "\\" not in line:
+		return line, None
+
+	texts, new_state = lex_line(line, state)
+	return strip_line(line, texts, state, new_state), new_state
+
+def is_name(text):
+	return text[0] in NAME_START and text not in KEYWORDS
+
+# 先按倍增的长度比较找到不同的区间，再在区间内二分查找，每个字符只需要复制常数次
+def common_prefix_length(a, b):
+	count = min(len(a), len(b))
+	pos, size = 0, 1024
+	while pos < count:
+		end = min(count, pos + size)
+		if a[pos:end] != b[pos:end]:
+			break
+		pos, size = end, size * 2
+	else:
+		return count
+
+	lo, hi = pos, end
+	while hi - lo > 1:
+		mid = (lo + hi) // 2
+		if a[lo:mid] == b[lo:mid]:
+			lo = mid
+		else:
+			hi = mid
+	return lo
+
+def common_suffix_length(a, b, limit):
+	la, lb = len(a), len(b)
+	pos, size = 0, 1024
+	while pos < limit:
+		end = min(limit, pos + size)
+		if a[la - end:la - pos] != b[lb - end:lb - pos]:
+			break
+		pos, size = end, size * 2
+	else:
+		return limit
+
+	# 后缀长度在 [lo, hi) 之间
+	lo, hi = pos, end
+	while hi - lo > 1:
+		mid = (lo + hi) // 2
+		if a[la - mid:la - lo] == b[lb - mid:lb - lo]:
+			lo = mid
+		else:
+			hi = mid
+	return lo
+
+class TokenStream(object):
+	""" 一个buffer的token流。只有前lexed行分析过，其余的行在使用者需要时才分析。
+
+	每次修改都会记录到changes中: (版本号, first, old_end, new_end)，表示旧的 [first, old_end) 行
+	被替换成了新的 [first, new_end) 行，其他行的token没有变化。使用者保存自己处理过的版本号，
+	用changes_since找到之后的修改，只更新受影响的行。
+	"""
+
+	def __init__(self, content = "", max_line_length = None):
+		self.content = ""
+		self.lines = [""]
+
+		# 超长的行只分析开头的部分
+		self.max_line_length = max_line_length
+
+		# 已经分析过的行数。tokens[i]是第i行的token，states[i]是第i行开始时的状态
+		self.lexed = 0
+		self.tokens = []
+		self.states = [None]
+
+		self.version = 0
+		self.changes = []
+
+		# 所属buffer的版本（sublime的change_count），由get_view_stream使用
+		self.buffer_version = None
+
+		if content:
+			self.update(content)
+
+	def line_count(self):
+		return len(self.lines)
+
+	def get_line(self, i):
+		line = self.lines[i]
+		if self.max_line_length is not None and len(line) > self.max_line_length:
+			line = line[:self.max_line_length]
+		return line
+
+	# 分析前count行。deadline之前没有完成时返回False
+	def lex_until(self, count, deadline = None):
+		count = min(count, len(self.lines))
+		lexed = self.lexed
+		if lexed >= count:
+			return True
+
+		tokens = self.tokens
+		states = self.states
+		state = states[lexed]
+		while lexed < count:
+			line_tokens, state = lex_line(self.get_line(lexed), state)
+			tokens.append(line_tokens)
+			states.append(state)
+			lexed += 1
+
+			if deadline is not None and lexed % BUDGET_CHECK_LINES == 0 and time.perf_counter() > deadline:
+				break
+
+		self.lexed = lexed
+		return lexed >= count
+
+	def lex_all(self, deadline = None):
+		return self.lex_until(len(self.lines), deadline)
+
+	# 更新内容，只重新分析修改过的行。返回内容是否有变化
+	def update(self, content, deadline = None):
+		old = self.content
+		if content == old:
+			return False
+
+		prefix = common_prefix_length(old, content)
+		suffix = common_suffix_length(old, content, min(len(old), len(content)) - prefix)
+
+		# 被修改的行: 旧内容的 [first, old_end) 行
+		line_start = old.rfind('\n', 0, prefix) + 1
+		first = old.count('\n', 0, line_start)
+		old_end = first + 1 + old.count('\n', line_start, len(old) - suffix)
+
+		line_end = content.find('\n', len(content) - suffix)
+		if line_end < 0: line_end = len(content)
+
+		new_lines = content[line_start:line_end].split('\n')
+		old_count = len(self.lines)
+		self.lines[first:old_end] = new_lines
+		self.content = content
+		new_end = first + len(new_lines)
+
+		if first < self.lexed:
+			old_end, new_end = self.relex(first, old_end, new_end, deadline)
+			if old_end is None:
+				old_end, new_end = old_count, len(self.lines)
+
+		self.version += 1
+		self.changes.append((self.version, first, old_end, new_end))
+		if len(self.changes) > MAX_CHANGES:
+			del self.changes[0]
+		return True
+
+	# 重新分析修改过的行。修改之后某一行开始时的状态变化了（例如输入了"--[["），需要继续分析后面的行，
+	# 直到状态与修改之前相同。返回实际变化的范围，超时返回 (None, None)，之后的行需要重新分析
+	def relex(self, first, old_end, new_end, deadline):
+		old_lexed = self.lexed
+		old_states = self.states
+		delta = new_end - old_end
+		changed_end = new_end
+
+		tokens = []
+		states = []
+		state = old_states[first]
+		i = first
+		while i < changed_end or (i < len(self.lines) and i - delta <= old_lexed and state != old_states[i - delta]):
+			line_tokens, state = lex_line(self.get_line(i), state)
+			tokens.append(line_tokens)
+			states.append(state)
+			i += 1
+
+			if deadline is not None and (i - first) % BUDGET_CHECK_LINES == 0 and time.perf_counter() > deadline:
+				break
+
+		new_end, old_end = i, i - delta
+		if i < changed_end or old_end > old_lexed or (new_end < len(self.lines) and state != old_states[old_end]):
+			# 后面的行还需要重新分析
+			del self.tokens[first:]
+			del self.states[first + 1:]
+			self.tokens.extend(tokens)
+			self.states.extend(states)
+			self.lexed = new_end
+			return None, None
+
+		self.tokens[first:old_end] = tokens
+		self.states[first + 1:old_end + 1] = states
+		self.lexed = old_lexed + delta
+		return old_end, new_end
+
+	# version之后的修改。太旧的版本返回None，使用者需要全部重新处理
+	def changes_since(self, version):
+		if version == self.version:
+			return []
+
+		changes = self.changes
+		if version > self.version or not changes or changes[0][0] > version + 1:
+			return None
+		return [change for change in changes if change[0] > version]
+
+	def code_line(self, i):
+		""" 第i行去掉注释和跨行字符串之后的代码。这一行必须已经分析过 """
+		line = self.get_line(i)
+		states = self.states
+		if states[i] is None and states[i + 1] is None and "--" not in line:
+			return line
+		return strip_line(line, self.tokens[i], states[i], states[i + 1])
+
+	def token_starts(self, i):
+		""" 第i行每个token开始的列。这一行必须已经分析过 """
+		return [start for start, end in line_spans(self.get_line(i), self.states[i])]
+
+	def in_literal(self, i, column):
+		""" 第i行的column列是否在字符串或注释中。光标在没有结束的字符串、注释的末尾时也算在其中 """
+		self.lex_until(i + 1)
+		if i >= self.lexed:
+			return False
+
+		line = self.get_line(i)
+		texts = self.tokens[i]
+		spans = line_spans(line, self.states[i])
+		for index, (start, end) in enumerate(spans):
+			if start >= column: break
+
+			text = texts[index]
+			if text[0] not in "\"'[-": continue
+			if column < end: return True
+			if end < len(line): continue
+
+			# 光标在行尾。跨行的字符串、注释，以及单行注释和没有结束的短字符串都延续到这里
+			if index == len(spans) - 1 and self.states[i + 1] is not None:
+				return True
+			if index == 0 and self.states[i] is not None:
+				return not line.endswith(self.states[i][1])
+			if text[0] == "-":
+				return long_comment_re.match(text) is None
+			if text[0] != "[":
+				return closed_string_res[text[0]].match(text) is None
+		return False
+
+# 每个buffer的token流。view id或文档uri : TokenStream
+VIEW_STREAMS = {}
+
+def get_view_stream(view_id, buffer_version, content, max_line_length = None):
+	""" 获取view的token流。同一个buffer版本只更新一次，之后的使用者直接使用 """
+	stream = VIEW_STREAMS.get(view_id)
+	if stream is None:
+		stream = VIEW_STREAMS[view_id] = TokenStream(max_line_length = max_line_length)
+
+	if stream.buffer_version != buffer_version:
+		stream.update(content)
+		stream.buffer_version = buffer_version
+	return stream
+
+def clear_view_stream(view_id):
+	VIEW_STREAMS.pop(view_id, None)
@@ -1,208 +1,481 @@
 
-from collections import OrderedDict, namedtuple
-from copy import copy
+from collections import namedtuple
+import bisect
 import logging
-import re
+import time
 
-logger = logging.getLogger("LuaAutocomplete.locals")
-
-localvar_re = re.compile(r"(?:[a-zA-Z_][a-zA-Z0-9_]*|\.\.\.)")
+try:
+	from LuaAutocomplete import lexer
+except ImportError:
+	import lexer # Running this file directly
 
-class StopParsing(Exception):
-	pass
+logger = logging.getLogger("LuaAutocomplete.locals")
 
 # Holds info about a variable.
 # vartype: Semantic info about the origins of a variable, ex. if it's a local var, a for loop index, an upvalue, ...
 VarInfo = namedtuple("VarInfo", ["vartype"])
 
+UPVALUE = VarInfo(vartype="upvalue")
+
+class OutOfTime(Exception):
+	pass
+
+def merge_scopes(scopes, union=False):
+	"""
+	Combines the scopes returned by LocalsFinder.run_many. By default only the variables in scope at every cursor are
+	kept, since a completion is inserted at all of them; with union=True a variable in scope at any cursor is kept.
+	The info of a variable comes from the first scope that has it.
+	"""
+	if not scopes:
+		return {}
+
+	merged = scopes[0].copy()
+	for scope in scopes[1:]:
+		if union:
+			for name, info in scope.items():
+				merged.setdefault(name, info)
+		else:
+			for name in list(merged):
+				if name not in scope:
+					del merged[name]
+	return merged
+
 class LocalsFinder:
 	"""
 	Parses a Lua file, looking for local variables that are in a certain scope.
+
+	Walks the token stream from the lexer module, which the indexer also uses, so strings, long strings
+	and comments are skipped the same way in both.
 	"""
-	
-	# Both patterns and matches need to be ordered, so that `longcomment` is tried first before `comment`
-	patterns = OrderedDict([
-		("for_incremental", re.compile(r"\bfor\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*=.*?\bdo\b", re.S)),
-		("for_iterator",    re.compile(r"\bfor\s*((?:[a-zA-Z_][a-zA-Z0-9_]*|,\s*)+)\s*in\b.*?\bdo\b", re.S)),
-		("local_function",  re.compile(r"\blocal\s+function\s+([a-zA-Z_][a-zA-Z0-9_]*)\s*\(((?:[a-zA-Z_][a-zA-Z0-9_]*|\.\.\.|,\s*)*)\)")),
-		("function",        re.compile(r"\bfunction(?:\s+[a-zA-Z0-9._]*)?\(((?:[a-zA-Z_][a-zA-Z0-9_]*|\.\.\.|,\s*)*)\)")),
-		("method",          re.compile(r"\bfunction\s+[a-zA-Z0-9._]+:[a-zA-Z0-9_]+\(((?:[a-zA-Z_][a-zA-Z0-9_]*|\.\.\.|,\s*)*)\)")),
-		("block_start",     re.compile(r"\b(?:do|then|repeat)\b")), # Matches while loops, incomplete for loops, and `do ... end` blocks
-		("block_end",       re.compile(r"\b(?:end|until)\b")),
-		("locals",          re.compile(r"\blocal\s+((?:[a-zA-Z_][a-zA-Z0-9_]*|,\s*)+)\b")),
-		("longcomment",     re.compile(r"\-\-\[(=*)\[")),
-		("comment",         re.compile(r"\-\-")),
-		("string",          re.compile(r"""(?:"|')""")),
-		("longstring",      re.compile(r"\[(=*)\[")),
-	])
-	
-	def __init__(self, code):
+
+	# Number of lines scanned between checks of the time budget
+	budget_check_lines = 64
+
+	def __init__(self, code="", time_budget=None, stream=None):
 		"""
-		Creates a new parser.
+		Creates a new parser. time_budget is the number of seconds a single run may take, or None for no limit.
+		stream is a shared lexer.TokenStream; a private one is made from code if it's not given.
 		"""
-		self.code = code
-	
+		if stream is None:
+			stream = lexer.TokenStream(code)
+		self.stream = stream
+		self.time_budget = time_budget
+
+		# Whether the last run stopped at the time budget before reaching the cursor
+		self.partial = False
+
 	def run(self, cursor):
 		"""
 		Runs the parser. cursor is the location of the scope.
 		"""
-		self.matches = OrderedDict()
-		self.scope_stack = [{}]
-		
-		self.setup_initial_matches()
-		
+		return self.run_many([cursor])[0]
+
+	def run_many(self, cursors):
+		"""
+		Runs the parser for several cursors in one scan, which costs the same as a single run to the last cursor.
+		Returns the scope at each cursor, in the order of cursors; merge_scopes combines them.
+		"""
+		if not cursors:
+			return []
+
+		order = sorted(range(len(cursors)), key=cursors.__getitem__)
+		scopes = self.run_at(self.locate_all([cursors[i] for i in order]))
+
+		ret = [None] * len(cursors)
+		for i, scope in zip(order, scopes):
+			ret[i] = scope
+		return ret
+
+	def locate(self, cursor):
+		"""
+		Converts a character offset into a (line, column) pair.
+		"""
+		return self.locate_all([cursor])[0]
+
+	def locate_all(self, cursors):
+		"""
+		Converts sorted character offsets into (line, column) pairs, counting lines only once.
+		"""
+		content = self.stream.content
+		positions = []
+		line = 0
+		counted = 0
+		for cursor in cursors:
+			cursor = min(cursor, len(content))
+			line_start = content.rfind("\n", 0, cursor) + 1
+			if counted == 0 and line_start > len(content) // 2:
+				# Usually the cursor is near the end of a large file; count the lines after it instead
+				line = len(self.stream.lines) - 1 - content.count("\n", line_start)
+				counted = line_start
+			elif line_start > counted:
+				line += content.count("\n", counted, line_start)
+				counted = line_start
+			positions.append((line, cursor - line_start))
+		return positions
+
+	def run_at(self, positions):
+		"""
+		Runs the parser for sorted (line, column) positions, starting at the beginning of the file.
+		"""
+		return self.run_from(0, 0, [{}], positions)
+
+	def run_from(self, line, index, scope_stack, positions):
+		"""
+		Runs the parser starting at token index of line with an existing scope stack, and returns the scope at each of
+		the sorted (line, column) positions.
+		"""
+		self.scope_stack = scope_stack
+		self.partial = False
+		self.far_line = line
+		self.set_position(line, index)
+
+		self.deadline = None
+		if self.time_budget is not None:
+			self.deadline = time.perf_counter() + self.time_budget
+		self.next_budget_check = line + self.budget_check_lines
+
+		scopes = []
 		try:
-			current_pos = 0
-			while True:
-				name, match = self.rematch(current_pos)
-				if not match:
-					break
-				
-				if match.start() >= cursor:
-					break
-				
-				current_pos = self.dispatch(name, match)
-		except StopParsing:
-			pass
-		
+			for position in positions[:-1]:
+				self.scan(*position)
+				# The scan continues from here, and may add variables to the same scope
+				scopes.append(self.scope_stack[-1].copy())
+			self.scan(*positions[-1])
+		except OutOfTime:
+			# Return the variables in scope at this point instead of at the remaining cursors
+			self.partial = True
+
 		curscope = self.scope_stack[-1]
-		del self.matches
 		del self.scope_stack
-		return curscope
-	
-	def setup_initial_matches(self):
-		for name, regex in self.patterns.items():
-			self.matches[name] = regex.search(self.code)
-	
-	def rematch(self, pos):
-		best_name, best_match = None, None
-		
-		for name, regex in self.patterns.items():
-			match = self.matches[name]
-			
-			if not match:
-				# Previous try didn't find anything. Trying now won't find anything either.
-				continue
-			
-			# If the new position is less than the first match, the regex doesn't need to be re-ran.
-			if pos > match.start():
-				match = regex.search(self.code, pos)
-				self.matches[name] = match
-			
-			# Find first match
-			if match and (not best_match or match.start() < best_match.start()):
-				best_name = name
-				best_match = match
-		return best_name, best_match
-	
-	def dispatch(self, name, match):
-		logger.debug("Matched %s at char %s", name, match.start())
-		return getattr(self, "handle_"+name)(match)
-	
+		scopes.extend([curscope] * (len(positions) - len(scopes)))
+		return scopes
+
+	def scan(self, cursor_line, cursor_column):
+		"""
+		Handles the keywords before the cursor. Other tokens are skipped without a method call.
+		"""
+		handlers = self.keyword_handlers
+		while self.line <= cursor_line:
+			line = self.line
+			tokens = self.tokens
+			end = len(tokens)
+			if line == cursor_line:
+				end = bisect.bisect_left(self.stream.token_starts(line), cursor_column)
+
+			index = self.index
+			while index < end:
+				handler = handlers.get(tokens[index])
+				index += 1
+				if handler is not None:
+					self.index = index
+					handler(self)
+					self.advance()
+					if self.line != line:
+						break # The handler read past the end of the line
+					index = self.index
+			else:
+				self.index = index # Where the scan for the next cursor continues
+				if line == cursor_line or not self.next_line():
+					return
+				if self.line >= self.next_budget_check:
+					self.check_budget()
+
+	def check_budget(self):
+		"""
+		Called at the start of a line every budget_check_lines lines, so that code without keywords also gets
+		checkpoints. Raises OutOfTime when the time budget is used up, after saving the position reached with
+		advance(True) so that the next run continues from it instead of starting over.
+		"""
+		self.next_budget_check = self.line + self.budget_check_lines
+		self.advance()
+		if self.deadline is not None and time.perf_counter() > self.deadline:
+			self.advance(True)
+			raise OutOfTime()
+
+	def advance(self, force=False):
+		"""
+		Called after each handled keyword, when self.line and self.index point past the tokens it used, and with
+		force set before stopping at the time budget.
+		"""
+		pass
+
+	#########################################################################
+
+	def set_position(self, line, index):
+		stream = self.stream
+		if line >= stream.lexed:
+			stream.lex_until(line + 1)
+
+		self.line = line
+		self.index = index
+		self.tokens = stream.tokens[line] if line < stream.lexed else lexer.EMPTY
+
+	def next_line(self):
+		stream = self.stream
+		line = self.line + 1
+		if line >= stream.lexed:
+			stream.lex_until(line + lexer.BUDGET_CHECK_LINES)
+			if line >= stream.lexed:
+				return False
+
+		self.line = line
+		self.index = 0
+		self.tokens = stream.tokens[line]
+		if line > self.far_line:
+			self.far_line = line
+		return True
+
+	def next_token(self):
+		"""
+		Returns the next name, keyword or operator, skipping strings, comments and numbers, or None at the end of the file.
+		"""
+		literal_start = lexer.LITERAL_START
+		while True:
+			tokens = self.tokens
+			index = self.index
+			while index < len(tokens):
+				text = tokens[index]
+				index += 1
+				if text[0] not in literal_start:
+					self.index = index
+					return text
+
+			self.index = index
+			if not self.next_line():
+				return None
+
+	def unread(self):
+		"""
+		Puts back the token returned by the last next_token call.
+		"""
+		self.index -= 1
+
+	def next_name(self):
+		"""
+		Returns the next token if it's a name that isn't a keyword, otherwise puts it back and returns None.
+		"""
+		text = self.next_token()
+		if text is None:
+			return None
+
+		if not lexer.is_name(text):
+			self.unread()
+			return None
+		return text
+
+	def next_is(self, expected):
+		"""
+		Consumes the next token if its text is expected.
+		"""
+		text = self.next_token()
+		if text == expected:
+			return True
+
+		if text is not None:
+			self.unread()
+		return False
+
+	def read_names(self):
+		"""
+		Reads a list of names separated by commas.
+		"""
+		names = []
+		while True:
+			name = self.next_name()
+			if name is None:
+				return names
+
+			names.append(name)
+			if not self.next_is(","):
+				return names
+
+	def read_function(self, is_method):
+		"""
+		Reads the parameter list after the name of a function, and enters its scope.
+		"""
+		self.push_scope(is_function=True)
+		if is_method:
+			self.add_var("self", vartype="self")
+
+		if not self.next_is("("):
+			return
+
+		arguments = []
+		while True:
+			text = self.next_token()
+			if text is None or text == ")":
+				break
+
+			if text == "..." or lexer.is_name(text):
+				arguments.append(text)
+			elif text != ",":
+				self.unread()
+				break
+
+		self.add_vars(arguments, vartype="parameter")
+
 	def push_scope(self, is_function=False):
 		if not is_function:
 			self.scope_stack.append(self.scope_stack[-1].copy())
 		else:
-			newscope = {}
-			for k, v in self.scope_stack[-1].items():
-				v2 = VarInfo(vartype="upvalue")
-				newscope[k] = v2
-			self.scope_stack.append(newscope)
-	
+			self.scope_stack.append(dict.fromkeys(self.scope_stack[-1], UPVALUE))
+
 	def pop_scope(self):
 		if len(self.scope_stack) == 1:
 			logging.debug("Scope stack underflow; probably an excess `end`")
 			# TODO: Can we handle excessive ends better?
 		else:
 			self.scope_stack.pop()
-	
+
 	def add_var(self, name, **kwargs):
 		self.scope_stack[-1][name] = VarInfo(**kwargs)
-	
+
 	def add_vars(self, vars, **kwargs):
 		info = VarInfo(**kwargs)
 		for name in vars:
 			self.scope_stack[-1][name] = info
-	
+
 	#########################################################################
-	
-	def handle_for_incremental(self, match):
-		self.push_scope()
-		
-		self.add_var(match.group(1), vartype="for index")
-		return match.end()
-	
-	def handle_for_iterator(self, match):
-		self.push_scope()
-		
-		the_locals = localvar_re.findall(match.group(1))
-		self.add_vars(the_locals, vartype="for index")
-		return match.end()
-	
-	def handle_local_function(self, match):
-		self.add_var(match.group(1), vartype="local")
-		
-		self.push_scope(is_function=True)
-		arguments = localvar_re.findall(match.group(2))
-		self.add_vars(arguments, vartype="parameter")
-		return match.end()
-	
-	def handle_function(self, match):
-		self.push_scope(is_function=True)
-		arguments = localvar_re.findall(match.group(1))
-		self.add_vars(arguments, vartype="parameter")
-		return match.end()
-	
-	def handle_method(self, match):
-		self.push_scope(is_function=True)
-		arguments = localvar_re.findall(match.group(1))
-		self.add_var("self", vartype="self")
-		self.add_vars(arguments, vartype="parameter")
-		return match.end()
-	
-	def handle_block_start(self, match):
+
+	def handle_for(self):
+		line, index = self.line, self.index
+
+		names = self.read_names()
+		if names:
+			text = self.next_token()
+			if text == "in" or (text == "=" and len(names) == 1):
+				# The loop header may contain anything up to `do`, which belongs to the loop instead of starting a block
+				while True:
+					text = self.next_token()
+					if text is None:
+						break
+					if text == "do":
+						self.push_scope()
+						self.add_vars(names, vartype="for index")
+						return
+
+		# Incomplete loop: ignore the `for`, its `do` (if any) starts a block as usual
+		self.set_position(line, index)
+
+	def handle_local(self):
+		if self.next_is("function"):
+			name = self.next_name()
+			if name is not None:
+				self.add_var(name, vartype="local")
+			self.read_function(is_method=False)
+			return
+
+		self.add_vars(self.read_names(), vartype="local")
+
+	def handle_function(self):
+		# Function name: `a.b.c:d`, or nothing for an anonymous function
+		is_method = False
+		if self.next_name() is not None:
+			while True:
+				text = self.next_token()
+				if text != "." and text != ":":
+					if text is not None:
+						self.unread()
+					break
+
+				is_method = text == ":"
+				if self.next_name() is None:
+					break
+
+		self.read_function(is_method)
+
+	def handle_block_start(self):
 		self.push_scope()
-		return match.end()
-	
-	def handle_block_end(self, match):
+
+	def handle_block_end(self):
 		self.pop_scope()
-		return match.end()
-	
-	def handle_locals(self, match):
-		the_locals = localvar_re.findall(match.group(1))
-		self.add_vars(the_locals, vartype="local")
-		return match.end()
-	
-	def handle_comment(self, match):
-		line_end = self.code.find("\n", match.end())
-		if line_end == -1:
-			raise StopParsing() # EOF
-		return line_end+1
-	
-	def handle_longcomment(self, match):
-		end_str = "]" + match.group(1) + "]" # Match number of equals signs
-		comment_end = self.code.find(end_str, match.end())
-		if comment_end == -1:
-			raise StopParsing() # EOF
-		return comment_end+len(end_str)
-	
-	def handle_string(self, match):
-		str_char = match.group(0) # single or double quotes?
-		str_end = match.end()
-		
-		while self.code[str_end] != str_char or self.code[str_end-1] == "\\": # Keep looking for unescaped terminator
-			str_end = self.code.find(str_char, str_end+1)
-			if str_end == -1:
-				raise StopParsing() # EOF
-		
-		return str_end+1
-	
-	def handle_longstring(self, match):
-		end_str = "]" + match.group(1) + "]" # Match number of equals signs
-		str_end = self.code.find(end_str, match.end())
-		if str_end == -1:
-			raise StopParsing() # EOF
-		return str_end+len(end_str)
+
+	keyword_handlers = {
+		"for" : handle_for,
+		"local" : handle_local,
+		"function" : handle_function,
+		"do" : handle_block_start, # Matches while loops, incomplete for loops, and `do ... end` blocks
+		"then" : handle_block_start,
+		"repeat" : handle_block_start,
+		"end" : handle_block_end,
+		"until" : handle_block_end,
+	}
+
+class IncrementalLocalsFinder(LocalsFinder):
+	"""
+	A LocalsFinder that snapshots the scope stack at regular intervals while scanning.
+
+	After the code changes, only the checkpoints that depend on changed lines of the token stream are discarded,
+	and the next run resumes from the closest checkpoint before the cursor instead of the start of the file.
+	"""
+
+	checkpoint_interval = 64 # Lines
+
+	def __init__(self, code="", time_budget=None, stream=None):
+		super(IncrementalLocalsFinder, self).__init__(code, time_budget, stream)
+		self.stream_version = self.stream.version
+		self.checkpoints = [] # Sorted list of (line, token index, furthest line looked at, scope stack snapshot)
+		self.checkpoint_lines = []
+
+	def update(self, code):
+		"""
+		Replaces the code, keeping the checkpoints that are still valid.
+		"""
+		self.stream.update(code)
+		self.sync_stream()
+
+	def sync_stream(self):
+		"""
+		Discards the checkpoints invalidated by changes to the token stream, which may be shared with the indexer
+		and updated by it.
+		"""
+		changes = self.stream.changes_since(self.stream_version)
+		self.stream_version = self.stream.version
+		if changes is None:
+			first = 0
+		elif not changes:
+			return
+		else:
+			first = min(change[1] for change in changes)
+
+		# A checkpoint is only kept if every line looked at before it, including lookahead, is unchanged
+		checkpoints = self.checkpoints
+		while checkpoints and checkpoints[-1][2] >= first:
+			checkpoints.pop()
+			self.checkpoint_lines.pop()
+
+	def run_at(self, positions):
+		self.sync_stream()
+
+		i = bisect.bisect_left(self.checkpoint_lines, positions[0][0]) - 1
+		if i < 0:
+			line, index, scope_stack = 0, 0, [{}]
+		else:
+			line, index, far_line, snapshot = self.checkpoints[i]
+			scope_stack = [scope.copy() for scope in snapshot]
+
+		self.next_checkpoint = line + self.checkpoint_interval
+		return self.run_from(line, index, scope_stack, positions)
+
+	def advance(self, force=False):
+		line = self.line
+		if line < self.next_checkpoint and not force:
+			return
+
+		self.next_checkpoint = line + self.checkpoint_interval
+		checkpoint_lines = self.checkpoint_lines
+		i = len(checkpoint_lines)
+		if checkpoint_lines and line <= checkpoint_lines[-1]:
+			if not force:
+				return # Resumed before existing checkpoints; they are still valid
+
+			# Stopped between two checkpoints; the next run must not start over from the earlier one
+			i = bisect.bisect_left(checkpoint_lines, line)
+			if checkpoint_lines[i] == line:
+				return
+
+		self.checkpoints.insert(i, (line, self.index, self.far_line, [scope.copy() for scope in self.scope_stack]))
+		checkpoint_lines.insert(i, line)
 
 if __name__ == "__main__":
 	import sys
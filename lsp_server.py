@@ -0,0 +1,540 @@
+# -*- coding: utf-8 -*-
+# 语言服务器：在sublime之外通过stdio提供Language Server Protocol服务，其他编辑器也可以使用同一份索引。
+# 每个工程只有一个常驻的ProjectIndexer，打开的文档使用增量同步，客户端每次只发送修改的部分。
+#   python lsp_server.py
+# 支持的请求和通知：
+#   initialize, shutdown, exit, workspace/didChangeWorkspaceFolders
+#   textDocument/didOpen, didChange, didSave, didClose
+#   textDocument/completion: require路径、xxx.成员（模块、类、self）、局部变量，与插件中的补全相同
+#   workspace/symbol: 按名字搜索所有工程中的模块、全局符号、类和类成员，返回定义所在的行
+#   luaAutocomplete/status: 工程的索引状态和补全耗时等统计（metrics.snapshot）
+import os
+import re
+import sys
+import json
+import threading
+import traceback
+
+if __name__ == "__main__":
+	from build_index import setup_package
+	setup_package()
+
+from urllib.parse import urlparse, quote
+from urllib.request import url2pathname
+
+from LuaAutocomplete import indexer, lexer, metrics
+from LuaAutocomplete.locals import IncrementalLocalsFinder
+
+# json-rpc错误码
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INTERNAL_ERROR = -32603
+SERVER_NOT_INITIALIZED = -32002
+
+# TextDocumentSyncKind.Incremental
+SYNC_INCREMENTAL = 2
+
+# CompletionItemKind
+COMPLETION_KINDS = {
+	"function" : 3,
+	"var" : 6,
+	"class" : 7,
+	"module" : 9,
+	"subdirectory" : 19,
+}
+COMPLETION_VARIABLE = 6
+
+# SymbolKind
+SYMBOL_MODULE = 2
+SYMBOL_CLASS = 5
+SYMBOL_METHOD = 6
+SYMBOL_FIELD = 8
+SYMBOL_FUNCTION = 12
+SYMBOL_VARIABLE = 13
+
+# InsertTextFormat.Snippet，函数的补全内容是 name($0args)
+SNIPPET_FORMAT = 2
+
+# workspace/symbol最多返回的数量
+MAX_WORKSPACE_SYMBOLS = 500
+
+require_prefix_pattern = re.compile(r"""require\s*\(?\s*["']([^"]*)$""")
+index_word_pattern = re.compile(r"[\w.:]*$")
+word_prefix_pattern = re.compile(r"\w*$")
+astral_pattern = re.compile("[\U00010000-\U0010ffff]")
+
+class LspError(Exception):
+	def __init__(self, code, message):
+		super(LspError, self).__init__(message)
+		self.code = code
+		self.message = message
+
+def uri_to_path(uri):
+	return os.path.normpath(url2pathname(urlparse(uri).path))
+
+def path_to_uri(path):
+	path = os.path.abspath(path).replace("\\", "/")
+	if not path.startswith("/"):
+		path = "/" + path
+	return "file://" + quote(path)
+
+# 把客户端的列（utf-16编码单元）转换成字符串中的位置。大部分的行没有BMP之外的字符，两者相同
+def to_column(line, character, encoding):
+	if encoding != "utf-16" or not astral_pattern.search(line, 0, character):
+		return min(character, len(line))
+
+	units = 0
+	for i, c in enumerate(line):
+		if units >= character: return i
+		units += 2 if c >= "\U00010000" else 1
+	return len(line)
+
+# 把sublime格式的补全 (触发词\t类型, 内容) 转换成CompletionItem
+def to_completion_item(completion):
+	trigger, contents = completion
+	label, _, detail = trigger.partition("\t")
+
+	item = {
+		"label" : label,
+		"kind" : COMPLETION_KINDS.get(detail, COMPLETION_VARIABLE),
+		"insertText" : contents,
+	}
+	if detail:
+		item["detail"] = detail
+	if "$" in contents:
+		item["insertTextFormat"] = SNIPPET_FORMAT
+	return item
+
+# 客户端打开的文档。内容按行保存，增量修改只替换修改的行，需要完整内容时才重新拼接
+class Document(object):
+	def __init__(self, uri, text, version = None):
+		self.uri = uri
+		self.file_path = uri_to_path(uri)
+		self.version = version
+		self.lines = text.split("\n")
+		self.text = text
+
+		# 每次修改都会增加，相当于sublime的change_count，用于token流和FileIndexer的缓存
+		self.change_count = 0
+
+	def get_text(self):
+		if self.text is None:
+			self.text = "\n".join(self.lines)
+		return self.text
+
+	# 应用一个TextDocumentContentChangeEvent。没有range时是整个文档的内容
+	def apply_change(self, change, encoding):
+		self.change_count += 1
+
+		if "range" not in change:
+			self.text = change["text"]
+			self.lines = self.text.split("\n")
+			return
+
+		start, end = change["range"]["start"], change["range"]["end"]
+		lines = self.lines
+		first = min(start["line"], len(lines) - 1)
+		last = min(end["line"], len(lines) - 1)
+
+		head = lines[first][:to_column(lines[first], start["character"], encoding)]
+		tail = lines[last][to_column(lines[last], end["character"], encoding):]
+		lines[first:last + 1] = (head + change["text"] + tail).split("\n")
+		self.text = None
+
+	# 位置对应的 (行, 列)，列是字符串中的位置
+	def get_position(self, position, encoding):
+		line = min(position["line"], len(self.lines) - 1)
+		return line, to_column(self.lines[line], position["character"], encoding)
+
+	def get_offset(self, line, column):
+		return sum(map(len, self.lines[:line])) + line + column
+
+class Server(object):
+	def __init__(self, reader, writer):
+		self.reader = reader
+		self.writer = writer
+		self.write_lock = threading.Lock()
+
+		self.initialized = False
+		self.shutdown_requested = False
+		self.running = True
+
+		# 客户端使用的位置编码，由initialize协商
+		self.position_encoding = "utf-16"
+
+		self.project_paths = indexer.ProjectPaths([])
+
+		# 打开的文档和它们的局部变量查找器。uri : Document / IncrementalLocalsFinder
+		self.documents = {}
+		self.finders = {}
+
+	def run(self):
+		while self.running:
+			message = self.read_message()
+			if message is None:
+				break
+
+			self.handle_message(message)
+
+		indexer.stop_all_watching()
+		return 0 if self.shutdown_requested else 1
+
+	# 读取一条消息。消息头中只使用Content-Length，输入结束时返回None
+	def read_message(self):
+		length = None
+		while True:
+			line = self.reader.readline()
+			if not line:
+				return None
+
+			line = line.strip()
+			if not line:
+				if length is None: continue
+				break
+
+			name, _, value = line.decode("ascii").partition(":")
+			if name.strip().lower() == "content-length":
+				length = int(value.strip())
+
+		body = self.reader.read(length)
+		try:
+			return json.loads(body.decode("utf-8"))
+		except ValueError as e:
+			print("invalid message:", e)
+			self.send({"jsonrpc" : "2.0", "id" : None, "error" : {"code" : PARSE_ERROR, "message" : str(e)}})
+			return {}
+
+	def send(self, message):
+		body = json.dumps(message, separators = (",", ":")).encode("utf-8")
+		with self.write_lock:
+			self.writer.write(("Content-Length: %d\r\n\r\n" % len(body)).encode("ascii"))
+			self.writer.write(body)
+			self.writer.flush()
+
+	def handle_message(self, message):
+		method = message.get("method")
+		if method is None:
+			return # 客户端对请求的回复，服务器不会发送请求
+
+		msg_id = message.get("id")
+		params = message.get("params") or {}
+		handler = self.handlers.get(method)
+
+		if msg_id is None:
+			# 通知没有回复，错误只记录到日志
+			if handler is None or (not self.initialized and method != "exit"):
+				return
+			try:
+				handler(self, params)
+			except Exception:
+				traceback.print_exc()
+			return
+
+		response = {"jsonrpc" : "2.0", "id" : msg_id}
+		try:
+			if handler is None:
+				raise LspError(METHOD_NOT_FOUND, "method not found: %s" % method)
+			if not self.initialized and method != "initialize":
+				raise LspError(SERVER_NOT_INITIALIZED, "server not initialized")
+			if self.shutdown_requested:
+				raise LspError(INVALID_REQUEST, "server is shutting down")
+
+			response["result"] = handler(self, params)
+		except LspError as e:
+			response["error"] = {"code" : e.code, "message" : e.message}
+		except Exception as e:
+			traceback.print_exc()
+			response["error"] = {"code" : INTERNAL_ERROR, "message" : "%s: %s" % (type(e).__name__, e)}
+
+		self.send(response)
+
+	#########################################################################
+	# 生命周期
+
+	def on_initialize(self, params):
+		encodings = ((params.get("capabilities") or {}).get("general") or {}).get("positionEncodings") or ()
+		if "utf-32" in encodings:
+			self.position_encoding = "utf-32"
+
+		folders = params.get("workspaceFolders")
+		if folders:
+			roots = [uri_to_path(folder["uri"]) for folder in folders]
+		elif params.get("rootUri"):
+			roots = [uri_to_path(params["rootUri"])]
+		elif params.get("rootPath"):
+			roots = [os.path.normpath(params["rootPath"])]
+		else:
+			roots = []
+
+		self.set_project_paths(roots)
+		self.initialized = True
+
+		return {
+			"capabilities" : {
+				"positionEncoding" : self.position_encoding,
+				"textDocumentSync" : {
+					"openClose" : True,
+					"change" : SYNC_INCREMENTAL,
+					"save" : {"includeText" : False},
+				},
+				"completionProvider" : {
+					"triggerCharacters" : [".", ":", "\"", "'"],
+				},
+				"workspaceSymbolProvider" : True,
+				"workspace" : {
+					"workspaceFolders" : {"supported" : True, "changeNotifications" : True},
+				},
+			},
+			"serverInfo" : {"name" : "LuaAutocomplete"},
+		}
+
+	def on_initialized(self, params):
+		pass
+
+	def on_shutdown(self, params):
+		self.shutdown_requested = True
+		return None
+
+	def on_exit(self, params):
+		self.running = False
+
+	# 工程在后台开始索引，索引完成之前的补全只能得到部分结果
+	def set_project_paths(self, roots):
+		roots = [root for root in roots if os.path.isdir(root)]
+		for project_path in self.project_paths.paths:
+			if project_path not in roots:
+				proj_indexer = indexer.PROJECT_DATAS.pop(project_path, None)
+				if proj_indexer is not None:
+					proj_indexer.stop_watching()
+
+		self.project_paths = indexer.ProjectPaths(roots)
+		for project_path in roots:
+			indexer.get_or_load_project_indexer(project_path)
+
+	def on_did_change_workspace_folders(self, params):
+		event = params.get("event") or {}
+		removed = set(uri_to_path(folder["uri"]) for folder in event.get("removed", ()))
+		roots = [path for path in self.project_paths.paths if path not in removed]
+		roots.extend(uri_to_path(folder["uri"]) for folder in event.get("added", ()))
+		self.set_project_paths(roots)
+
+	#########################################################################
+	# 文档同步
+
+	def on_did_open(self, params):
+		item = params["textDocument"]
+		document = Document(item["uri"], item["text"], item.get("version"))
+		self.documents[item["uri"]] = document
+
+		# 懒索引的工程在后台索引这个文件require的模块
+		if document.file_path.endswith(".lua"):
+			project_path = self.project_paths.find(document.file_path)
+			if project_path is not None:
+				indexer.prefetch_requires(project_path, item["text"])
+
+	def on_did_change(self, params):
+		document = self.documents.get(params["textDocument"]["uri"])
+		if document is None:
+			return
+
+		for change in params["contentChanges"]:
+			document.apply_change(change, self.position_encoding)
+		document.version = params["textDocument"].get("version")
+
+	def on_did_save(self, params):
+		self.reindex_file(uri_to_path(params["textDocument"]["uri"]))
+
+	# 关闭之后没有保存的修改被丢弃，索引重新使用磁盘上的文件
+	def on_did_close(self, params):
+		uri = params["textDocument"]["uri"]
+		document = self.documents.pop(uri, None)
+		self.finders.pop(uri, None)
+		indexer.clear_file_indexer(uri)
+		lexer.clear_view_stream(uri)
+
+		if document is not None:
+			self.reindex_file(document.file_path)
+
+	def reindex_file(self, file_path):
+		if not file_path.endswith(".lua") or not os.path.exists(file_path):
+			return
+
+		proj_indexer = self.find_project_indexer(file_path)
+		if proj_indexer is not None:
+			proj_indexer.parse_file(file_path)
+
+	#########################################################################
+	# 补全
+
+	def find_project_indexer(self, file_path, content = None):
+		project_path = self.project_paths.find(file_path)
+		if project_path is None:
+			return None
+
+		# 只有第一次加载工程时才需要按require排列索引的顺序
+		priority_modules = None
+		if content is not None and project_path not in indexer.PROJECT_DATAS:
+			priority_modules = indexer.find_requires(content)
+		return indexer.get_or_load_project_indexer(project_path, priority_modules)
+
+	def on_completion(self, params):
+		document = self.documents.get(params["textDocument"]["uri"])
+		if document is None or not document.file_path.endswith(".lua"):
+			return None
+
+		line, column = document.get_position(params["position"], self.position_encoding)
+		with metrics.Request("lsp.completion", document.file_path, (line, column)):
+			completions, incomplete = self.complete(document, line, column)
+
+			with metrics.phase("convert"):
+				items = [to_completion_item(completion) for completion in completions]
+		return {"isIncomplete" : incomplete, "items" : items}
+
+	# 返回 (sublime格式的补全列表, 是否被截断)
+	def complete(self, document, line, column):
+		before = document.lines[line][:column]
+
+		match = require_prefix_pattern.search(before)
+		if match:
+			return self.complete_require(match.group(1).split(".")), False
+
+		content = document.get_text()
+		proj_indexer = self.find_project_indexer(document.file_path, content)
+		limits = proj_indexer.parse_limits if proj_indexer is not None else indexer.DEFAULT_PARSE_LIMITS
+
+		with metrics.phase("lex"):
+			stream = lexer.get_view_stream(document.uri, document.change_count, content, limits.max_line_length)
+			if stream.in_literal(line, column):
+				return [], False
+
+		location = document.get_offset(line, column)
+
+		word = index_word_pattern.search(before).group()
+		first_name = indexer.get_index_name(word)
+		if first_name is not None:
+			return self.complete_member(document, proj_indexer, first_name, re.split(r"[.:]", word)[-1], location, content)
+
+		# 与插件相同，xxx.之外的位置补全局部变量
+		prefix = word_prefix_pattern.search(before).group()
+		if prefix[:1].isdigit() or before[:len(before) - len(prefix)].endswith((".", ":")):
+			return [], False
+
+		finder = self.finders.get(document.uri)
+		if finder is None or finder.stream is not stream:
+			finder = IncrementalLocalsFinder(stream = stream)
+			self.finders[document.uri] = finder
+
+		finder.time_budget = limits.time_budget_ms / 1000.0 if limits.time_budget_ms else None
+		with metrics.phase("locals"):
+			varz = finder.run(location)
+
+		if finder.partial:
+			metrics.increment("lsp.completion.partial")
+
+		with metrics.phase("filter"):
+			completions = indexer.filter_completions([(name + "\t" + data.vartype, name) for name, data in varz.items()], prefix)
+		return completions, finder.partial or len(completions) >= indexer.MAX_COMPLETIONS
+
+	def complete_require(self, module_path):
+		completions = []
+		for project_path in self.project_paths.paths:
+			proj_indexer = indexer.get_or_load_project_indexer(project_path)
+			completions.extend(proj_indexer.get_module_children(module_path[:-1]))
+		return completions
+
+	def complete_member(self, document, proj_indexer, first_name, prefix, location, content):
+		if first_name in indexer.BUILTIN_MODULES:
+			return indexer.filter_completions(indexer.index_builtin(first_name), prefix), False
+
+		if proj_indexer is None:
+			return [], False
+
+		with metrics.phase("update_file"):
+			file_indexer = indexer.get_file_indexer(document.uri, document.change_count, document.file_path,
+				proj_indexer, content, location)
+		if file_indexer is None:
+			return [], False
+
+		with metrics.phase("index_value"):
+			result = file_indexer.index_value(first_name, prefix)
+		if result is None:
+			return [], False
+
+		completions = result[0]
+		return completions, file_indexer.pending or len(completions) >= proj_indexer.max_completions
+
+	#########################################################################
+	# 工程
+
+	# 在所有工程中按名字搜索符号（子串、子序列，忽略大小写），位置是符号定义所在的行
+	def on_workspace_symbol(self, params):
+		with metrics.Request("lsp.workspace_symbol"):
+			locations = indexer.search_symbols(params.get("query", ""), MAX_WORKSPACE_SYMBOLS, self.project_paths.paths)
+
+		ret = []
+		for location in locations:
+			position = {"line" : location.line, "character" : 0}
+			ret.append({
+				"name" : location.name,
+				"kind" : symbol_kind(location),
+				"containerName" : location.container,
+				"location" : {"uri" : path_to_uri(location.file_path), "range" : {"start" : position, "end" : position}},
+			})
+		return ret
+
+	def on_status(self, params):
+		projects = []
+		for project_path in self.project_paths.paths:
+			proj_indexer = indexer.PROJECT_DATAS.get(project_path)
+			if proj_indexer is None: continue
+
+			projects.append({
+				"path" : project_path,
+				"indexing" : proj_indexer.is_indexing(),
+				"files" : proj_indexer.get_file_count(),
+			})
+
+		return {
+			"projects" : projects,
+			"documents" : sorted(self.documents.keys()),
+			"metrics" : metrics.snapshot(),
+		}
+
+	handlers = {
+		"initialize" : on_initialize,
+		"initialized" : on_initialized,
+		"shutdown" : on_shutdown,
+		"exit" : on_exit,
+		"workspace/didChangeWorkspaceFolders" : on_did_change_workspace_folders,
+		"textDocument/didOpen" : on_did_open,
+		"textDocument/didChange" : on_did_change,
+		"textDocument/didSave" : on_did_save,
+		"textDocument/didClose" : on_did_close,
+		"textDocument/completion" : on_completion,
+		"workspace/symbol" : on_workspace_symbol,
+		"luaAutocomplete/status" : on_status,
+	}
+
+def symbol_kind(location):
+	if location.kind == "module":
+		return SYMBOL_MODULE
+	if location.kind == "class":
+		return SYMBOL_CLASS
+
+	# 类成员的container是类的全名，模块中的全局符号的container就是模块
+	is_member = location.container != location.module
+	if location.kind == "function":
+		return SYMBOL_METHOD if is_member else SYMBOL_FUNCTION
+	return SYMBOL_FIELD if is_member else SYMBOL_VARIABLE
+
+def main():
+	# 索引过程中的日志（包括子进程的输出）都写到stderr，stdout只用于协议
+	writer = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+	os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+	server = Server(sys.stdin.buffer, writer)
+	return server.run()
+
+if __name__ == "__main__":
+	sys.exit(main())
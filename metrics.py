@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# 性能统计：计数器、耗时直方图和慢查询日志。
+# 补全请求用Request记录每个阶段的耗时，同一个线程中调用phase时会自动记录到当前的请求中。
+import time
+import threading
+from collections import deque
+
+# 每个直方图保留的最近样本数
+HISTOGRAM_SAMPLES = 1000
+
+# 慢查询日志保留的条数
+SLOW_QUERY_LOG_SIZE = 100
+
+# 超过这个时间（毫秒）的请求会被记录到慢查询日志中。可以在配置文件中用SLOW_QUERY_MS修改
+slow_query_ms = 100.0
+
+lock = threading.Lock()
+counters = {}
+histograms = {}
+slow_queries = deque(maxlen = SLOW_QUERY_LOG_SIZE)
+
+# 当前线程正在处理的请求
+current = threading.local()
+
+now = time.perf_counter
+
+# 耗时直方图，只保留最近的样本用于计算百分位数
+class Histogram(object):
+	def __init__(self):
+		self.samples = deque(maxlen = HISTOGRAM_SAMPLES)
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def add(self, value):
+		self.samples.append(value)
+		self.count += 1
+		self.total += value
+		self.max = max(self.max, value)
+
+	def percentile(self, p):
+		if not self.samples:
+			return 0.0
+
+		samples = sorted(self.samples)
+		index = min(len(samples) - 1, int(len(samples) * p / 100.0))
+		return samples[index]
+
+	def summary(self):
+		return {
+			"count" : self.count,
+			"mean" : self.total / self.count if self.count else 0.0,
+			"p50" : self.percentile(50),
+			"p95" : self.percentile(95),
+			"p99" : self.percentile(99),
+			"max" : self.max,
+		}
+
+def increment(name, value = 1):
+	with lock:
+		counters[name] = counters.get(name, 0) + value
+
+# 记录缓存是否命中，生成 name.hit 和 name.miss 两个计数器
+def cache_access(name, hit):
+	increment(name + (".hit" if hit else ".miss"))
+
+def record(name, ms):
+	with lock:
+		histogram = histograms.get(name)
+		if histogram is None:
+			histogram = histograms[name] = Histogram()
+		histogram.add(ms)
+
+# 只保留最后一次的值，例如索引速度
+def set_gauge(name, value):
+	with lock:
+		counters[name] = value
+
+def set_slow_query_threshold(ms):
+	global slow_query_ms
+	slow_query_ms = float(ms)
+
+def reset():
+	with lock:
+		counters.clear()
+		histograms.clear()
+		slow_queries.clear()
+
+# 一次补全请求。记录总耗时和每个阶段的耗时，总耗时超过阈值时写入慢查询日志
+class Request(object):
+	def __init__(self, name, file_path = None, location = None):
+		self.name = name
+		self.file_path = file_path
+		self.location = location
+		self.phases = []
+		self.start = now()
+
+	def __enter__(self):
+		self.parent = getattr(current, "request", None)
+		current.request = self
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		current.request = self.parent
+
+		elapsed = (now() - self.start) * 1000.0
+		record(self.name, elapsed)
+		if elapsed >= slow_query_ms:
+			self.log_slow_query(elapsed)
+		return False
+
+	def add_phase(self, name, ms):
+		self.phases.append((name, ms))
+		record(self.name + "." + name, ms)
+
+	def log_slow_query(self, elapsed):
+		entry = {
+			"time" : time.time(),
+			"request" : self.name,
+			"file" : self.file_path,
+			"location" : self.location,
+			"ms" : elapsed,
+			"phases" : list(self.phases),
+		}
+		with lock:
+			slow_queries.append(entry)
+
+		print("slow %s: %.1fms %s:%s %s" % (self.name, elapsed, self.file_path, self.location,
+			", ".join("%s=%.1fms" % phase for phase in self.phases)))
+
+# 记录一个阶段的耗时。在请求中时记录为请求的阶段，否则记录为独立的直方图
+def phase(name):
+	return Phase(name)
+
+class Phase(object):
+	def __init__(self, name):
+		self.name = name
+
+	def __enter__(self):
+		self.start = now()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		elapsed = (now() - self.start) * 1000.0
+		request = getattr(current, "request", None)
+		if request is not None:
+			request.add_phase(self.name, elapsed)
+		else:
+			record(self.name, elapsed)
+		return False
+
+def snapshot():
+	with lock:
+		return {
+			"counters" : dict(counters),
+			"histograms" : dict((name, histogram.summary()) for name, histogram in histograms.items()),
+			"slow_queries" : list(slow_queries),
+		}
+
+# 生成可读的统计报告
+def format_report():
+	datas = snapshot()
+	lines = ["LuaAutocomplete metrics", ""]
+
+	lines.append("%-44s %8s %9s %9s %9s %9s %9s" % ("timing (ms)", "count", "mean", "p50", "p95", "p99", "max"))
+	for name, s in sorted(datas["histograms"].items()):
+		lines.append("%-44s %8d %9.2f %9.2f %9.2f %9.2f %9.2f" % (name, s["count"], s["mean"], s["p50"], s["p95"], s["p99"], s["max"]))
+
+	lines.append("")
+	lines.append("cache hit rates")
+	counters = datas["counters"]
+	caches = sorted(set(name[:-4] for name in counters if name.endswith(".hit")) |
+		set(name[:-5] for name in counters if name.endswith(".miss")))
+	for name in caches:
+		hit = counters.get(name + ".hit", 0)
+		miss = counters.get(name + ".miss", 0)
+		lines.append("%-44s %6.1f%% (%d/%d)" % (name, 100.0 * hit / max(1, hit + miss), hit, hit + miss))
+
+	lines.append("")
+	lines.append("counters")
+	for name, value in sorted(counters.items()):
+		if name.endswith(".hit") or name.endswith(".miss"): continue
+		if isinstance(value, float):
+			lines.append("%-44s %.1f" % (name, value))
+		else:
+			lines.append("%-44s %d" % (name, value))
+
+	lines.append("")
+	lines.append("slow queries (>= %.0fms)" % slow_query_ms)
+	for entry in datas["slow_queries"]:
+		lines.append("%s %.1fms %s:%s" % (entry["request"], entry["ms"], entry["file"], entry["location"]))
+		for name, ms in entry["phases"]:
+			lines.append("    %-40s %9.2f" % (name, ms))
+
+	return "\n".join(lines) + "\n"
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# 在后台线程中重新解析正在编辑的buffer。修改停止一段时间之后才开始解析，解析过程中buffer又被修改时放弃这次解析。
+# 解析分成很多小段执行，每一段持有buffer的锁，补全请求在两段之间取得锁，读取最近一次解析好的结果。
+import time
+import threading
+import traceback
+
+# 每一段解析的时间（秒）。补全请求最多等待这么长时间
+SLICE_SECONDS = 0.01
+
+class Reparser(object):
+	def __init__(self):
+		# 等待执行的任务。buffer的key : (修改的时间, 延迟, 任务)。同一个buffer只保留最新的任务
+		self.jobs = {}
+
+		# 每个buffer的锁，保护token流、FileIndexer和LocalsFinder
+		self.locks = {}
+
+		# 每个buffer最近一次完整解析的版本。buffer的key : change_count
+		self.versions = {}
+
+		self.condition = threading.Condition()
+		self.thread = None
+		self.stopped = False
+
+	# 安排在delay秒之后执行job(cancelled)。在这之前再次调用时，之前的任务被替换，重新计时。
+	# 任务执行时，cancelled()返回True表示又有了新的任务（buffer又被修改过），应该尽快返回
+	def schedule(self, key, delay, job):
+		with self.condition:
+			if self.stopped:
+				return
+
+			self.jobs[key] = (time.time(), delay, job)
+			if self.thread is None:
+				self.thread = threading.Thread(target = self.run)
+				self.thread.daemon = True
+				self.thread.start()
+			self.condition.notify()
+
+	def get_lock(self, key):
+		with self.condition:
+			lock = self.locks.get(key)
+			if lock is None:
+				lock = self.locks[key] = threading.RLock()
+			return lock
+
+	def get_version(self, key):
+		return self.versions.get(key)
+
+	def set_version(self, key, version):
+		self.versions[key] = version
+
+	# buffer关闭时调用，丢弃等待中的任务
+	def forget(self, key):
+		with self.condition:
+			self.jobs.pop(key, None)
+			self.locks.pop(key, None)
+			self.versions.pop(key, None)
+
+	def stop(self):
+		with self.condition:
+			self.stopped = True
+			self.jobs.clear()
+			self.condition.notify()
+
+	def run(self):
+		while True:
+			with self.condition:
+				key, job = self.wait_job()
+				if job is None:
+					self.thread = None
+					return
+
+			cancelled = lambda: key in self.jobs or self.stopped
+			try:
+				job(cancelled)
+			except Exception:
+				traceback.print_exc()
+
+	# 等待到有任务的延迟时间已经过去，返回最早到期的任务。停止时返回 (None, None)
+	def wait_job(self):
+		while not self.stopped:
+			now = time.time()
+			due = None
+			for key, (start, delay, job) in self.jobs.items():
+				if due is None or start + delay < due[0]:
+					due = (start + delay, key)
+
+			if due is None:
+				self.condition.wait()
+			elif due[0] > now:
+				self.condition.wait(due[0] - now)
+			else:
+				key = due[1]
+				return key, self.jobs.pop(key)[2]
+
+		return None, None
+
+REPARSER = Reparser()
@@ -0,0 +1,540 @@
+# -*- coding: utf-8 -*-
+# 保存在本地SQLite数据库中的工程索引，用于有几十万个lua文件的大型工程（配置INDEX_STORAGE = "sqlite"）。
+# 符号、类的基类和require关系都写入数据库，按符号表名、类名、基类和符号名建立索引；内存中只保留最近用到的符号表和类，
+# 以及打开的buffer的解析结果（它们比磁盘上的内容新，优先使用）。
+# 对外的接口与ProjectIndexer相同，FileIndexer的index_module和index_class_by_cname不需要知道索引保存在哪里。
+# 数据库本身也是索引缓存，再次加载工程时只重新解析修改时间或大小变化的文件。
+import os
+import hashlib
+from sys import intern
+from LuaAutocomplete import metrics
+from LuaAutocomplete.indexer import ProjectIndexer, LRUCache, SymbolLocation, PARSE_CACHE, CACHE_VERSION, MAX_CHAR, KIND_NAMES, \
+	make_symbol, intern_symbols, get_result_names, is_subsequence, is_entry_valid, sort_files_by_priority, get_cache_path
+
+# sublime自带的python在部分平台上没有sqlite3模块，这时create_project_indexer仍然使用内存中的索引
+try:
+	import sqlite3
+except ImportError:
+	sqlite3 = None
+
+# 数据库格式的版本号。格式有变化时需要增加，旧的数据库会被重建
+SCHEMA_VERSION = 1
+
+# 内存中保存的符号表和类的数量（热数据）
+HOT_CACHE_SIZE = 4096
+
+# 缓存的require补全结果数量
+MODULE_CHILDREN_CACHE_SIZE = 256
+
+# 生成索引时每写入这么多个文件提交一次。索引过程中的补全读取的是同一个连接，不需要等待提交
+BATCH_FILES = 500
+
+# files: 所有的.lua和.luac文件。mtime为NULL的是只用于require补全的.luac文件；seq越大的文件，定义的同名符号表和类越优先
+# symbols: 每个文件定义的符号表。name为NULL的行表示文件定义了这个符号表（可能是空表）
+# bases: 每个文件定义的类的基类。base为NULL的行表示文件定义了这个类（可能没有基类）
+# requires: 每个文件require的模块
+# names: 所有不同的符号名和模块名，用于按名字搜索。name使用NOCASE排序，LIKE 'xxx%' 可以使用索引
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+
+CREATE TABLE files (id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE, module TEXT NOT NULL, name TEXT NOT NULL,
+	mtime REAL, size INTEGER, seq INTEGER NOT NULL);
+CREATE INDEX files_module ON files (module);
+CREATE INDEX files_name ON files (name);
+
+CREATE TABLE symbols (file_id INTEGER NOT NULL, tbl TEXT NOT NULL, name TEXT, kind INTEGER, args TEXT, line INTEGER);
+CREATE INDEX symbols_tbl ON symbols (tbl);
+CREATE INDEX symbols_name ON symbols (name);
+CREATE INDEX symbols_file ON symbols (file_id);
+
+CREATE TABLE bases (file_id INTEGER NOT NULL, cname TEXT NOT NULL, base TEXT, pos INTEGER NOT NULL);
+CREATE INDEX bases_cname ON bases (cname);
+CREATE INDEX bases_base ON bases (base);
+CREATE INDEX bases_file ON bases (file_id);
+
+CREATE TABLE requires (file_id INTEGER NOT NULL, alias TEXT NOT NULL, path TEXT NOT NULL);
+CREATE INDEX requires_path ON requires (path);
+CREATE INDEX requires_file ON requires (file_id);
+
+CREATE TABLE names (name TEXT NOT NULL COLLATE NOCASE);
+CREATE UNIQUE INDEX names_name ON names (name COLLATE BINARY);
+CREATE INDEX names_nocase ON names (name);
+"""
+
+# 收集文件时代替模块树，记录所有的.lua和.luac文件。文件路径 : 模块名
+class CollectedModules(dict):
+	def add(self, module_name, file_path):
+		self[file_path] = module_name
+
+# LIKE的参数，query中的 % _ \ 按字面匹配
+def escape_like(query):
+	return query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+class SqliteProjectIndexer(ProjectIndexer):
+	def __init__(self, project_path, config_file = None):
+		super(SqliteProjectIndexer, self).__init__(project_path, config_file)
+
+		# 从数据库读出的符号表和类。名字 : (版本号, 符号表或类，没有时为None)
+		self.hot_tables = LRUCache(HOT_CACHE_SIZE)
+		self.hot_classes = LRUCache(HOT_CACHE_SIZE)
+
+		# require补全的结果。模块路径 : 补全列表。files表有增减时清空
+		self.module_children = LRUCache(MODULE_CHILDREN_CACHE_SIZE)
+
+		# 生成索引的过程中为True。这时不逐个计算失效的名字，每次提交时让所有从数据库读出的结果失效
+		self.loading = False
+		self.batch_generation = 0
+		self.pending_writes = 0
+
+		self.db_file = self.get_database_file()
+		self.db = self.open_database()
+		self.next_seq = (self.db.execute("SELECT MAX(seq) FROM files").fetchone()[0] or 0) + 1
+
+	def parse_config(self):
+		super(SqliteProjectIndexer, self).parse_config()
+
+		# 数据库就是完整的索引缓存，再次加载时只检查文件的修改时间，不需要懒索引
+		if self.lazy_index:
+			print("LAZY_INDEX is ignored with INDEX_STORAGE = sqlite")
+			self.lazy_index = False
+
+	def get_database_file(self):
+		name = hashlib.md5(self.project_path.encode("utf-8")).hexdigest()
+		return os.path.join(get_cache_path(), "LuaAutocomplete", name + ".sqlite3")
+
+	# 打开数据库。版本不同或者文件损坏时重建
+	def open_database(self):
+		dir_path = os.path.dirname(self.db_file)
+		if not os.path.isdir(dir_path):
+			os.makedirs(dir_path)
+
+		version = "%d.%d" % (SCHEMA_VERSION, CACHE_VERSION)
+		if os.path.exists(self.db_file):
+			try:
+				db = self.connect()
+				row = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+				if row is not None and row[0] == version:
+					return db
+				db.close()
+				print("rebuild index database", self.db_file)
+			except sqlite3.DatabaseError as e:
+				print("rebuild index database", self.db_file, e)
+
+		for suffix in ("", "-wal", "-shm"):
+			if os.path.exists(self.db_file + suffix):
+				os.remove(self.db_file + suffix)
+
+		db = self.connect()
+		db.executescript(SCHEMA)
+		db.executemany("INSERT INTO meta (key, value) VALUES (?, ?)", (("version", version), ("project", self.project_path)))
+		db.commit()
+		return db
+
+	# 后台索引线程、监视线程和主线程共用一个连接，所有的访问都在self.lock之内
+	def connect(self):
+		db = sqlite3.connect(self.db_file, timeout = 10, check_same_thread = False)
+		db.execute("PRAGMA journal_mode = WAL")
+		db.execute("PRAGMA synchronous = NORMAL")
+		return db
+
+	def save_cache(self):
+		with self.lock:
+			self.commit()
+
+	def commit(self):
+		self.db.commit()
+		self.pending_writes = 0
+		if self.loading:
+			self.batch_generation += 1
+
+	def load_cache(self):
+		return {}
+
+	def generate_indices(self, priority_modules = None, progress = None):
+		start = metrics.now()
+
+		modules = CollectedModules()
+		files = []
+		for path in self.lua_paths:
+			files.extend(self.collect_files(path, modules))
+
+		with self.lock:
+			if not self.use_cache:
+				for table in ("files", "symbols", "bases", "requires", "names"):
+					self.db.execute("DELETE FROM %s" % table)
+
+			# 文件路径 : (模块名, 修改时间, 大小)
+			stored = dict((row[0], row[1:]) for row in self.db.execute("SELECT path, module, mtime, size FROM files"))
+			self.loading = True
+
+		try:
+			with self.lock:
+				for file_path in stored:
+					if file_path not in modules:
+						self.delete_file(file_path)
+
+				# .luac文件只用于require补全，不解析
+				for file_path, module_name in modules.items():
+					if not file_path.endswith(".lua") and stored.get(file_path, (None, ))[0] != module_name:
+						self.write_module(file_path, module_name)
+
+			total = len(files)
+			count = 0
+			prebuilt_entries = None
+			prebuilt = 0
+
+			pending = []
+			for file_path, module_name in sort_files_by_priority(files, priority_modules):
+				row = stored.get(file_path)
+				if row is not None and is_entry_valid({"module" : row[0], "mtime" : row[1], "size" : row[2]}, file_path, module_name):
+					count += 1
+					continue
+
+				if prebuilt_entries is None:
+					prebuilt_entries = self.load_prebuilt_index()
+
+				entry = self.find_prebuilt_entry(prebuilt_entries, file_path, module_name)
+				if entry is None:
+					pending.append((file_path, module_name))
+					continue
+
+				prebuilt += 1
+				entry["symbols"] = intern_symbols(entry["symbols"])
+				self.add_file_entry(file_path, entry)
+				count += 1
+
+			parse_start = metrics.now()
+			shallow = 0
+			shared = 0
+			for file_path, entry in self.parse_files(pending):
+				if entry is not None:
+					if entry.get("shared"):
+						shared += 1
+					self.add_file_entry(file_path, entry)
+					if entry.get("shallow"):
+						shallow += 1
+				elif file_path in stored:
+					with self.lock:
+						self.delete_file(file_path)
+
+				count += 1
+				if progress is not None and count < total:
+					progress(count, total)
+
+			parse_elapsed = metrics.now() - parse_start
+
+			# 按照文件顺序重新编号，保证多个文件定义同一个名字时，结果与解析顺序无关
+			with self.lock:
+				seqs = dict(self.db.execute("SELECT path, seq FROM files WHERE mtime IS NOT NULL"))
+				updates = [(i + 1, file_path) for i, (file_path, _) in enumerate(files) if seqs.get(file_path, i + 1) != i + 1]
+				self.db.executemany("UPDATE files SET seq = ? WHERE path = ?", updates)
+				self.next_seq = len(files) + 1
+				self.commit()
+		finally:
+			with self.lock:
+				self.loading = False
+				self.batch_generation += 1
+				self.hot_tables.clear()
+				self.hot_classes.clear()
+
+		if progress is not None:
+			progress(total, total)
+
+		if self.use_cache:
+			PARSE_CACHE.prune()
+
+		metrics.record("index.generate_indices", (metrics.now() - start) * 1000.0)
+		metrics.increment("index.files_cached", total - len(pending) - prebuilt)
+		metrics.increment("index.files_prebuilt", prebuilt)
+		metrics.increment("index.files_shared", shared)
+		metrics.increment("index.files_parsed", len(pending) - shared)
+		metrics.increment("index.files_shallow", shallow)
+		if len(pending) > shared and parse_elapsed > 0:
+			metrics.set_gauge("index.files_parsed_per_second", (len(pending) - shared) / parse_elapsed)
+		return
+
+	# 磁盘上的解析结果写入数据库。打开的buffer之前合并的结果被丢弃，与ProjectIndexer中磁盘的结果替换buffer的结果相同
+	def add_file_entry(self, file_path, entry):
+		entry.pop("shared", None)
+		with self.lock:
+			result = self.file_results.pop(file_path, None)
+			if result is not None:
+				self.remove_file_result(result, file_path)
+				self.update_symbol_files(file_path, result, None)
+
+			changed = self.write_file(file_path, entry)
+			if self.loading:
+				self.pending_writes += 1
+				if self.pending_writes >= BATCH_FILES:
+					self.commit()
+			else:
+				self.invalidate(changed)
+
+	def remove_file(self, file_path):
+		with self.lock:
+			super(SqliteProjectIndexer, self).remove_file(file_path)
+			self.invalidate(self.delete_file(file_path))
+
+	# 在保存的文件被重新索引之后提交
+	def parse_file(self, file_path):
+		entry = super(SqliteProjectIndexer, self).parse_file(file_path)
+		self.save_cache()
+		return entry
+
+	# 把一个文件的解析结果写入数据库，替换这个文件之前的结果。返回内容可能有变化的符号表名和类名
+	def write_file(self, file_path, entry):
+		db = self.db
+		module_name = entry["module"]
+		values = (module_name, module_name.rpartition(".")[2], entry["mtime"], entry["size"], self.next_seq)
+		self.next_seq += 1
+
+		changed = set()
+		old_names = frozenset()
+		row = db.execute("SELECT id FROM files WHERE path = ?", (file_path, )).fetchone()
+		if row is None:
+			file_id = db.execute("INSERT INTO files (module, name, mtime, size, seq, path) VALUES (?, ?, ?, ?, ?, ?)",
+				values + (file_path, )).lastrowid
+		else:
+			file_id = row[0]
+			changed = self.get_file_tables(file_id)
+			old_names = self.get_file_names(file_id)
+			self.delete_rows(file_id)
+			db.execute("UPDATE files SET module = ?, name = ?, mtime = ?, size = ?, seq = ? WHERE id = ?", values + (file_id, ))
+		self.module_children.clear()
+
+		rows = []
+		lines = entry.get("lines", {})
+		for table_name, table in entry["symbols"].items():
+			rows.append((file_id, table_name, None, None, None, None))
+			table_lines = lines.get(table_name, {})
+			for name, symbol in table.items():
+				rows.append((file_id, table_name, name, symbol.kind, symbol.args, table_lines.get(name, 0)))
+		db.executemany("INSERT INTO symbols (file_id, tbl, name, kind, args, line) VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+		rows = []
+		for cname, bases in entry["classes"].items():
+			rows.append((file_id, cname, None, -1))
+			rows.extend((file_id, cname, base, i) for i, base in enumerate(bases))
+		db.executemany("INSERT INTO bases (file_id, cname, base, pos) VALUES (?, ?, ?, ?)", rows)
+
+		db.executemany("INSERT INTO requires (file_id, alias, path) VALUES (?, ?, ?)",
+			((file_id, alias, path) for alias, path in entry["requires"].items()))
+
+		new_names = get_result_names(entry)
+		db.executemany("INSERT OR IGNORE INTO names (name) VALUES (?)", ((name, ) for name in new_names - old_names))
+		self.prune_names(old_names - new_names)
+
+		changed.update(entry["symbols"].keys())
+		changed.update(entry["classes"].keys())
+		return changed
+
+	# 只用于require补全的模块文件
+	def write_module(self, file_path, module_name):
+		self.db.execute("DELETE FROM files WHERE path = ?", (file_path, ))
+		self.db.execute("INSERT INTO files (path, module, name, seq) VALUES (?, ?, ?, 0)", (file_path, module_name, module_name.rpartition(".")[2]))
+		self.module_children.clear()
+
+	# 删除文件的所有结果，返回它定义的符号表名和类名
+	def delete_file(self, file_path):
+		row = self.db.execute("SELECT id FROM files WHERE path = ?", (file_path, )).fetchone()
+		if row is None:
+			return set()
+
+		file_id = row[0]
+		changed = self.get_file_tables(file_id)
+		old_names = self.get_file_names(file_id)
+		self.delete_rows(file_id)
+		self.db.execute("DELETE FROM files WHERE id = ?", (file_id, ))
+		self.prune_names(old_names)
+		self.module_children.clear()
+		return changed
+
+	def delete_rows(self, file_id):
+		for table in ("symbols", "bases", "requires"):
+			self.db.execute("DELETE FROM %s WHERE file_id = ?" % table, (file_id, ))
+
+	def get_file_tables(self, file_id):
+		tables = set(row[0] for row in self.db.execute("SELECT DISTINCT tbl FROM symbols WHERE file_id = ?", (file_id, )))
+		tables.update(row[0] for row in self.db.execute("SELECT DISTINCT cname FROM bases WHERE file_id = ?", (file_id, )))
+		return tables
+
+	# 与get_result_names相同：文件中所有的符号名，以及模块名的最后一部分
+	def get_file_names(self, file_id):
+		db = self.db
+		names = set(row[0] for row in db.execute("SELECT DISTINCT name FROM symbols WHERE file_id = ? AND name IS NOT NULL", (file_id, )))
+		row = db.execute("SELECT name FROM files WHERE id = ? AND mtime IS NOT NULL", (file_id, )).fetchone()
+		if row is not None:
+			names.add(row[0])
+		return names
+
+	# 删除已经没有任何文件定义的名字
+	def prune_names(self, names):
+		db = self.db
+		for name in names:
+			if db.execute("SELECT 1 FROM symbols WHERE name = ? LIMIT 1", (name, )).fetchone() is not None: continue
+			if db.execute("SELECT 1 FROM files WHERE name = ? AND mtime IS NOT NULL LIMIT 1", (name, )).fetchone() is not None: continue
+			db.execute("DELETE FROM names WHERE name = ? COLLATE BINARY", (name, ))
+
+	# 生成索引的过程中，每次提交之后从数据库读出的结果都会失效
+	def get_generation(self, name):
+		return (self.generations.get(name, 0), self.batch_generation)
+
+	def get_derived_classes(self, cname):
+		with self.lock:
+			derived = set(self.derived_classes.get(cname, ()))
+			derived.update(row[0] for row in self.db.execute("SELECT DISTINCT cname FROM bases WHERE base = ?", (cname, )))
+			return derived
+
+	def get_module_dependents(self, module_name):
+		with self.lock:
+			dependents = set(self.module_dependents.get(module_name, ()))
+			dependents.update(row[0] for row in self.db.execute(
+				"SELECT DISTINCT f.module FROM requires r JOIN files f ON f.id = r.file_id WHERE r.path = ?", (module_name, )))
+			return dependents
+
+	# 打开的buffer的结果（以及_G）在self.symbols和self.classes中，优先于数据库
+	def get_symbol(self, name):
+		symbols = self.symbols.get(name)
+		if symbols is not None:
+			return symbols
+		return self.get_hot(self.hot_tables, name, self.load_table)
+
+	def get_class(self, class_name):
+		cls_info = self.classes.get(class_name)
+		if cls_info is not None:
+			return cls_info
+		return self.get_hot(self.hot_classes, class_name, self.load_class)
+
+	def is_class(self, name):
+		return self.get_class(name) is not None
+
+	def get_hot(self, cache, name, load):
+		generation = self.get_generation(name)
+		with self.lock:
+			cached = cache.get(name)
+			hit = cached is not None and cached[0] == generation
+			metrics.cache_access("sqlite.hot", hit)
+			if hit:
+				return cached[1]
+
+			value = load(name)
+			cache.put(name, (generation, value))
+			return value
+
+	# seq最大的文件定义的符号表
+	def load_table(self, name):
+		rows = self.db.execute("SELECT s.file_id, s.name, s.kind, s.args FROM symbols s JOIN files f ON f.id = s.file_id "
+			"WHERE s.tbl = ? ORDER BY f.seq", (name, )).fetchall()
+		if not rows:
+			return None
+
+		owner = rows[-1][0]
+		table = {}
+		for file_id, symbol_name, kind, args in rows:
+			if file_id == owner and symbol_name is not None:
+				table[intern(symbol_name)] = make_symbol(kind, args)
+		return table
+
+	def load_class(self, class_name):
+		rows = self.db.execute("SELECT b.file_id, b.base FROM bases b JOIN files f ON f.id = b.file_id "
+			"WHERE b.cname = ? ORDER BY f.seq, b.pos", (class_name, )).fetchall()
+		if not rows:
+			return None
+
+		owner = rows[-1][0]
+		return {".bases" : [base for file_id, base in rows if file_id == owner and base is not None]}
+
+	# require补全。模块按名字排序，每次查询跳到下一个子节点，查询次数与子节点的数量成正比，与子模块的总数无关
+	def get_module_children(self, names):
+		key = tuple(names)
+		with self.lock:
+			ret = self.module_children.get(key)
+			if ret is not None:
+				return ret
+
+			prefix = "".join(name + "." for name in names)
+			end = prefix + MAX_CHAR
+
+			# 名字 : [是否有子模块, 是否是模块]
+			children = {}
+			after = prefix
+			while True:
+				row = self.db.execute("SELECT module FROM files WHERE module > ? AND module < ? ORDER BY module LIMIT 1", (after, end)).fetchone()
+				if row is None: break
+
+				name, dot, _ = row[0][len(prefix):].partition(".")
+				flags = children.setdefault(name, [False, False])
+				if dot:
+					flags[0] = True
+					after = prefix + name + "." + MAX_CHAR
+				else:
+					flags[1] = True
+					after = row[0]
+
+			ret = []
+			for name, (has_children, has_files) in sorted(children.items()):
+				if has_children:
+					ret.append((name + "\tsubdirectory", name))
+				if has_files:
+					ret.append((name + "\tmodule", name))
+
+			self.module_children.put(key, ret)
+			return ret
+
+	# 与NameSearch的顺序相同：前缀 > 子串 > 子序列，每一组按小写排序。打开的buffer中新增的名字也在其中
+	def search_symbols(self, query, limit = 100, fuzzy = True):
+		query = query.strip().lower()
+		if "\n" in query:
+			return []
+
+		tiers = [(escape_like(query) + "%", lambda name: name.lower().startswith(query))]
+		if query:
+			tiers.append(("%" + escape_like(query) + "%", lambda name: query in name.lower()))
+			if fuzzy:
+				tiers.append(("%" + "%".join(escape_like(c) for c in query) + "%", lambda name: is_subsequence(query, name.lower())))
+
+		ret = []
+		found = set()
+		with self.lock:
+			for pattern, match in tiers:
+				names = set(name for name in self.symbol_files if match(name))
+				names.update(row[0] for row in self.db.execute("SELECT name FROM names WHERE name LIKE ? ESCAPE '\\' "
+					"ORDER BY name LIMIT ?", (pattern, limit + len(found))))
+
+				for name in sorted(names - found, key = lambda x: (x.lower(), x)):
+					found.add(name)
+					ret.extend(self.find_symbol_locations(name, limit - len(ret)))
+					if len(ret) >= limit:
+						return ret
+		return ret
+
+	def find_symbol_locations(self, name, limit = None):
+		with self.lock:
+			ret = super(SqliteProjectIndexer, self).find_symbol_locations(name, limit)
+
+			for file_path, module_name in self.db.execute("SELECT path, module FROM files WHERE name = ? AND mtime IS NOT NULL", (name, )):
+				if file_path not in self.file_results:
+					ret.append(SymbolLocation(name, "module", module_name, module_name, file_path, 0))
+
+			rows = self.db.execute("SELECT f.path, f.module, s.tbl, s.kind, s.line FROM symbols s JOIN files f ON f.id = s.file_id "
+				"WHERE s.name = ? ORDER BY f.path LIMIT ?", (name, -1 if limit is None else limit + len(ret)))
+			for file_path, module_name, table_name, kind, line in rows:
+				if file_path not in self.file_results:
+					ret.append(SymbolLocation(name, KIND_NAMES[kind], module_name, table_name, file_path, line))
+			return ret[:limit]
+
+	def get_file_snapshot(self):
+		with self.lock:
+			return dict((row[0], (row[1], row[2])) for row in self.db.execute("SELECT path, mtime, size FROM files WHERE mtime IS NOT NULL"))
+
+	def get_file_count(self):
+		with self.lock:
+			return self.db.execute("SELECT COUNT(*) FROM files WHERE mtime IS NOT NULL").fetchone()[0]
+
+	def get_debug_info(self):
+		return {
+			"database" : self.db_file,
+			"files" : self.get_file_count(),
+			"symbols" : self.symbols,
+			"classes" : self.classes,
+		}
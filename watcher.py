@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+# 监视LUA_PATHS下的文件变化（例如git checkout、代码生成工具），合并一段时间内的变化后再通知索引更新。
+# Linux下使用inotify，其他平台或者inotify不可用时，定时扫描文件的修改时间和大小。
+import os
+import sys
+import errno
+import select
+import struct
+import threading
+import time
+
+IN_MODIFY		= 0x00000002
+IN_ATTRIB		= 0x00000004
+IN_CLOSE_WRITE	= 0x00000008
+IN_MOVED_FROM	= 0x00000040
+IN_MOVED_TO		= 0x00000080
+IN_CREATE		= 0x00000100
+IN_DELETE		= 0x00000200
+IN_DELETE_SELF	= 0x00000400
+IN_MOVE_SELF	= 0x00000800
+IN_Q_OVERFLOW	= 0x00004000
+IN_IGNORED		= 0x00008000
+IN_ISDIR		= 0x40000000
+
+IN_NONBLOCK		= 0o4000
+IN_CLOEXEC		= 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+	IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT_HEADER = struct.Struct("iIII")
+
+# 持续有事件时，最多等待debounce的这么多倍就处理一次
+MAX_DEBOUNCE_FACTOR = 10
+
+# 扫描路径下所有的lua文件。返回 文件路径 : (mtime, size)
+def scan_lua_files(paths):
+	ret = {}
+	for path in paths:
+		for root, dirs, files in os.walk(path):
+			for fname in files:
+				if not fname.endswith(".lua"): continue
+
+				file_path = os.path.join(root, fname)
+				try:
+					stat = os.stat(file_path)
+				except OSError:
+					continue
+
+				ret[file_path] = (stat.st_mtime, stat.st_size)
+	return ret
+
+# 比较两次快照，返回 (新增的文件, 修改的文件, 删除的文件)
+def diff_snapshots(old, new):
+	added = []
+	modified = []
+	for file_path, value in new.items():
+		old_value = old.get(file_path)
+		if old_value is None:
+			added.append(file_path)
+		elif old_value != value:
+			modified.append(file_path)
+
+	deleted = [file_path for file_path in old.keys() if file_path not in new]
+	return sorted(added), sorted(modified), sorted(deleted)
+
+class Inotify(object):
+	@staticmethod
+	def create():
+		if not sys.platform.startswith("linux"):
+			return None
+
+		try:
+			import ctypes, ctypes.util
+			libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno = True)
+			fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		except (ImportError, OSError, AttributeError):
+			return None
+
+		if fd < 0:
+			return None
+
+		return Inotify(libc, fd)
+
+	def __init__(self, libc, fd):
+		self.libc = libc
+		self.fd = fd
+		self.paths = {} # watch descriptor : 目录
+
+	def close(self):
+		os.close(self.fd)
+
+	# 监视目录及其所有子目录。监视数量超过系统限制时返回False
+	def watch_tree(self, paths):
+		for path in paths:
+			for root, dirs, files in os.walk(path):
+				wd = self.libc.inotify_add_watch(self.fd, root.encode("utf-8"), WATCH_MASK)
+				if wd >= 0:
+					self.paths[wd] = root
+					continue
+
+				import ctypes
+				err = ctypes.get_errno()
+				if err == errno.ENOSPC or err == errno.ENOMEM:
+					print("inotify watch limit reached", root)
+					return False
+		return True
+
+	# 目录被删除或者移走之后，不再监视它和它的子目录
+	def unwatch_tree(self, path):
+		prefix = path + os.sep
+		for wd, root in list(self.paths.items()):
+			if root == path or root.startswith(prefix):
+				self.libc.inotify_rm_watch(self.fd, wd)
+				del self.paths[wd]
+
+	# 读取事件，返回 [(路径, mask), ...]。timeout秒内没有事件时返回空列表
+	def read(self, timeout):
+		readable, _, _ = select.select([self.fd], [], [], timeout)
+		if not readable:
+			return []
+
+		try:
+			data = os.read(self.fd, 64 * 1024)
+		except OSError as e:
+			if e.errno == errno.EAGAIN: return []
+			raise
+
+		events = []
+		offset = 0
+		while offset + EVENT_HEADER.size <= len(data):
+			wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+			offset += EVENT_HEADER.size
+			name = data[offset : offset + length].rstrip(b"\0").decode("utf-8", "replace")
+			offset += length
+
+			if mask & IN_IGNORED:
+				self.paths.pop(wd, None)
+				continue
+
+			root = self.paths.get(wd)
+			if mask & IN_Q_OVERFLOW or root is None:
+				events.append((None, mask))
+				continue
+
+			events.append((os.path.join(root, name) if name else root, mask))
+
+		return events
+
+class ChangeDetector(object):
+	# snapshot: 已经索引过的文件 文件路径 : (mtime, size)
+	# on_changes(added, modified, deleted) 在监视线程中被调用
+	def __init__(self, lua_paths, snapshot, on_changes, poll_interval = 10.0, debounce = 1.0):
+		self.lua_paths = list(lua_paths)
+		self.snapshot = dict(snapshot)
+		self.on_changes = on_changes
+		self.poll_interval = poll_interval
+		self.debounce = debounce
+
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target = self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		self.stopped.set()
+
+	def run(self):
+		inotify = Inotify.create()
+		try:
+			if inotify is not None and inotify.watch_tree(self.lua_paths):
+				print("watch lua files with inotify", self.lua_paths)
+				self.run_inotify(inotify)
+			else:
+				# 达到监视数量的限制时，已经添加的监视在轮询期间没有用处，关闭fd释放它们
+				if inotify is not None:
+					inotify.close()
+					inotify = None
+
+				print("watch lua files by polling", self.lua_paths)
+				self.run_polling()
+		finally:
+			if inotify is not None:
+				inotify.close()
+
+	def run_polling(self):
+		while not self.stopped.wait(self.poll_interval):
+			snapshot = scan_lua_files(self.lua_paths)
+			if snapshot == self.snapshot:
+				continue
+
+			# 等到文件不再变化之后再处理，避免索引到一半的git checkout
+			for i in range(MAX_DEBOUNCE_FACTOR):
+				if self.stopped.wait(self.debounce): return
+
+				newer = scan_lua_files(self.lua_paths)
+				if newer == snapshot: break
+				snapshot = newer
+
+			self.apply_snapshot(snapshot)
+
+	def run_inotify(self, inotify):
+		dirty = set()
+		rescan = False
+		first_event_time = None
+
+		while not self.stopped.is_set():
+			events = inotify.read(self.debounce)
+			if events:
+				for path, mask in events:
+					if path is None:
+						rescan = True
+						continue
+
+					if mask & IN_ISDIR:
+						if mask & (IN_CREATE | IN_MOVED_TO):
+							inotify.watch_tree([path])
+						elif mask & (IN_DELETE | IN_MOVED_FROM):
+							inotify.unwatch_tree(path)
+					dirty.add(path)
+
+				# 一段时间内没有新的事件之后再处理
+				if first_event_time is None:
+					first_event_time = time.time()
+				if time.time() - first_event_time < self.debounce * MAX_DEBOUNCE_FACTOR:
+					continue
+
+			first_event_time = None
+			if rescan:
+				self.apply_snapshot(scan_lua_files(self.lua_paths))
+			elif dirty:
+				self.apply_snapshot(self.update_snapshot(dirty))
+
+			dirty = set()
+			rescan = False
+
+	# 只重新检查发生变化的路径，返回新的快照
+	def update_snapshot(self, paths):
+		snapshot = dict(self.snapshot)
+		for path in paths:
+			if os.path.isdir(path):
+				snapshot.update(scan_lua_files([path]))
+				continue
+
+			if path.endswith(".lua"):
+				try:
+					stat = os.stat(path)
+					snapshot[path] = (stat.st_mtime, stat.st_size)
+				except OSError:
+					snapshot.pop(path, None)
+				continue
+
+			# 删除或者移走的目录
+			prefix = path + os.sep
+			for file_path in [x for x in snapshot.keys() if x.startswith(prefix)]:
+				if not os.path.exists(file_path):
+					del snapshot[file_path]
+
+		return snapshot
+
+	def apply_snapshot(self, snapshot):
+		added, modified, deleted = diff_snapshots(self.snapshot, snapshot)
+		self.snapshot = snapshot
+		if not added and not modified and not deleted:
+			return
+
+		try:
+			self.on_changes(added, modified, deleted)
+		except Exception as e:
+			print("failed apply lua file changes", e)